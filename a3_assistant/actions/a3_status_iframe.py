@@ -9,6 +9,7 @@ from __future__ import annotations
 
 import html
 import json
+import sys
 from pathlib import Path
 from typing import Any, Optional
 
@@ -18,6 +19,62 @@ from pydantic import BaseModel, Field
 BASE_DIR = Path("/a3_assistant")
 STATE_DIR = Path("/app/backend/data/a3_state/projects")
 ACTIVE_DIR = Path("/app/backend/data/a3_state/active_users")
+# Module name Open WebUI gives the A3 pipe (function id a3_pm_methodologist).
+PIPE_MODULE = "function_a3_pm_methodologist"
+
+
+def _apply_journal_ops(state: Any, ops: list[Any]) -> Any:
+    for op in ops:
+        path = op.get("path") or []
+        if not path:
+            if op.get("op") == "set" and isinstance(op.get("value"), dict):
+                state = op["value"]
+            continue
+        parent = state
+        for key in path[:-1]:
+            if not isinstance(parent.get(key), dict):
+                parent[key] = {}
+            parent = parent[key]
+        key = path[-1]
+        if op.get("op") == "set":
+            parent[key] = op.get("value")
+        elif op.get("op") == "del":
+            parent.pop(key, None)
+        elif op.get("op") == "append":
+            if not isinstance(parent.get(key), list):
+                parent[key] = []
+            parent[key].append(op.get("value"))
+    return state
+
+
+def _read_project_file(project_id: str) -> Any:
+    """``<id>.json`` plus its ``.journal`` replayed, the way the pipe's JSON store loads it."""
+    p = STATE_DIR / f"{project_id}.json"
+    if not p.exists():
+        return None
+    state = json.loads(p.read_text(encoding="utf-8-sig"))
+    if not isinstance(state, dict):
+        return state
+    seq = int(state.pop("_journal_seq", 0) or 0)
+    for name in (f"{project_id}.journal.prev", f"{project_id}.journal"):
+        try:
+            lines = (STATE_DIR / name).read_text(encoding="utf-8").splitlines()
+        except OSError:
+            continue
+        for ln in lines:
+            try:
+                entry = json.loads(ln)
+            except ValueError:
+                break
+            if not isinstance(entry, dict) or not isinstance(entry.get("seq"), int):
+                continue
+            if entry["seq"] <= seq:
+                continue
+            if entry["seq"] != seq + 1:
+                return state
+            state = _apply_journal_ops(state, entry.get("ops") or [])
+            seq = entry["seq"]
+    return state
 
 
 class Action:
@@ -35,7 +92,35 @@ class Action:
             return str(first.get("id", "unknown_user"))
         return "unknown_user"
 
+    def _pipe_store(self):
+        # Same process as the A3 pipe: read through its store (JSON or SQLite).
+        getter = getattr(sys.modules.get(PIPE_MODULE), "get_project_store", None)
+        if not callable(getter):
+            return None
+        try:
+            return getter()
+        except Exception:
+            return None
+
+    def _pipe_registry(self):
+        getter = getattr(sys.modules.get(PIPE_MODULE), "get_active_registry", None)
+        if not callable(getter):
+            return None
+        try:
+            return getter()
+        except Exception:
+            return None
+
     def _get_active_project(self, user_id: str) -> str:
+        # 0) The pipe's in-memory registry: the user's project, else the last one touched.
+        registry = self._pipe_registry()
+        if registry is not None:
+            try:
+                pid = (user_id and registry.get(user_id)) or registry.current()
+                if pid:
+                    return pid
+            except Exception:
+                pass
         # 1) User's own active-project file (written by pipe on /continue or /new).
         if user_id and user_id != "unknown_user":
             p = ACTIVE_DIR / f"{user_id}.json"
@@ -47,25 +132,37 @@ class Action:
                         return pid
                 except Exception:
                     pass
-        # 2) Most recently modified project file (skip A3-0001 when real projects exist).
-        files = list(STATE_DIR.glob("*.json"))
-        if not files:
+        # 2) Most recently modified project (skip A3-0001 when real projects exist).
+        store = self._pipe_store()
+        if store is not None:
+            try:
+                return store.latest_project_id(skip=("A3-0001",)) or "A3-0001"
+            except Exception:
+                pass
+        mtimes = {f.stem: f.stat().st_mtime for f in STATE_DIR.glob("*.json")}
+        if not mtimes:
             return "A3-0001"
-        real = [f for f in files if f.stem != "A3-0001"]
-        pool = real if real else files
-        return max(pool, key=lambda f: f.stat().st_mtime).stem
+        # Journaled saves leave the snapshot untouched: count the journal too.
+        for f in STATE_DIR.glob("*.journal"):
+            if f.stem in mtimes:
+                mtimes[f.stem] = max(mtimes[f.stem], f.stat().st_mtime)
+        pool = [pid for pid in mtimes if pid != "A3-0001"] or list(mtimes)
+        return max(pool, key=lambda pid: mtimes[pid])
+
+    def _read_state(self, project_id: str) -> Any:
+        store = self._pipe_store()
+        if store is not None:
+            return store.load(project_id)
+        state = _read_project_file(project_id)
+        return {} if state is None else state
 
     def _load_state(self, project_id: str) -> dict[str, Any]:
-        p = STATE_DIR / f"{project_id}.json"
-        if not p.exists():
-            state = {}
-        else:
-            try:
-                state = json.loads(p.read_text(encoding="utf-8-sig"))
-                if not isinstance(state, dict):
-                    state = {}
-            except Exception:
+        try:
+            state = self._read_state(project_id)
+            if not isinstance(state, dict):
                 state = {}
+        except Exception:
+            state = {}
         state.setdefault("project_id", project_id)
         state.setdefault("current_step", 1)
         state.setdefault("meta", {})
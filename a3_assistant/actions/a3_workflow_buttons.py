@@ -8,12 +8,69 @@ required_open_webui_version: 0.8.0
 from __future__ import annotations
 
 import json
+import sys
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
 
 STATE_DIR = Path("/app/backend/data/a3_state/projects")
 ACTIVE_DIR = Path("/app/backend/data/a3_state/active_users")
+# Module name Open WebUI gives the A3 pipe (function id a3_pm_methodologist).
+PIPE_MODULE = "function_a3_pm_methodologist"
+
+
+def _apply_journal_ops(state: Any, ops: List[Any]) -> Any:
+    for op in ops:
+        path = op.get("path") or []
+        if not path:
+            if op.get("op") == "set" and isinstance(op.get("value"), dict):
+                state = op["value"]
+            continue
+        parent = state
+        for key in path[:-1]:
+            if not isinstance(parent.get(key), dict):
+                parent[key] = {}
+            parent = parent[key]
+        key = path[-1]
+        if op.get("op") == "set":
+            parent[key] = op.get("value")
+        elif op.get("op") == "del":
+            parent.pop(key, None)
+        elif op.get("op") == "append":
+            if not isinstance(parent.get(key), list):
+                parent[key] = []
+            parent[key].append(op.get("value"))
+    return state
+
+
+def _read_project_file(project_id: str) -> Any:
+    """``<id>.json`` plus its ``.journal`` replayed, the way the pipe's JSON store loads it."""
+    p = STATE_DIR / f"{project_id}.json"
+    if not p.exists():
+        return None
+    state = json.loads(p.read_text(encoding="utf-8-sig"))
+    if not isinstance(state, dict):
+        return state
+    seq = int(state.pop("_journal_seq", 0) or 0)
+    for name in (f"{project_id}.journal.prev", f"{project_id}.journal"):
+        try:
+            lines = (STATE_DIR / name).read_text(encoding="utf-8").splitlines()
+        except OSError:
+            continue
+        for ln in lines:
+            try:
+                entry = json.loads(ln)
+            except ValueError:
+                break
+            if not isinstance(entry, dict) or not isinstance(entry.get("seq"), int):
+                continue
+            if entry["seq"] <= seq:
+                continue
+            if entry["seq"] != seq + 1:
+                return state
+            state = _apply_journal_ops(state, entry.get("ops") or [])
+            seq = entry["seq"]
+    return state
 
 
 class Action:
@@ -33,6 +90,12 @@ class Action:
         return "unknown_user"
 
     def _get_active_project(self, user_id: str) -> str:
+        getter = getattr(sys.modules.get(PIPE_MODULE), "get_active_registry", None)
+        if callable(getter):
+            try:
+                return getter().get(user_id) or "A3-0001"
+            except Exception:
+                pass
         p = ACTIVE_DIR / f"{user_id}.json"
         if not p.exists():
             return "A3-0001"
@@ -43,14 +106,28 @@ class Action:
         except Exception:
             return "A3-0001"
 
+    def _pipe_store(self):
+        # Same process as the A3 pipe: read through its store (JSON or SQLite).
+        getter = getattr(sys.modules.get(PIPE_MODULE), "get_project_store", None)
+        if not callable(getter):
+            return None
+        try:
+            return getter()
+        except Exception:
+            return None
+
     def _load_state(self, project_id: str) -> Dict[str, Any]:
-        p = STATE_DIR / f"{project_id}.json"
-        if not p.exists():
-            return {"current_step": 1, "meta": {}, "data": {}}
+        store = self._pipe_store()
         try:
-            return json.loads(p.read_text(encoding="utf-8"))
+            if store is not None:
+                state = store.load(project_id)
+            else:
+                state = _read_project_file(project_id)
         except Exception:
+            state = None
+        if not isinstance(state, dict):
             return {"current_step": 1, "meta": {}, "data": {}}
+        return state
 
     def _step_actions(self, step: int) -> List[str]:
         return []
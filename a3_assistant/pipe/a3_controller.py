@@ -1,9 +1,37 @@
 from pathlib import Path
 
+import asyncio
+
+import atexit
+
+import contextlib
+
+import contextvars
+
+import functools
+
+import hashlib
+
 import json
 
+import os
+
 import re as _re
 
+import shutil
+
+import sqlite3
+
+import threading
+
+import time
+
+import weakref
+
+from collections import OrderedDict, deque
+
+from concurrent.futures import ThreadPoolExecutor
+
 from typing import List, Dict, Any, Tuple, Optional
 
 from pydantic import BaseModel, Field
@@ -12,6 +40,14 @@ from open_webui.main import generate_chat_completions
 
 from open_webui.models.users import Users
 
+try:
+
+    import fcntl
+
+except ImportError:  # Windows dev boxes: in-process locks only
+
+    fcntl = None
+
 def _re_search(pattern, string, flags=0):
 
     try:
@@ -84,368 +120,3285 @@ STATE_DIR.mkdir(parents=True, exist_ok=True)
 
 ACTIVE_DIR.mkdir(parents=True, exist_ok=True)
 
-# ====== DoD rules ======
+GLOBAL_ACTIVE_PATH = STATE_DIR.parent / "global_active.json"
 
-SOLUTION_WORDS = [
+LOCK_DIR = STATE_DIR.parent / "locks"
 
-    "автоматиз",
+PROJECT_SEQ_PATH = STATE_DIR.parent / "project_seq.json"
 
-    "оптимиз",
+PROJECTS_INDEX_PATH = STATE_DIR.parent / "projects_index.jsonl"
 
-    "внедр",
+LLM_CACHE_DIR = STATE_DIR.parent / "llm_cache"
 
-    "улучш",
+LLM_METRICS_PATH = STATE_DIR.parent / "llm_metrics.json"
 
-    "реализ",
+JOBS_DIR = STATE_DIR.parent / "jobs"
 
-    "разработ",
+# ====== crash-safe file writes ======
 
-    "настро",
+# "always" fsyncs every write, "batched" at most once per interval,
+# "never" leaves flushing to the OS. The previous generation is kept in
+# ``<name>.bak`` in every mode, so a torn write is never fatal.
+FSYNC_MODES = ("always", "batched", "never")
 
-    "создать",
+_LAST_FSYNC = {"ts": 0.0}
 
-    "ввести",
 
-    "перейти",
+def _backup_path(path: Path) -> Path:
+    return path.with_name(path.name + ".bak")
 
-    "сделать",
 
-    "надо",
+def _fsync_dir(directory: Path) -> None:
+    try:
+        fd = os.open(str(directory), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _atomic_write_text(
+    path: Path,
+    text: str,
+    fsync: str = "always",
+    fsync_interval: float = 5.0,
+    keep_previous: bool = False,
+) -> None:
+    """Replace ``path`` with ``text`` via a temp file and an atomic rename."""
+    mode = fsync if fsync in FSYNC_MODES else "always"
+    do_sync = mode == "always" or (
+        mode == "batched" and time.monotonic() - _LAST_FSYNC["ts"] >= fsync_interval
+    )
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            if do_sync:
+                os.fsync(f.fileno())
+        if keep_previous and path.exists():
+            bak = _backup_path(path)
+            try:
+                if bak.exists():
+                    bak.unlink()
+                os.link(path, bak)
+            except OSError:
+                shutil.copyfile(path, bak)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        raise
+    if do_sync:
+        _fsync_dir(path.parent)
+        _LAST_FSYNC["ts"] = time.monotonic()
 
-    "нужно",
 
-]
+def _read_json_with_fallback(path: Path) -> Optional[Dict[str, Any]]:
+    """Read ``path``; if it is torn or corrupted, use the ``.bak`` generation."""
+    if not path.exists():
+        return None
+    try:
+        return json.loads(path.read_text(encoding="utf-8-sig"))
+    except (OSError, ValueError) as e:
+        bak = _backup_path(path)
+        if not bak.exists():
+            raise
+        try:
+            return json.loads(bak.read_text(encoding="utf-8-sig"))
+        except (OSError, ValueError):
+            raise e
 
-WEAK_PHRASES = [
+# ====== project stores ======
 
-    "неизвестно",
+STATE_BACKENDS = ("json", "sqlite")
 
-    "пока неизвестно",
+DEFAULT_DB_NAME = "projects.sqlite3"
 
-    "нет данных",
 
-    "данных нет",
+def _project_number(project_id: str) -> Optional[int]:
+    m = _re_search(r"(\d+)$", project_id or "")
+    if not m:
+        return None
+    try:
+        return int(m.group(1))
+    except Exception:
+        return None
 
-    "сложно сказать",
 
-    "в целом",
+def _state_owner(state: Dict[str, Any]) -> str:
+    meta = state.get("meta") if isinstance(state, dict) else None
+    return str(meta.get("owner") or "") if isinstance(meta, dict) else ""
 
-    "примерно",
 
-    "приблизительно",
+def _state_step(state: Dict[str, Any]) -> int:
+    try:
+        return int(state.get("current_step", 1))
+    except Exception:
+        return 1
 
-    "не знаю",
 
-    "пока нет",
+def _state_title(state: Dict[str, Any]) -> str:
+    steps = ((state or {}).get("data") or {}).get("steps") or {}
+    pd = steps.get("process_definition") if isinstance(steps, dict) else None
+    return str(pd.get("project_title") or "").strip() if isinstance(pd, dict) else ""
 
-    "нет информации",
 
-    "не определено",
+def _index_entry(project_id: str, state: Dict[str, Any], updated_at: float) -> Dict[str, Any]:
+    return {
+        "id": project_id,
+        "title": _state_title(state),
+        "current_step": _state_step(state),
+        "updated_at": updated_at,
+        "owner": _state_owner(state),
+    }
 
-    "не могу сказать",
 
-]
+def _json_diff(old: Any, new: Any, path: Tuple = ()) -> List[Dict[str, Any]]:
+    """JSON-patch-like ops turning ``old`` into ``new`` (set / del / append)."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops: List[Dict[str, Any]] = []
+        for key, value in new.items():
+            if key not in old:
+                ops.append({"op": "set", "path": list(path + (key,)), "value": value})
+            else:
+                ops += _json_diff(old[key], value, path + (key,))
+        for key in old:
+            if key not in new:
+                ops.append({"op": "del", "path": list(path + (key,))})
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        if len(new) > len(old) and new[: len(old)] == old:
+            return [
+                {"op": "append", "path": list(path), "value": value}
+                for value in new[len(old):]
+            ]
+    if type(old) is not type(new) or old != new:
+        return [{"op": "set", "path": list(path), "value": new}]
+    return []
+
+
+def _json_apply(state: Dict[str, Any], ops: List[Dict[str, Any]]) -> Dict[str, Any]:
+    for op in ops:
+        path = op.get("path") or []
+        if not path:
+            if op.get("op") == "set" and isinstance(op.get("value"), dict):
+                state = op["value"]
+            continue
+        parent: Any = state
+        for key in path[:-1]:
+            if not isinstance(parent.get(key), dict):
+                parent[key] = {}
+            parent = parent[key]
+        key = path[-1]
+        if op.get("op") == "set":
+            parent[key] = op.get("value")
+        elif op.get("op") == "del":
+            parent.pop(key, None)
+        elif op.get("op") == "append":
+            if not isinstance(parent.get(key), list):
+                parent[key] = []
+            parent[key].append(op.get("value"))
+    return state
+
+
+_SHORT_LOCKS: Dict[str, threading.Lock] = {}
+
+_SHORT_LOCKS_GUARD = threading.Lock()
+
+
+@contextlib.contextmanager
+def _short_file_lock(name: str):
+    """Brief exclusive section on shared a3_state files, across workers when fcntl exists."""
+    with _SHORT_LOCKS_GUARD:
+        lock = _SHORT_LOCKS.setdefault(name, threading.Lock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        LOCK_DIR.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(LOCK_DIR / f"{name}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+
+def _query_entries(
+    entries, owner: Optional[str], step: Optional[int], offset: int, limit: int
+) -> Tuple[int, List[Dict[str, Any]]]:
+    rows = [
+        e for e in entries
+        if (owner is None or e.get("owner") == owner)
+        and (step is None or e.get("current_step") == step)
+    ]
+    rows.sort(key=lambda e: (e.get("updated_at") or 0, e.get("id") or ""), reverse=True)
+    return len(rows), rows[max(0, offset): max(0, offset) + max(0, limit)]
+
+
+class ProjectIndex:
+    """Summary rows for /projects kept in PROJECTS_INDEX_PATH (JSON backend).
+
+    Every save appends one ``_index_entry`` line; the last line per project
+    wins. Readers tail the file incrementally, so rows written by other
+    workers show up without rescanning. The file is rewritten compactly
+    once stale lines outnumber live ones, and rebuilt from the projects
+    directory if it is missing.
+    """
+
+    _COMPACT_SLACK = 64
+
+    def __init__(self, store: "JsonProjectStore"):
+        self.store = store
+        self._lock = threading.RLock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._lines = 0
+        self._offset = 0
+        self._ino: Optional[int] = None
+
+    def record(self, project_id: str, state: Dict[str, Any]) -> None:
+        entry = _index_entry(project_id, state, time.time())
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock, _short_file_lock("projects_index"):
+            if not PROJECTS_INDEX_PATH.exists():
+                self._rebuild()
+            fd = os.open(str(PROJECTS_INDEX_PATH), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+            self._refresh()
+            if self._lines > 2 * len(self._entries) + self._COMPACT_SLACK:
+                self._write(self._entries.values())
+
+    def query(
+        self, owner: Optional[str] = None, step: Optional[int] = None, offset: int = 0, limit: int = 20
+    ) -> Tuple[int, List[Dict[str, Any]]]:
+        with self._lock:
+            if not PROJECTS_INDEX_PATH.exists():
+                with _short_file_lock("projects_index"):
+                    if not PROJECTS_INDEX_PATH.exists():
+                        self._rebuild()
+            self._refresh()
+            return _query_entries(self._entries.values(), owner, step, offset, limit)
+
+    def _refresh(self) -> None:
+        try:
+            st = os.stat(PROJECTS_INDEX_PATH)
+        except OSError:
+            self._entries, self._lines, self._offset, self._ino = {}, 0, 0, None
+            return
+        if st.st_ino != self._ino or st.st_size < self._offset:
+            self._entries, self._lines, self._offset, self._ino = {}, 0, 0, st.st_ino
+        if st.st_size == self._offset:
+            return
+        with open(PROJECTS_INDEX_PATH, "rb") as f:
+            f.seek(self._offset)
+            chunk = f.read()
+        end = chunk.rfind(b"\n") + 1  # a half-written last line is picked up next time
+        for raw in chunk[:end].splitlines():
+            try:
+                entry = json.loads(raw)
+            except ValueError:
+                continue
+            if isinstance(entry, dict) and entry.get("id"):
+                self._entries[entry["id"]] = entry
+                self._lines += 1
+        self._offset += end
+
+    def _rebuild(self) -> None:
+        entries = []
+        for pid in self.store.list_ids():
+            try:
+                state = self.store.load(pid)
+                mtime = self.store.path(pid).stat().st_mtime
+            except Exception:
+                continue
+            if isinstance(state, dict):
+                entries.append(_index_entry(pid, state, mtime))
+        self._write(entries)
+
+    def _write(self, entries) -> None:
+        text = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries)
+        _atomic_write_text(
+            PROJECTS_INDEX_PATH,
+            text,
+            fsync=self.store.fsync,
+            fsync_interval=self.store.fsync_interval,
+        )
+        self._refresh()
 
-class Pipe:
 
-    class Valves(BaseModel):
+class JsonProjectStore:
+    """Legacy layout: one pretty-printed ``<project_id>.json`` per project in STATE_DIR.
 
-        DEFAULT_PROJECT_ID: str = Field(default="A3-0001")
+    With ``journal_max_ops`` > 0 a save appends only the diff to
+    ``<id>.journal`` (one ``{"seq", "ops"}`` line per save). The snapshot
+    carries the last folded ``_journal_seq`` and is rewritten after
+    ``journal_max_ops`` entries or ``journal_idle_sec`` without writes; the
+    folded journal is kept as ``<id>.journal.prev`` next to ``<id>.json.bak``.
+    """
 
-        METHODOLOGIST_MODEL: str = Field(default="gpt-5.2")
+    backend = "json"
 
-    _EDIT_FIELDS: dict = {
-        "проблема": ("data", "steps", "raw_problem", "raw_problem_sentence"),
-        "где/когда": ("data", "steps", "problem_spec", "where_when"),
-        "масштаб": ("data", "steps", "problem_spec", "scale"),
-        "последствия": ("data", "steps", "problem_spec", "consequences"),
-        "кто страдает": ("data", "steps", "problem_spec", "who_suffers"),
-        "деньги": ("data", "steps", "problem_spec", "money_impact"),
-        "событие начала": ("data", "steps", "process_context", "start_event"),
-        "событие окончания": ("data", "steps", "process_context", "end_event"),
-        "владелец процесса": ("data", "steps", "process_context", "owner"),
-        "периметр": ("data", "steps", "process_context", "perimeter"),
-        "название процесса": ("data", "steps", "process_definition", "process_name"),
-        "название проекта": ("data", "steps", "process_definition", "project_title"),
-    }
+    _BASELINES_MAX = 512
 
-    def __init__(self):
+    def __init__(
+        self,
+        fsync: str = "always",
+        fsync_interval: float = 5.0,
+        journal_max_ops: int = 0,
+        journal_idle_sec: float = 0.0,
+    ):
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.journal_max_ops = max(0, int(journal_max_ops or 0))
+        self.journal_idle_sec = max(0.0, float(journal_idle_sec or 0))
+        self._lock = threading.RLock()
+        # project_id -> (version token, snapshot seq, last seq, state as on disk)
+        self._baselines: "OrderedDict[str, Tuple[Any, int, int, Dict[str, Any]]]" = OrderedDict()
+        self._idle_handles: Dict[str, Any] = {}
+        self.index = ProjectIndex(self)
+
+    def path(self, project_id: str) -> Path:
+        return STATE_DIR / f"{project_id}.json"
 
-        self.valves = self.Valves()
+    def journal_path(self, project_id: str) -> Path:
+        return STATE_DIR / f"{project_id}.journal"
 
-    def pipes(self):
-        return [{"id": "a3", "name": "A3 Project Controller"}]
+    def _read_journal(self, project_id: str) -> List[Dict[str, Any]]:
+        entries: List[Dict[str, Any]] = []
+        jp = self.journal_path(project_id)
+        for p in (jp.with_name(jp.name + ".prev"), jp):
+            try:
+                lines = p.read_text(encoding="utf-8").splitlines()
+            except OSError:
+                continue
+            for ln in lines:
+                try:
+                    entry = json.loads(ln)
+                except ValueError:
+                    break  # torn tail after a crash: nothing valid follows
+                if isinstance(entry, dict) and isinstance(entry.get("seq"), int):
+                    entries.append(entry)
+        return entries
+
+    def _remember(self, project_id: str, snap_seq: int, seq: int, state: Dict[str, Any]) -> None:
+        self._baselines[project_id] = (self.version(project_id), snap_seq, seq, _copy_json(state))
+        self._baselines.move_to_end(project_id)
+        while len(self._baselines) > self._BASELINES_MAX:
+            self._baselines.popitem(last=False)
+
+    def load(self, project_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            state = _read_json_with_fallback(self.path(project_id))
+            if state is None:
+                return None
+            snap_seq = int(state.pop("_journal_seq", 0) or 0)
+            seq = snap_seq
+            for entry in self._read_journal(project_id):
+                if entry["seq"] <= seq:
+                    continue
+                if entry["seq"] != seq + 1:
+                    break  # gap: later entries were written on top of lost ones
+                state = _json_apply(state, entry.get("ops") or [])
+                seq = entry["seq"]
+            if self.journal_max_ops:
+                self._remember(project_id, snap_seq, seq, state)
+            return state
+
+    def save(self, project_id: str, state: Dict[str, Any]) -> None:
+        self._save(project_id, state)
+        self.index.record(project_id, state)
+
+    def _save(self, project_id: str, state: Dict[str, Any]) -> None:
+        with self._lock:
+            base = self._baselines.get(project_id)
+            if (
+                not self.journal_max_ops
+                or base is None
+                or base[0] != self.version(project_id)
+            ):
+                # No trusted on-disk baseline (first write, another worker
+                # wrote in between, or journaling is off): full snapshot.
+                self._write_snapshot(project_id, state, self._last_seq(project_id, base))
+                return
+            _, snap_seq, seq, before = base
+            ops = _json_diff(before, state)
+            if not ops:
+                # Keep "recently modified" semantics (/continue) without a write.
+                os.utime(self.path(project_id))
+                self._remember(project_id, snap_seq, seq, before)
+                return
+            seq += 1
+            line = json.dumps({"seq": seq, "ops": ops}, ensure_ascii=False) + "\n"
+            with open(self.journal_path(project_id), "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                if self.fsync == "always":
+                    os.fsync(f.fileno())
+            if seq - snap_seq >= self.journal_max_ops:
+                self._write_snapshot(project_id, state, seq)
+                return
+            self._remember(project_id, snap_seq, seq, state)
+            self._schedule_idle_compaction(project_id)
+
+    def _last_seq(self, project_id: str, base) -> int:
+        if base is not None and base[0] == self.version(project_id):
+            return base[2]
+        entries = self._read_journal(project_id)
+        return max([e["seq"] for e in entries] or [0])
+
+    def _write_snapshot(self, project_id: str, state: Dict[str, Any], seq: int) -> None:
+        doc = dict(state)
+        if self.journal_max_ops or seq:
+            doc["_journal_seq"] = seq
+        _atomic_write_text(
+            self.path(project_id),
+            json.dumps(doc, ensure_ascii=False, indent=2),
+            fsync=self.fsync,
+            fsync_interval=self.fsync_interval,
+            keep_previous=True,
+        )
+        jp = self.journal_path(project_id)
+        if jp.exists():
+            os.replace(jp, jp.with_name(jp.name + ".prev"))
+        if self.journal_max_ops:
+            self._remember(project_id, seq, seq, state)
+        else:
+            self._baselines.pop(project_id, None)
+
+    def compact(self, project_id: str) -> bool:
+        """Fold the journal into a fresh snapshot; False if there was nothing to fold."""
+        with self._lock:
+            self._idle_handles.pop(project_id, None)
+            base = self._baselines.get(project_id)
+            if base is None or base[0] != self.version(project_id):
+                if not self.journal_path(project_id).exists():
+                    return False
+                state = self.load(project_id)
+                base = self._baselines.get(project_id)
+                if state is None or base is None:
+                    return False
+            _, snap_seq, seq, state = base
+            if seq == snap_seq:
+                return False
+            self._write_snapshot(project_id, state, seq)
+            return True
 
-    def _get_edit_field(self, state: dict, path: tuple) -> str:
-        obj = state
-        for key in path[:-1]:
-            if not isinstance(obj, dict):
-                return ""
-            obj = obj.get(key) or {}
-        if not isinstance(obj, dict):
-            return ""
-        return str(obj.get(path[-1], "") or "").strip()
+    def _schedule_idle_compaction(self, project_id: str) -> None:
+        if not self.journal_idle_sec:
+            return
+        loop = _owner_loop()
+        if loop is None:
+            return
 
-    def _set_edit_field(self, state: dict, path: tuple, value: str) -> None:
-        obj = state
-        for key in path[:-1]:
-            if not isinstance(obj.get(key), dict):
-                obj[key] = {}
-            obj = obj[key]
-        obj[path[-1]] = value
+        def arm() -> None:
+            handle = self._idle_handles.pop(project_id, None)
+            if handle is not None:
+                handle.cancel()
+            # The compaction rewrites the snapshot (and fsyncs it): run it
+            # on the I/O pool, never on the loop the timer fires on.
+            self._idle_handles[project_id] = loop.call_later(
+                self.journal_idle_sec, loop.run_in_executor, _io_pool(), self._compact_quietly, project_id
+            )
 
-    def _build_edit_view(self, state: dict, project_id: str) -> str:
-        lines = [
-            f"✏️ Режим редактирования проекта `{project_id}`\n",
-            "Отредактируй нужные поля в блоке ниже, скопируй и отправь обратно.",
-            "Чтобы выйти без изменений — напиши `готово`.\n",
-            "```",
-        ]
-        for label, path in self._EDIT_FIELDS.items():
-            value = self._get_edit_field(state, path)
-            lines.append(f"{label.capitalize()}: {value}")
-        lines.append("```")
-        return "\n".join(lines)
+        _on_loop(loop, arm)
 
-    @staticmethod
-    def _fmt_hint(h: str) -> str:
-        """Format a hint: bold the label before first colon, add arrow."""
-        h = h.strip().strip('"').strip("'")
-        if ":" in h:
-            label, _, rest = h.partition(":")
-            label = label.strip()
-            rest = rest.strip()
-            if label and len(label) < 60:
-                return f"> **{label}** → {rest}"
-        return f"> {h}"
+    def _compact_quietly(self, project_id: str) -> None:
+        try:
+            self.compact(project_id)
+        except Exception:
+            pass
 
-    async def _generate_hypothesis(self, state: dict, project_id: str, __request__, __user__: dict) -> str:
-        steps = state.get("data", {}).get("steps", {})
+    def version(self, project_id: str) -> Optional[Tuple[int, ...]]:
+        """Cache token over snapshot + journal: any write always changes it."""
+        try:
+            st = os.stat(self.path(project_id))
+        except OSError:
+            return None
+        token: Tuple[int, ...] = (st.st_ino, st.st_mtime_ns, st.st_size)
+        try:
+            jst = os.stat(self.journal_path(project_id))
+            token += (jst.st_ino, jst.st_mtime_ns, jst.st_size)
+        except OSError:
+            pass
+        return token
 
-        raw_problem = steps.get("raw_problem", {}).get("raw_problem_sentence", "")
-        if not raw_problem:
-            return "⚠️ Сначала опиши проблему на шаге 1 — тогда смогу сгенерировать гипотезу."
+    def exists(self, project_id: str) -> bool:
+        return self.path(project_id).exists()
 
-        spec = steps.get("problem_spec", {})
-        spec_text = (
-            f"Где/когда: {spec.get('where_when','—')}, "
-            f"Масштаб: {spec.get('scale','—')}, "
-            f"Последствия: {spec.get('consequences','—')}, "
-            f"Кто страдает: {spec.get('who_suffers','—')}, "
-            f"Деньги: {spec.get('money_impact','—')}"
-        ) if spec else "нет данных"
+    def list_ids(self) -> List[str]:
+        return [p.stem for p in STATE_DIR.glob("*.json") if p.is_file()]
 
-        ctx = steps.get("process_context", {})
-        process_text = (
-            f"Начало: {ctx.get('start_event','—')}, "
-            f"Окончание: {ctx.get('end_event','—')}, "
-            f"Владелец: {ctx.get('owner','—')}, "
-            f"Периметр: {ctx.get('perimeter','—')}, "
-            f"Метрики: {', '.join(ctx.get('result_metrics') or ['—'])}"
-        ) if ctx else "нет данных"
+    def max_number(self) -> int:
+        nums = [_project_number(pid) for pid in self.list_ids()]
+        return max([n for n in nums if n is not None] or [0])
 
-        system = (
-            "Ты методолог A3/Lean. Генерируй полный черновик A3 по предоставленным данным. "
-            "Верни СТРОГО JSON без пояснений."
+    def query_index(
+        self, owner: Optional[str] = None, step: Optional[int] = None, offset: int = 0, limit: int = 20
+    ) -> Tuple[int, List[Dict[str, Any]]]:
+        """(total, page) of index rows, most recently updated first."""
+        return self.index.query(owner=owner, step=step, offset=offset, limit=limit)
+
+    def allocate_number(self) -> int:
+        """Next project number from PROJECT_SEQ_PATH; the directory is scanned only to seed it."""
+        with _short_file_lock("project_seq"):
+            try:
+                nxt = int(json.loads(PROJECT_SEQ_PATH.read_text(encoding="utf-8"))["next"])
+            except (OSError, ValueError, KeyError, TypeError):
+                nxt = self.max_number() + 1
+            # IDs typed in by hand via /continue may already be taken.
+            while self.exists(f"{nxt:05d}"):
+                nxt += 1
+            _atomic_write_text(
+                PROJECT_SEQ_PATH,
+                json.dumps({"next": nxt + 1}),
+                fsync=self.fsync,
+                fsync_interval=self.fsync_interval,
+            )
+            return nxt
+
+    def latest_project_id(self, skip: Tuple[str, ...] = ()) -> Optional[str]:
+        mtimes: Dict[str, float] = {}
+        for p in STATE_DIR.glob("*.json"):
+            if p.is_file():
+                mtimes[p.stem] = p.stat().st_mtime
+        for p in STATE_DIR.glob("*.journal"):
+            if p.stem in mtimes:
+                mtimes[p.stem] = max(mtimes[p.stem], p.stat().st_mtime)
+        pool = [pid for pid in mtimes if pid not in skip] or list(mtimes)
+        if not pool:
+            return None
+        return max(pool, key=lambda pid: mtimes[pid])
+
+    def close(self) -> None:
+        for handle in self._idle_handles.values():
+            handle.cancel()
+        self._idle_handles.clear()
+
+
+class SqliteProjectStore:
+    """WAL-mode SQLite store: indexed project columns plus the state blob.
+
+    The first open imports the JSON directory once (see ``migrate_from_json``).
+    """
+
+    backend = "sqlite"
+
+    _SYNCHRONOUS = {"always": "FULL", "batched": "NORMAL", "never": "OFF"}
+
+    def __init__(self, db_path: Path, fsync: str = "always"):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._con = sqlite3.connect(
+            str(self.db_path), timeout=30, isolation_level=None, check_same_thread=False
         )
-        user_prompt = (
-            "Сгенерируй полный черновик A3 по данным ниже.\n\n"
-            f"Проблема (шаг 1): {raw_problem}\n"
-            f"Уточнение (шаг 2): {spec_text}\n"
-            f"Процесс (шаг 3): {process_text}\n\n"
-            "Верни строго JSON:\n"
-            '{\n'
-            '  "problem": "...",\n'
-            '  "spec": {"where_when":"...","scale":"...","consequences":"...","who_suffers":"...","money_impact":"..."},\n'
-            '  "baseline": [{"metric":"...","current_value":"..."}],\n'
-            '  "target": [{"metric":"...","target_value":"..."}],\n'
-            '  "root_causes": ["...","...","..."],\n'
-            '  "actions": [{"action":"...","owner":"...","due":"..."}],\n'
-            '  "monitoring": "..."\n'
-            '}'
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute(f"PRAGMA synchronous={self._SYNCHRONOUS.get(fsync, 'FULL')}")
+        self._con.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS projects (
+                project_id   TEXT PRIMARY KEY,
+                id_num       INTEGER,
+                owner        TEXT NOT NULL DEFAULT '',
+                title        TEXT NOT NULL DEFAULT '',
+                current_step INTEGER NOT NULL DEFAULT 1,
+                updated_at   REAL NOT NULL,
+                version      INTEGER NOT NULL DEFAULT 1,
+                state        TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_projects_id_num ON projects(id_num);
+            CREATE INDEX IF NOT EXISTS idx_projects_owner ON projects(owner, updated_at);
+            CREATE INDEX IF NOT EXISTS idx_projects_step ON projects(current_step, updated_at);
+            CREATE INDEX IF NOT EXISTS idx_projects_updated ON projects(updated_at);
+            CREATE TABLE IF NOT EXISTS store_meta (
+                key   TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            """
+        )
+        cols = {r[1] for r in self._con.execute("PRAGMA table_info(projects)")}
+        if "version" not in cols:
+            self._con.execute("ALTER TABLE projects ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+        if "title" not in cols:
+            self._con.execute("ALTER TABLE projects ADD COLUMN title TEXT NOT NULL DEFAULT ''")
+            for pid, raw in self._con.execute("SELECT project_id, state FROM projects").fetchall():
+                try:
+                    title = _state_title(json.loads(raw))
+                except ValueError:
+                    continue
+                self._con.execute("UPDATE projects SET title=? WHERE project_id=?", (title, pid))
+        self.migrate_from_json()
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._con.execute("SELECT value FROM store_meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def migrate_from_json(self, src_dir: Optional[Path] = None) -> int:
+        """One-shot import of ``<id>.json`` files; later calls are no-ops."""
+        src = Path(src_dir) if src_dir is not None else STATE_DIR
+        with self._lock:
+            if self._get_meta("migrated_from_json"):
+                return 0
+            imported = 0
+            self._con.execute("BEGIN IMMEDIATE")
+            try:
+                legacy = JsonProjectStore()
+                for p in sorted(src.glob("*.json")) if src.exists() else []:
+                    try:
+                        state = legacy.load(p.stem) if src == STATE_DIR else _read_json_with_fallback(p)
+                    except Exception:
+                        continue
+                    if not isinstance(state, dict):
+                        continue
+                    cur = self._con.execute(
+                        "INSERT OR IGNORE INTO projects"
+                        " (project_id, id_num, owner, title, current_step, updated_at, state)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            p.stem,
+                            _project_number(p.stem),
+                            _state_owner(state),
+                            _state_title(state),
+                            _state_step(state),
+                            p.stat().st_mtime,
+                            json.dumps(state, ensure_ascii=False),
+                        ),
+                    )
+                    imported += cur.rowcount
+                marker = {"source": str(src), "projects": imported, "at": time.time()}
+                self._con.execute(
+                    "INSERT OR REPLACE INTO store_meta (key, value) VALUES (?, ?)",
+                    ("migrated_from_json", json.dumps(marker)),
+                )
+                self._con.execute("COMMIT")
+            except BaseException:
+                self._con.execute("ROLLBACK")
+                raise
+            return imported
+
+    def load(self, project_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._con.execute(
+                "SELECT state FROM projects WHERE project_id=?", (project_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, project_id: str, state: Dict[str, Any]) -> None:
+        with self._lock:
+            self._con.execute(
+                "INSERT INTO projects"
+                " (project_id, id_num, owner, title, current_step, updated_at, state)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(project_id) DO UPDATE SET"
+                " owner=excluded.owner, title=excluded.title,"
+                " current_step=excluded.current_step,"
+                " updated_at=excluded.updated_at, version=projects.version + 1,"
+                " state=excluded.state",
+                (
+                    project_id,
+                    _project_number(project_id),
+                    _state_owner(state),
+                    _state_title(state),
+                    _state_step(state),
+                    time.time(),
+                    json.dumps(state, ensure_ascii=False),
+                ),
+            )
+
+    def version(self, project_id: str) -> Optional[int]:
+        with self._lock:
+            row = self._con.execute(
+                "SELECT version FROM projects WHERE project_id=?", (project_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def exists(self, project_id: str) -> bool:
+        with self._lock:
+            row = self._con.execute(
+                "SELECT 1 FROM projects WHERE project_id=?", (project_id,)
+            ).fetchone()
+        return row is not None
+
+    def list_ids(self) -> List[str]:
+        with self._lock:
+            rows = self._con.execute("SELECT project_id FROM projects ORDER BY project_id").fetchall()
+        return [r[0] for r in rows]
+
+    def max_number(self) -> int:
+        with self._lock:
+            row = self._con.execute("SELECT MAX(id_num) FROM projects").fetchone()
+        return int(row[0] or 0) if row else 0
+
+    def query_index(
+        self, owner: Optional[str] = None, step: Optional[int] = None, offset: int = 0, limit: int = 20
+    ) -> Tuple[int, List[Dict[str, Any]]]:
+        """(total, page) of project rows, most recently updated first."""
+        where, args = [], []
+        if owner is not None:
+            where.append("owner=?")
+            args.append(owner)
+        if step is not None:
+            where.append("current_step=?")
+            args.append(step)
+        cond = (" WHERE " + " AND ".join(where)) if where else ""
+        with self._lock:
+            total = self._con.execute(f"SELECT COUNT(*) FROM projects{cond}", args).fetchone()[0]
+            rows = self._con.execute(
+                "SELECT project_id, title, current_step, updated_at, owner FROM projects"
+                f"{cond} ORDER BY updated_at DESC, project_id DESC LIMIT ? OFFSET ?",
+                args + [max(0, limit), max(0, offset)],
+            ).fetchall()
+        keys = ("id", "title", "current_step", "updated_at", "owner")
+        return int(total), [dict(zip(keys, r)) for r in rows]
+
+    def allocate_number(self) -> int:
+        """Next project number from the ``next_project_num`` sequence in store_meta."""
+        with self._lock:
+            self._con.execute("BEGIN IMMEDIATE")
+            try:
+                value = self._get_meta("next_project_num")
+                if value is None:
+                    row = self._con.execute("SELECT MAX(id_num) FROM projects").fetchone()
+                    value = int(row[0] or 0) + 1
+                nxt = int(value)
+                while self._con.execute(
+                    "SELECT 1 FROM projects WHERE project_id=?", (f"{nxt:05d}",)
+                ).fetchone():
+                    nxt += 1
+                self._con.execute(
+                    "INSERT OR REPLACE INTO store_meta (key, value) VALUES (?, ?)",
+                    ("next_project_num", str(nxt + 1)),
+                )
+                self._con.execute("COMMIT")
+            except BaseException:
+                self._con.execute("ROLLBACK")
+                raise
+            return nxt
+
+    def latest_project_id(self, skip: Tuple[str, ...] = ()) -> Optional[str]:
+        with self._lock:
+            rows = self._con.execute(
+                "SELECT project_id FROM projects ORDER BY updated_at DESC LIMIT ?",
+                (len(skip) + 1,),
+            ).fetchall()
+        pool = [r[0] for r in rows if r[0] not in skip] or [r[0] for r in rows]
+        return pool[0] if pool else None
+
+    def close(self) -> None:
+        with self._lock:
+            self._con.close()
+
+
+def _copy_json(value: Any) -> Any:
+    """Copy of JSON-shaped data; much cheaper than copy.deepcopy for states."""
+    if isinstance(value, dict):
+        return {k: _copy_json(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_json(v) for v in value]
+    return value
+
+
+class ProjectStateCache:
+    """LRU of parsed project states keyed by project_id.
+
+    Entries are validated against the store's version token (file inode +
+    mtime + size, or the SQLite row version), so writes from another worker
+    are never served stale. Callers always get a private copy.
+    """
+
+    def __init__(self, capacity: int = 256):
+        self.capacity = max(0, int(capacity))
+        self._items: "OrderedDict[str, Tuple[Any, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, project_id: str, version: Any) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            item = self._items.get(project_id)
+            if item is None:
+                self.misses += 1
+                return None
+            if item[0] != version:
+                self.stale += 1
+                del self._items[project_id]
+                return None
+            self._items.move_to_end(project_id)
+            self.hits += 1
+            cached = item[1]
+        return _copy_json(cached)
+
+    def put(self, project_id: str, version: Any, state: Dict[str, Any]) -> None:
+        if self.capacity <= 0 or version is None or not isinstance(state, dict):
+            return
+        entry = (version, _copy_json(state))
+        with self._lock:
+            self._items[project_id] = entry
+            self._items.move_to_end(project_id)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, project_id: str) -> None:
+        with self._lock:
+            self._items.pop(project_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses + self.stale
+            return {
+                "size": len(self._items),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+class CachedProjectStore:
+    """Read-through / write-through ProjectStateCache in front of a store."""
+
+    def __init__(self, inner, capacity: int = 256):
+        self.inner = inner
+        self.backend = inner.backend
+        self.cache = ProjectStateCache(capacity)
+
+    def load(self, project_id: str) -> Optional[Dict[str, Any]]:
+        version = self.inner.version(project_id)
+        if version is None:
+            self.cache.invalidate(project_id)
+            return self.inner.load(project_id)
+        state = self.cache.get(project_id, version)
+        if state is not None:
+            return state
+        # The token is taken before reading, so the cached data is never
+        # older than its token; a newer write just shows up as stale later.
+        state = self.inner.load(project_id)
+        self.cache.put(project_id, version, state)
+        return state
+
+    def save(self, project_id: str, state: Dict[str, Any]) -> None:
+        self.inner.save(project_id, state)
+        self.cache.put(project_id, self.inner.version(project_id), state)
+
+    def __getattr__(self, name: str):
+        return getattr(self.inner, name)
+
+
+# The store the pipe currently writes to; the A3 actions reach it through
+# get_project_store() when this module is loaded in the same process.
+_CURRENT_STORE: Dict[str, Any] = {"key": None, "store": None}
+
+
+def _open_store(
+    backend: str,
+    db_path: str = "",
+    fsync: str = "always",
+    fsync_interval: float = 5.0,
+    cache_size: int = 256,
+    journal_max_ops: int = 0,
+    journal_idle_sec: float = 0.0,
+):
+    backend = backend if backend in STATE_BACKENDS else "json"
+    path = Path(db_path) if db_path else STATE_DIR.parent / DEFAULT_DB_NAME
+    key = (
+        backend,
+        str(path) if backend == "sqlite" else "",
+        fsync,
+        fsync_interval,
+        cache_size,
+        journal_max_ops,
+        journal_idle_sec,
+        str(STATE_DIR),
+    )
+    if _CURRENT_STORE["key"] == key and _CURRENT_STORE["store"] is not None:
+        return _CURRENT_STORE["store"]
+    old = _CURRENT_STORE["store"]
+    if backend == "sqlite":
+        store = SqliteProjectStore(path, fsync=fsync)
+    else:
+        store = JsonProjectStore(
+            fsync=fsync,
+            fsync_interval=fsync_interval,
+            journal_max_ops=journal_max_ops,
+            journal_idle_sec=journal_idle_sec,
         )
+    store = CachedProjectStore(store, capacity=cache_size)
+    _CURRENT_STORE.update(key=key, store=store)
+    if old is not None:
+        old.close()
+    return store
+
+
+def get_project_store():
+    """Project store shared with the A3 actions (JSON files until the pipe opens one)."""
+    return _CURRENT_STORE["store"] or JsonProjectStore()
+
+# ====== per-project turn locks ======
 
+# Turns of the same project queue on one asyncio.Lock; entries disappear
+# together with the last turn holding or awaiting the lock.
+_PROJECT_LOCKS: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+class ProjectBusyError(Exception):
+    """The project stayed locked by another turn for the whole wait timeout."""
+
+
+def _project_lock(project_id: str) -> asyncio.Lock:
+    lock = _PROJECT_LOCKS.get(project_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _PROJECT_LOCKS[project_id] = lock
+    return lock
+
+
+@contextlib.asynccontextmanager
+async def _project_file_lock(project_id: str, deadline: float, poll_sec: float = 0.05):
+    """fcntl advisory lock shared by all uvicorn workers on this volume."""
+    if fcntl is None:
+        yield
+        return
+    LOCK_DIR.mkdir(parents=True, exist_ok=True)
+    name = _re.sub(r"[^\w.-]", "_", project_id) or "_"
+    fd = os.open(str(LOCK_DIR / f"{name}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise ProjectBusyError(project_id)
+                await asyncio.sleep(poll_sec)
         try:
-            data = await self._call_llm_json(
-                __request__, __user__,
-                [{"role": "system", "content": system}, {"role": "user", "content": user_prompt}],
-            )
-        except Exception as e:
-            return f"⚠️ Не удалось сгенерировать гипотезу: {e}"
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+# ====== per-turn unit of work ======
+
+
+class _StateUnitOfWork:
+    """Dirty project states and the active-project marker of one pipe() turn.
+
+    ``_save_state`` only records the state here; the turn writes each dirty
+    project once when it ends (or at an explicit checkpoint).
+    """
+
+    def __init__(self):
+        self.dirty: Dict[str, Dict[str, Any]] = {}
+        self.active_project: Optional[str] = None
+        self.closed = False
+
+
+_TURN_UOW: contextvars.ContextVar = contextvars.ContextVar("a3_turn_uow", default=None)
+
+# ====== off-loop storage I/O ======
+
+# Disk and database calls of the pipe run here instead of on the Open WebUI
+# event loop; a small dedicated pool keeps them from queuing behind other
+# users of the default executor.
+IO_WORKERS = 4
+
+_IO_EXECUTOR: Dict[str, Any] = {"pool": None}
+
+_IO_STATS: Dict[str, float] = {"calls": 0, "seconds": 0.0}
+
+# Event loop of the coroutine that handed the call to the pool, so storage
+# code running on an a3-io thread can still arm its debounce timers there.
+_IO_LOOP: contextvars.ContextVar = contextvars.ContextVar("a3_io_loop", default=None)
+
+
+def _io_pool() -> ThreadPoolExecutor:
+    if _IO_EXECUTOR["pool"] is None:
+        _IO_EXECUTOR["pool"] = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="a3-io")
+    return _IO_EXECUTOR["pool"]
+
+
+def _timed_io(fn, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _IO_STATS["calls"] += 1
+        _IO_STATS["seconds"] += time.perf_counter() - started
+
+
+async def _gather_bounded(factories, limit: int) -> List[Any]:
+    """Await coroutine factories concurrently, at most ``limit`` at a time, in order."""
+    sem = asyncio.Semaphore(max(1, int(limit or 1)))
+
+    async def one(factory):
+        async with sem:
+            return await factory()
+
+    return await asyncio.gather(*(one(f) for f in factories))
+
+
+async def _run_io(fn, *args, **kwargs):
+    """Run a blocking storage call on the I/O pool (with the caller's contextvars)."""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    ctx.run(_IO_LOOP.set, loop)
+    call = functools.partial(ctx.run, _timed_io, fn, *args, **kwargs)
+    return await loop.run_in_executor(_io_pool(), call)
+
+
+def _owner_loop() -> Optional[asyncio.AbstractEventLoop]:
+    """The running loop, or the one whose ``_run_io`` call this thread is serving."""
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return _IO_LOOP.get()
+
+
+def _on_loop(loop: asyncio.AbstractEventLoop, fn) -> None:
+    """Call ``fn`` on ``loop``'s thread: now if already there, else as soon as it can."""
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        fn()
+    else:
+        loop.call_soon_threadsafe(fn)
+
+
+class LoopLagMonitor:
+    """Measures event-loop blocking as how late a periodic sleep wakes up.
+
+    Any synchronous work on the loop (file I/O, JSON parsing, DB queries)
+    shows up directly as lag, so the numbers before and after moving a call
+    off the loop are comparable.
+    """
+
+    def __init__(self, interval: float = 0.1, stall_ms: float = 50.0, window: int = 1200):
+        self.interval = interval
+        self.stall_ms = stall_ms
+        self._lags: "deque[float]" = deque(maxlen=window)
+        self._task = None
+        self.samples = 0
+        self.stalls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def ensure_started(self) -> None:
+        if self.interval <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        task = self._task
+        if task is not None and not task.done() and task.get_loop() is loop:
+            return
+        self._task = loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self.interval > 0:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, (loop.time() - started - self.interval) * 1000.0))
+
+    def record(self, lag_ms: float) -> None:
+        self._lags.append(lag_ms)
+        self.samples += 1
+        self.total_ms += lag_ms
+        self.max_ms = max(self.max_ms, lag_ms)
+        if lag_ms >= self.stall_ms:
+            self.stalls += 1
+
+    def stats(self) -> Dict[str, Any]:
+        recent = sorted(self._lags)
+        p95 = recent[min(len(recent) - 1, int(len(recent) * 0.95))] if recent else 0.0
+        return {
+            "samples": self.samples,
+            "stalls": self.stalls,
+            "total_ms": round(self.total_ms, 1),
+            "max_ms": round(self.max_ms, 1),
+            "p95_ms": round(p95, 1),
+        }
+
+
+_LOOP_LAG = LoopLagMonitor()
+
+# Step definitions are static files: parsed once, re-read off the loop when
+# their mtime changes (see Pipe._refresh_steps).
+_STEP_CACHE: Dict[Path, Tuple[int, Dict[str, Any]]] = {}
+
+
+class UserCache:
+    """Open WebUI user objects by id for ``ttl_sec`` (LLM calls need one each).
+
+    ``get`` is a memory lookup safe on the event loop; only misses go to
+    the database, off the loop. Unknown ids are not cached.
+    """
+
+    def __init__(self, ttl_sec: float = 60.0, max_entries: int = 1000):
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self._items: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uid: str) -> Optional[Any]:
+        with self._lock:
+            item = self._items.get(uid)
+            if item is None or item[0] < time.monotonic():
+                self._items.pop(uid, None)
+                return None
+            self._items.move_to_end(uid)
+            return item[1]
+
+    def put(self, uid: str, user: Any) -> None:
+        if self.ttl_sec <= 0 or user is None:
+            return
+        with self._lock:
+            self._items[uid] = (time.monotonic() + self.ttl_sec, user)
+            self._items.move_to_end(uid)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def invalidate(self, uid: Optional[str] = None) -> None:
+        with self._lock:
+            if uid is None:
+                self._items.clear()
+            else:
+                self._items.pop(uid, None)
+
+    async def lookup(self, uid: str, loader) -> Optional[Any]:
+        user = self.get(uid) if self.ttl_sec > 0 else None
+        if user is not None:
+            self.hits += 1
+            return user
+        self.misses += 1
+        user = await _run_io(loader, uid)
+        self.put(uid, user)
+        return user
+
+
+_USER_CACHE = UserCache()
+
+# ====== LLM response cache ======
+
+# Part of every cache key: bump when prompts or the shape of parsed answers
+# change in a way the message text alone does not capture.
+LLM_PROMPT_VERSION = 1
+
+# True while a turn asks for fresh variants ("обнови варианты"): cached
+# answers are not served, but the new ones still replace them.
+_LLM_CACHE_BYPASS: contextvars.ContextVar = contextvars.ContextVar("a3_llm_cache_bypass", default=False)
+
+
+def _normalize_messages(messages: List[Dict[str, Any]]) -> List[List[str]]:
+    out = []
+    for m in messages or []:
+        content = m.get("content", "") if isinstance(m, dict) else m
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False, sort_keys=True)
+        out.append([str(m.get("role", "")) if isinstance(m, dict) else "", " ".join(content.split())])
+    return out
+
+
+def _llm_cache_key(models: List[str], messages: List[Dict[str, Any]]) -> str:
+    payload = json.dumps(
+        {"v": LLM_PROMPT_VERSION, "models": list(models), "messages": _normalize_messages(messages)},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LlmResponseCache:
+    """Parsed LLM JSON answers in LLM_CACHE_DIR, one ``<key>.json`` per entry.
+
+    Entries expire after ``ttl_sec``; file mtime doubles as the LRU clock
+    (refreshed on every hit), and every ``sweep_every`` writes the oldest
+    files beyond ``max_entries`` are removed. Being plain files on the data
+    volume, the cache survives restarts and is shared by all workers.
+    """
+
+    def __init__(self, ttl_sec: float = 7 * 86400, max_entries: int = 2000, sweep_every: int = 50):
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self.sweep_every = sweep_every
+        self._lock = threading.Lock()
+        self._writes_since_sweep = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.writes = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl_sec > 0
+
+    def path(self, key: str) -> Path:
+        return LLM_CACHE_DIR / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+        p = self.path(key)
+        try:
+            entry = json.loads(p.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        if not isinstance(entry, dict) or time.time() - float(entry.get("created_at") or 0) > self.ttl_sec:
+            with self._lock:
+                self.expired += 1
+            with contextlib.suppress(OSError):
+                p.unlink()
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(p)
+        with self._lock:
+            self.hits += 1
+        return entry
+
+    def put(self, key: str, model: str, data: Any) -> None:
+        if not self.enabled:
+            return
+        p = self.path(key)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        entry = {"created_at": time.time(), "model": model, "data": data}
+        _atomic_write_text(p, json.dumps(entry, ensure_ascii=False), fsync="never")
+        with self._lock:
+            self.writes += 1
+            self._writes_since_sweep += 1
+            if self._writes_since_sweep < self.sweep_every:
+                return
+            self._writes_since_sweep = 0
+        self.sweep()
+
+    def sweep(self) -> int:
+        """Drop expired entries and the least recently used ones over ``max_entries``."""
+        now = time.time()
+        files = []
+        for p in LLM_CACHE_DIR.glob("*/*.json"):
+            try:
+                files.append((p.stat().st_mtime, p))
+            except OSError:
+                continue
+        files.sort(reverse=True)
+        removed = 0
+        for i, (mtime, p) in enumerate(files):
+            if i >= self.max_entries or now - mtime > self.ttl_sec:
+                with contextlib.suppress(OSError):
+                    p.unlink()
+                    removed += 1
+        with self._lock:
+            self.evictions += removed
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses + self.expired
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+_LLM_CACHE = LlmResponseCache()
+
+# ====== speculative next-step prefetch ======
+
+
+def _fingerprint(*parts: Any) -> str:
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class PrefetchScheduler:
+    """Next-step LLM calls started in the background once their inputs are fixed.
+
+    Jobs are keyed by (project_id, kind) and carry a fingerprint of their
+    inputs; ``take`` hands a result only to a consumer with the same
+    fingerprint, waiting for a job still in flight rather than duplicating
+    it. A finished job that nobody took is handed to ``persist`` so the
+    result survives in the project state (meta.prefetch).
+    """
+
+    def __init__(self):
+        self._jobs: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.started = 0
+        self.used = 0
+        self.missed = 0
+        self.failed = 0
+
+    def schedule(self, project_id: str, kind: str, fingerprint: str, factory, persist=None) -> None:
+        key = (project_id, kind)
+        old = self._jobs.get(key)
+        if old is not None:
+            if old["fingerprint"] == fingerprint and not old["task"].done():
+                return
+            old["task"].cancel()
+        loop = asyncio.get_running_loop()
+        job: Dict[str, Any] = {"fingerprint": fingerprint, "consumed": False, "ready": loop.create_future()}
+
+        async def run():
+            # The task inherits the turn's contextvars; its writes must not
+            # land in that turn's unit of work.
+            _TURN_UOW.set(None)
+            _LLM_PRIORITY.set(LLM_PRIORITY_BACKGROUND)
+            _LLM_EMITTER.set(None)
+            try:
+                result = await factory()
+            except Exception as e:
+                self.failed += 1
+                if not job["ready"].done():
+                    job["ready"].set_exception(e)
+                    job["ready"].exception()  # retrieved: nobody may be waiting
+                return
+            if not job["ready"].done():
+                job["ready"].set_result(result)
+            if persist is not None:
+                with contextlib.suppress(Exception):
+                    await persist(result, lambda: job["consumed"])
+
+        job["task"] = loop.create_task(run())
+        job["task"].add_done_callback(lambda _t: self._forget(key, job))
+        self._jobs[key] = job
+        self.started += 1
+
+    def _forget(self, key: Tuple[str, str], job: Dict[str, Any]) -> None:
+        if self._jobs.get(key) is job:
+            del self._jobs[key]
+
+    async def take(self, project_id: str, kind: str, fingerprint: str) -> Optional[Any]:
+        job = self._jobs.get((project_id, kind))
+        if job is None or job["fingerprint"] != fingerprint:
+            return None
+        job["consumed"] = True
+        try:
+            result = await asyncio.shield(job["ready"])
+        except Exception:
+            return None
+        self.used += 1
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "started": self.started,
+            "used": self.used,
+            "missed": self.missed,
+            "failed": self.failed,
+            "running": sum(1 for j in self._jobs.values() if not j["task"].done()),
+        }
+
+
+_PREFETCH = PrefetchScheduler()
+
+
+class SingleFlight:
+    """Coalesces identical concurrent calls onto one shared task.
+
+    The first caller for a key starts the work; callers arriving while it is
+    in flight await the same task (shielded, so one caller giving up does
+    not cancel it for the others). Each caller gets its own copy of the
+    result, since callers normalise it in place. The key is dropped once
+    the task ends, so later calls start fresh.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Tuple[int, str], asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def run(self, key: str, factory):
+        loop = asyncio.get_running_loop()
+        slot = (id(loop), key)
+        task = self._tasks.get(slot)
+        if task is None or task.done():
+            task = loop.create_task(factory())
+            task.add_done_callback(lambda t: self._forget(slot, t))
+            self._tasks[slot] = task
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        return _copy_json(await asyncio.shield(task))
+
+    def _forget(self, slot: Tuple[int, str], task: asyncio.Task) -> None:
+        if self._tasks.get(slot) is task:
+            del self._tasks[slot]
+        if not task.cancelled():
+            task.exception()  # retrieved: every waiter may have gone
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "inflight": sum(1 for t in self._tasks.values() if not t.done()),
+        }
+
+
+_LLM_FLIGHTS = SingleFlight()
+
+
+# ====== LLM admission: global concurrency cap with fair queueing ======
+
+LLM_PRIORITY_INTERACTIVE = 0
+LLM_PRIORITY_REVIEW = 1
+LLM_PRIORITY_BACKGROUND = 2
+
+# Call sites that produce whole-project reports rather than answer a step turn.
+_REVIEW_SITES = {"_analyze_project_with_gpt52", "_generate_hypothesis"}
+
+_LLM_PRIORITY: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "a3_llm_priority", default=LLM_PRIORITY_INTERACTIVE
+)
+
+# The running turn's __event_emitter__, for queue-position status events.
+_LLM_EMITTER: contextvars.ContextVar = contextvars.ContextVar("a3_llm_emitter", default=None)
+
+
+class LlmAdmission:
+    """Process-wide cap on concurrent LLM calls with a fair wait queue.
+
+    Waiters are grouped by priority class (lower goes first) and served
+    round-robin per user inside a class, so one user's burst cannot starve
+    the others. ``limit`` 0 means unlimited.
+    """
+
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.active = 0
+        self.admitted = 0
+        self.queued = 0
+        self.max_wait = 0.0
+        self._queues: Dict[int, "OrderedDict[str, deque]"] = {}
+
+    def waiting(self) -> int:
+        return sum(len(w) for users in self._queues.values() for w in users.values())
+
+    def _order(self) -> List[asyncio.Future]:
+        out: List[asyncio.Future] = []
+        for priority in sorted(self._queues):
+            lanes = [list(w) for w in self._queues[priority].values()]
+            while any(lanes):
+                for lane in lanes:
+                    if lane:
+                        out.append(lane.pop(0))
+        return out
+
+    def position(self, fut: asyncio.Future) -> int:
+        """1-based place in the dispatch order, 0 once admitted."""
+        order = self._order()
+        return order.index(fut) + 1 if fut in order else 0
+
+    def _next(self) -> Optional[asyncio.Future]:
+        for priority in sorted(self._queues):
+            users = self._queues[priority]
+            if users:
+                user_id, waiters = next(iter(users.items()))
+                fut = waiters.popleft()
+                if waiters:
+                    users.move_to_end(user_id)
+                else:
+                    del users[user_id]
+                return fut
+        return None
+
+    def _dispatch(self) -> None:
+        while self.limit <= 0 or self.active < self.limit:
+            fut = self._next()
+            if fut is None:
+                return
+            self.active += 1
+            fut.set_result(None)
+
+    def _release(self) -> None:
+        self.active -= 1
+        self._dispatch()
+
+    def _withdraw(self, priority: int, user_id: str, fut: asyncio.Future) -> None:
+        users = self._queues.get(priority) or {}
+        waiters = users.get(user_id)
+        if waiters is not None and fut in waiters:
+            waiters.remove(fut)
+            if not waiters:
+                del users[user_id]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id: str, priority: int = LLM_PRIORITY_INTERACTIVE, on_wait=None):
+        """Hold one of ``limit`` slots; ``on_wait(position)`` reports the queue place."""
+        if self.limit > 0 and (self.active >= self.limit or self.waiting()):
+            fut = asyncio.get_running_loop().create_future()
+            self._queues.setdefault(priority, OrderedDict()).setdefault(user_id, deque()).append(fut)
+            self.queued += 1
+            started = time.monotonic()
+            try:
+                while not fut.done():
+                    if on_wait is not None:
+                        await on_wait(self.position(fut))
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(asyncio.shield(fut), timeout=2.0)
+            except BaseException:
+                if fut.done():
+                    self._release()  # admitted while being cancelled
+                else:
+                    self._withdraw(priority, user_id, fut)
+                    fut.cancel()
+                raise
+            self.max_wait = max(self.max_wait, time.monotonic() - started)
+            if on_wait is not None:
+                with contextlib.suppress(Exception):
+                    await on_wait(0)
+        else:
+            self.active += 1
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting(),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "max_wait": round(self.max_wait, 2),
+        }
+
+
+_LLM_GATE = LlmAdmission()
+
+
+# ====== background jobs for long LLM operations ======
+
+
+class JobRunner:
+    """In-process background jobs for long LLM operations.
+
+    A job runs as its own task, so cancelling the request that started it
+    (e.g. a proxy timeout) only stops the waiting. The latest job of each
+    kind is recorded in ``JOBS_DIR/<project>/<kind>.json`` (id, input
+    fingerprint, status, result); a later request with the same inputs
+    joins the running job or takes the stored result for ``ttl_sec``.
+    Records left "running" by a stopped process are ignored.
+    """
+
+    def __init__(self, ttl_sec: float = 3600.0):
+        self.ttl_sec = ttl_sec
+        self._running: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.started = 0
+        self.reused = 0
+        self.failed = 0
+
+    def _path(self, project_id: str, kind: str) -> Path:
+        return JOBS_DIR / str(project_id) / f"{kind}.json"
+
+    def _read(self, project_id: str, kind: str) -> Optional[Dict[str, Any]]:
+        try:
+            record = json.loads(self._path(project_id, kind).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        return record if isinstance(record, dict) else None
+
+    def _write(self, project_id: str, kind: str, record: Dict[str, Any]) -> None:
+        path = self._path(project_id, kind)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # A lost record only costs a repeated LLM call, like the LLM cache.
+        _atomic_write_text(path, json.dumps(record, ensure_ascii=False), fsync="never")
+
+    async def _save(self, project_id: str, kind: str, record: Dict[str, Any]) -> None:
+        with contextlib.suppress(Exception):
+            await _run_io(self._write, project_id, kind, dict(record))
+
+    async def lookup(
+        self, project_id: str, kind: str, fingerprint: str, fresh: bool = False
+    ) -> Optional[Dict[str, Any]]:
+        """The running job or a stored result for these inputs, if any."""
+        job = self._running.get((project_id, kind))
+        if job is not None and job["fingerprint"] == fingerprint:
+            return job
+        if fresh or self.ttl_sec <= 0:
+            return None
+        record = await _run_io(self._read, project_id, kind)
+        if (
+            record is None
+            or record.get("status") != "done"
+            or record.get("fingerprint") != fingerprint
+            or time.time() - float(record.get("finished_at") or 0) > self.ttl_sec
+        ):
+            return None
+        self.reused += 1
+        return {"id": record.get("id"), "fingerprint": fingerprint, "record": record}
+
+    def start(self, project_id: str, kind: str, fingerprint: str, factory) -> Dict[str, Any]:
+        key = (project_id, kind)
+        running = self._running.get(key)
+        if running is not None and running["fingerprint"] == fingerprint:
+            return running  # started by a concurrent request while we read the record
+        record: Dict[str, Any] = {
+            "id": f"{kind}-{os.urandom(4).hex()}",
+            "project_id": project_id,
+            "kind": kind,
+            "fingerprint": fingerprint,
+            "status": "running",
+            "created_at": time.time(),
+        }
+        job: Dict[str, Any] = {
+            "id": record["id"],
+            "fingerprint": fingerprint,
+            "record": record,
+            "started": time.monotonic(),
+        }
+
+        async def save() -> None:
+            # A job superseded by one with newer inputs must not overwrite its record.
+            if self._running.get(key) is job:
+                await self._save(project_id, kind, record)
+
+        async def run():
+            # Outlives the turn that started it: never joins its unit of work.
+            _TURN_UOW.set(None)
+            await save()
+            try:
+                result = await factory()
+            except Exception as e:
+                self.failed += 1
+                record.update(status="failed", error=str(e), finished_at=time.time())
+                await save()
+                raise
+            record.update(status="done", result=result, finished_at=time.time())
+            await save()
+            return result
+
+        def forget(task: asyncio.Task) -> None:
+            if self._running.get(key) is job:
+                del self._running[key]
+            if not task.cancelled():
+                task.exception()  # retrieved: the requester may be gone
+
+        job["task"] = asyncio.get_running_loop().create_task(run())
+        job["task"].add_done_callback(forget)
+        self._running[key] = job
+        self.started += 1
+        return job
+
+    async def wait(self, job: Dict[str, Any], on_progress=None, every: float = 5.0) -> Any:
+        """Result of ``job``; ``on_progress(job, elapsed)`` is called while it runs."""
+        task = job.get("task")
+        if task is None:
+            return job["record"].get("result")
+        while True:
+            if on_progress is not None:
+                await on_progress(job, time.monotonic() - job["started"])
+            done, _ = await asyncio.wait({task}, timeout=every)
+            if done:
+                return task.result()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "started": self.started,
+            "running": sum(1 for j in self._running.values() if not j["task"].done()),
+            "reused": self.reused,
+            "failed": self.failed,
+        }
+
+
+_JOBS = JobRunner()
+
+
+# ====== prompt assembly ======
+
+
+def _estimate_tokens(text: str) -> int:
+    """Rough token count: about 4 bytes of UTF-8 per token (2 Cyrillic letters)."""
+    return (len((text or "").encode("utf-8")) + 3) // 4
+
+
+def _prune_empty(value: Any) -> Any:
+    if isinstance(value, dict):
+        pruned = {k: _prune_empty(v) for k, v in value.items()}
+        return {k: v for k, v in pruned.items() if v not in ("", None, [], {})}
+    if isinstance(value, list):
+        return [v for v in (_prune_empty(x) for x in value) if v not in ("", None, [], {})]
+    return value.strip() if isinstance(value, str) else value
+
+
+def _compact_json(value: Any) -> str:
+    """Project data for a prompt: one line, no ASCII escapes, empty fields dropped."""
+    return json.dumps(_prune_empty(value), ensure_ascii=False, separators=(", ", ": "))
+
+
+_PROMPT_STATS: Dict[str, Any] = {"builds": 0, "truncated": 0, "last": {}}
+
+
+class PromptBuilder:
+    """Prompt text assembled from named sections within a token budget.
+
+    A section is a fixed ``head`` plus cuttable ``items`` (a line or a list
+    of lines each). Over budget, sections are cut from the highest
+    ``priority`` down, oldest items first (``keep="head"`` drops the newest
+    instead), leaving an "omitted" marker; priority 0 is never cut.
+    ``report`` holds the estimated tokens per section before and after.
+    """
+
+    def __init__(self, budget: int = 0):
+        self.budget = budget
+        self.report: Dict[str, Dict[str, int]] = {}
+        self._sections: List[Dict[str, Any]] = []
+
+    def add(self, name: str, head=(), items=(), priority: int = 0, keep: str = "tail") -> None:
+        self._sections.append(
+            {
+                "name": name,
+                "head": list(head),
+                "items": [list(i) if isinstance(i, (list, tuple)) else [str(i)] for i in items],
+                "priority": priority,
+                "keep": keep,
+                "dropped": 0,
+            }
+        )
+
+    @staticmethod
+    def _section_lines(section: Dict[str, Any]) -> List[str]:
+        body = [ln for item in section["items"] for ln in item]
+        if section["dropped"]:
+            marker = f"- … ещё {section['dropped']} (сокращено)"
+            body = [marker] + body if section["keep"] == "tail" else body + [marker]
+        return section["head"] + body
+
+    def _tokens(self, section: Dict[str, Any]) -> int:
+        return _estimate_tokens("\n".join(self._section_lines(section)))
+
+    def lines(self) -> List[str]:
+        before = {s["name"]: self._tokens(s) for s in self._sections}
+        total = sum(before.values())
+        if self.budget > 0 and total > self.budget:
+            for section in sorted(self._sections, key=lambda x: -x["priority"]):
+                if section["priority"] <= 0:
+                    break
+                while total > self.budget and section["items"]:
+                    was = self._tokens(section)
+                    section["items"].pop(0 if section["keep"] == "tail" else -1)
+                    section["dropped"] += 1
+                    total += self._tokens(section) - was
+        self.report = {
+            s["name"]: {"before": before[s["name"]], "after": self._tokens(s)} for s in self._sections
+        }
+        return [ln for s in self._sections for ln in self._section_lines(s)]
+
+# ====== streamed completions ======
+
+
+def _sse_delta(payload: str) -> str:
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return ""
+    choices = data.get("choices") if isinstance(data, dict) else None
+    if not isinstance(choices, list) or not choices or not isinstance(choices[0], dict):
+        return ""
+    delta = choices[0].get("delta") or choices[0].get("message") or {}
+    content = delta.get("content") if isinstance(delta, dict) else None
+    return content if isinstance(content, str) else ""
+
+
+async def _iter_completion_text(result, idle_timeout: Optional[float] = None):
+    """Text pieces of a generate_chat_completions result, streamed or not.
+
+    Handles the StreamingResponse Open WebUI returns for ``stream: True``
+    (OpenAI-style SSE ``data:`` lines), a bare async iterator of such
+    chunks, and a plain completion dict (yielded as one piece).
+    """
+    if isinstance(result, dict):
+        content = _sse_delta(json.dumps(result))
+        if content:
+            yield content
+        return
+    chunks = getattr(result, "body_iterator", result)
+    if not hasattr(chunks, "__anext__"):
+        chunks = chunks.__aiter__()
+    buf = ""
+    while True:
+        try:
+            chunk = await asyncio.wait_for(chunks.__anext__(), timeout=idle_timeout)
+        except StopAsyncIteration:
+            break
+        buf += chunk.decode("utf-8", "ignore") if isinstance(chunk, (bytes, bytearray)) else str(chunk)
+        *lines, buf = buf.split("\n")
+        for line in lines:
+            line = line.strip()
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                return
+            piece = _sse_delta(payload)
+            if piece:
+                yield piece
+    tail = buf.strip()
+    if tail.startswith("data:") and tail[5:].strip() != "[DONE]":
+        piece = _sse_delta(tail[5:].strip())
+        if piece:
+            yield piece
+
+
+class IncrementalJsonObject:
+    """Feeds a streamed JSON object and reports top-level members as they close.
+
+    Only the outer object is tracked: a member becomes available once the
+    tokenizer is back at depth 1 after its value (``,`` or the final ``}``),
+    then that slice is parsed with ``json.loads``. Text before the first
+    ``{`` (markdown fences, chatter) is ignored.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.values: Dict[str, Any] = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_str = False
+        self._escape = False
+        self._key: Optional[str] = None
+        self._key_start = -1
+        self._value_start = -1
+        self.closed = False
+
+    def feed(self, chunk: str) -> List[str]:
+        """Add text; returns the keys completed by this chunk."""
+        self.text += chunk
+        done: List[str] = []
+        text = self.text
+        while self._pos < len(text) and not self.closed:
+            ch = text[self._pos]
+            i = self._pos
+            self._pos += 1
+            if self._in_str:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_str = False
+                    if self._depth == 1 and self._key is None and self._key_start >= 0:
+                        with contextlib.suppress(ValueError):
+                            self._key = json.loads(text[self._key_start: i + 1])
+                continue
+            if ch == '"':
+                self._in_str = True
+                if self._depth == 1 and self._key is None:
+                    self._key_start = i
+                continue
+            if ch in "{[":
+                self._depth += 1
+                continue
+            if self._depth == 1 and ch == ":" and self._key is not None and self._value_start < 0:
+                self._value_start = i + 1
+                continue
+            if ch in "}]":
+                self._depth -= 1
+            if (ch == "," and self._depth == 1) or (ch == "}" and self._depth == 0):
+                if self._key is not None and self._value_start >= 0:
+                    try:
+                        self.values[self._key] = json.loads(text[self._value_start: i])
+                        done.append(self._key)
+                    except ValueError:
+                        pass
+                self._key, self._key_start, self._value_start = None, -1, -1
+                if self._depth == 0:
+                    self.closed = True
+        return done
+
+
+_JSON_STATS: Dict[str, int] = {"parsed": 0, "repaired": 0, "reasked": 0, "failed": 0}
+
+_LOCAL_EXTRACT_STATS: Dict[str, Dict[str, int]] = {
+    "step2": {"local": 0, "llm": 0},
+    "step3": {"local": 0, "llm": 0},
+}
+
+_OPEN_QUOTES = {'"': '"', "'": "'", "\u201c": "\u201d\u201c", "\u201e": "\u201c\u201d", "\u201d": "\u201d"}
+
+_BARE_WORDS = {"True": "true", "False": "false", "None": "null"}
+
+
+def _repair_json(text: str) -> Any:
+    """Best-effort local fix of a malformed LLM JSON answer, or None.
+
+    Drops prose around the payload, turns single/smart quotes into double
+    quotes, escapes raw newlines and stray inner quotes in strings, removes
+    trailing commas and closes whatever a truncated answer left open
+    (cutting back to the last complete member if needed).
+    """
+    s = str(text or "")
+    start = min((i for i in (s.find("{"), s.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        return None
+    out: List[str] = []
+    stack: List[str] = []
+    checkpoints: List[Tuple[int, int]] = []
+    close_on = ""
+    i, n = start, len(s)
+    while i < n:
+        ch = s[i]
+        if close_on:
+            if ch == "\\" and i + 1 < n:
+                out.append(s[i:i + 2])
+                i += 2
+                continue
+            if ch in close_on:
+                rest = s[i + 1:].lstrip()
+                if not rest or rest[0] in ",:}]":
+                    out.append('"')
+                    close_on = ""
+                    i += 1
+                    continue
+            if ch == '"':
+                out.append('\\"')
+            elif ch == "\n":
+                out.append("\\n")
+            elif ch == "\r":
+                out.append("\\r")
+            elif ch == "\t":
+                out.append("\\t")
+            else:
+                out.append(ch)
+            i += 1
+            continue
+        if ch in _OPEN_QUOTES:
+            close_on = _OPEN_QUOTES[ch]
+            out.append('"')
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            out.append(ch)
+        elif ch in "}]":
+            while out and (out[-1].isspace() or out[-1] == ","):
+                out.pop()
+            if stack:
+                out.append(stack.pop())
+            if not stack:
+                break
+        elif ch == ",":
+            checkpoints.append((len(out), len(stack)))
+            out.append(ch)
+        elif ch.isalpha():
+            j = i
+            while j < n and s[j].isalnum():
+                j += 1
+            word = s[i:j]
+            out.append(_BARE_WORDS.get(word, word))
+            i = j
+            continue
+        else:
+            out.append(ch)
+        i += 1
+
+    if close_on:
+        out.append('"')
+    candidates = ["".join(out)]
+    for pos, _depth in reversed(checkpoints[-3:]):
+        candidates.append("".join(out[:pos]))
+    for body in candidates:
+        body = body.rstrip().rstrip(",").rstrip()
+        if body.endswith(":"):
+            body += " null"
+        depth: List[str] = []
+        in_str = esc = False
+        for ch in body:
+            if in_str:
+                if esc:
+                    esc = False
+                elif ch == "\\":
+                    esc = True
+                elif ch == '"':
+                    in_str = False
+            elif ch == '"':
+                in_str = True
+            elif ch in "{[":
+                depth.append("}" if ch == "{" else "]")
+            elif ch in "}]" and depth:
+                depth.pop()
+        try:
+            return json.loads(body + "".join(reversed(depth)))
+        except ValueError:
+            continue
+    return None
+
+
+# ====== model health: circuit breaker and latency ======
+
+
+class ModelHealth:
+    """Per-model circuit breaker and recent latencies for LLM calls.
+
+    After ``failures`` consecutive errors or timeouts a model is skipped for
+    ``cooldown_sec``; the first call after the cooldown is a probe that
+    either closes the breaker or re-opens it. Successful latencies feed the
+    p95 used as the hedging delay.
+    """
+
+    def __init__(self, failures: int = 3, cooldown_sec: float = 60.0, window: int = 200):
+        self.failures = failures
+        self.cooldown_sec = cooldown_sec
+        self.window = window
+        self._state: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, model: str) -> Dict[str, Any]:
+        st = self._state.get(model)
+        if st is None:
+            st = self._state[model] = {
+                "consecutive": 0,
+                "open_until": 0.0,
+                "ok": 0,
+                "errors": 0,
+                "skipped": 0,
+                "latencies": deque(maxlen=self.window),
+            }
+        return st
+
+    def available(self, model: str) -> bool:
+        with self._lock:
+            return time.monotonic() >= self._get(model)["open_until"]
+
+    def order(self, models: List[str]) -> List[str]:
+        """Models with a closed breaker; all of them if every breaker is open."""
+        live = [m for m in models if self.available(m)]
+        with self._lock:
+            for m in models:
+                if m not in live:
+                    self._get(m)["skipped"] += 1
+        return live or list(models)
+
+    def record_success(self, model: str, latency: float) -> None:
+        with self._lock:
+            st = self._get(model)
+            st["consecutive"] = 0
+            st["open_until"] = 0.0
+            st["ok"] += 1
+            st["latencies"].append(latency)
+
+    def record_failure(self, model: str) -> None:
+        with self._lock:
+            st = self._get(model)
+            st["consecutive"] += 1
+            st["errors"] += 1
+            if self.failures > 0 and st["consecutive"] >= self.failures:
+                st["open_until"] = time.monotonic() + self.cooldown_sec
+
+    def p95(self, model: str) -> Optional[float]:
+        with self._lock:
+            lat = sorted(self._get(model)["latencies"])
+        if len(lat) < 5:
+            return None
+        return lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        out = {}
+        with self._lock:
+            items = list(self._state.items())
+        for model, st in items:
+            out[model] = {
+                "ok": st["ok"],
+                "errors": st["errors"],
+                "skipped": st["skipped"],
+                "open": now < st["open_until"],
+                "p95": self.p95(model),
+            }
+        return out
+
+
+_MODEL_HEALTH = ModelHealth()
+
+
+# ====== LLM telemetry ======
+
+_LLM_CALL_SITE: contextvars.ContextVar[str] = contextvars.ContextVar("a3_llm_call_site", default="")
+
+
+def _percentile(ordered: List[float], q: float) -> Optional[float]:
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class LlmTelemetry:
+    """Rolling per-(call site, model) stats of LLM attempts.
+
+    Each attempt records its number within the call (2+ means fallback or
+    hedge), outcome (ok / timeout / error / cancelled), wall time and the
+    ``usage`` token counts when the backend reports them. JSON call sites
+    also record whether the answer parsed, needed a repair or failed.
+    """
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._rows: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._parse: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(
+        self, site: str, model: str, attempt: int, outcome: str, seconds: float, usage: Optional[dict] = None
+    ) -> None:
+        with self._lock:
+            row = self._rows.get((site, model))
+            if row is None:
+                row = self._rows[(site, model)] = {
+                    "calls": 0,
+                    "fallback": 0,
+                    "outcomes": {},
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "latencies": deque(maxlen=self.window),
+                }
+            row["calls"] += 1
+            if attempt > 1:
+                row["fallback"] += 1
+            row["outcomes"][outcome] = row["outcomes"].get(outcome, 0) + 1
+            if outcome == "ok":
+                row["latencies"].append(seconds)
+            if isinstance(usage, dict):
+                for k in ("prompt_tokens", "completion_tokens"):
+                    if isinstance(usage.get(k), int):
+                        row[k] += usage[k]
+
+    def record_parse(self, site: str, outcome: str) -> None:
+        with self._lock:
+            counts = self._parse.setdefault(site, {"parsed": 0, "repaired": 0, "failed": 0})
+            counts[outcome] = counts.get(outcome, 0) + 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            rows = [(k, dict(v, latencies=sorted(v["latencies"]))) for k, v in self._rows.items()]
+            parse = {k: dict(v) for k, v in self._parse.items()}
+        calls = []
+        for (site, model), row in sorted(rows):
+            lat = row.pop("latencies")
+            row.update(
+                site=site,
+                model=model,
+                p50=_percentile(lat, 0.5),
+                p95=_percentile(lat, 0.95),
+                p99=_percentile(lat, 0.99),
+            )
+            calls.append(row)
+        return {"generated_at": int(time.time()), "calls": calls, "json": parse}
+
+    def dump(self, path: Path) -> Dict[str, Any]:
+        snap = self.snapshot()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _atomic_write_text(path, json.dumps(snap, ensure_ascii=False, indent=2), fsync="never")
+        return snap
+
+
+_LLM_TELEMETRY = LlmTelemetry()
+
+# ====== active project registry ======
+
+
+class ActiveProjectRegistry:
+    """Active project per user and the global marker, kept in memory.
+
+    ``ACTIVE_DIR/<user>.json`` stays the durable record and is written only
+    on a switch; lookups are served from memory and revalidated by the
+    file's mtime, so a switch made by another worker is still seen. The
+    global marker (read by start_with_sync.sh at boot) is written to
+    GLOBAL_ACTIVE_PATH only when it changes, ``flush_delay`` seconds later.
+    """
+
+    def __init__(self, flush_delay: float = 2.0, fsync: str = "batched", fsync_interval: float = 5.0):
+        self.flush_delay = flush_delay
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._users: Dict[str, Tuple[int, str]] = {}
+        self._global: Optional[str] = None
+        self._flushed: Optional[str] = None
+        self._handle = None
+        self.flushes = 0
+        self.skipped = 0
+
+    def get(self, user_id: str) -> Optional[str]:
+        path = ACTIVE_DIR / f"{user_id}.json"
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            cached = self._users.get(user_id)
+        if cached is not None and cached[0] == mtime:
+            return cached[1] or None
+        try:
+            data = json.loads(path.read_text(encoding="utf-8-sig"))
+            pid = str(data.get("project_id") or "").strip()
+        except Exception:
+            return None
+        with self._lock:
+            self._users[user_id] = (mtime, pid)
+        return pid or None
+
+    def remember(self, user_id: str, project_id: str) -> None:
+        """Record a switch the caller has just written to ACTIVE_DIR."""
+        try:
+            mtime = os.stat(ACTIVE_DIR / f"{user_id}.json").st_mtime_ns
+        except OSError:
+            return
+        with self._lock:
+            self._users[user_id] = (mtime, project_id)
+
+    def current(self) -> Optional[str]:
+        return self._global
+
+    def touch(self, project_id: str) -> None:
+        with self._lock:
+            self._global = project_id
+            if project_id == self._flushed:
+                self.skipped += 1
+                return
+            if self._handle is not None:
+                return  # the pending flush picks up the newest value
+        loop = _owner_loop()
+        if loop is None:
+            self.flush()
+            return
+
+        def arm() -> None:
+            # The write (and its fsync) runs on the I/O pool, not on the loop.
+            with self._lock:
+                if self._handle is None and self._global != self._flushed:
+                    self._handle = loop.call_later(
+                        max(0.0, self.flush_delay), loop.run_in_executor, _io_pool(), self._flush_quietly
+                    )
+
+        _on_loop(loop, arm)
+
+    def flush(self) -> bool:
+        with self._lock:
+            if self._handle is not None:
+                self._handle.cancel()
+                self._handle = None
+            pid = self._global
+            if not pid or pid == self._flushed:
+                return False
+            _atomic_write_text(
+                GLOBAL_ACTIVE_PATH,
+                json.dumps({"project_id": pid}, ensure_ascii=False),
+                fsync=self.fsync,
+                fsync_interval=self.fsync_interval,
+            )
+            self._flushed = pid
+            self.flushes += 1
+            return True
+
+    def _flush_quietly(self) -> None:
+        try:
+            self.flush()
+        except Exception:
+            pass
+
+
+_ACTIVE_REGISTRY = ActiveProjectRegistry()
+
+
+def get_active_registry() -> ActiveProjectRegistry:
+    """Registry shared with the A3 actions loaded in the same process."""
+    return _ACTIVE_REGISTRY
+
+
+@atexit.register
+def _flush_active_registry() -> None:
+    _ACTIVE_REGISTRY._flush_quietly()
+
+# ====== DoD rules ======
+
+SOLUTION_WORDS = [
+
+    "автоматиз",
+
+    "оптимиз",
+
+    "внедр",
+
+    "улучш",
+
+    "реализ",
+
+    "разработ",
+
+    "настро",
+
+    "создать",
+
+    "ввести",
+
+    "перейти",
+
+    "сделать",
+
+    "надо",
+
+    "нужно",
+
+]
+
+WEAK_PHRASES = [
+
+    "неизвестно",
+
+    "пока неизвестно",
+
+    "нет данных",
+
+    "данных нет",
+
+    "сложно сказать",
+
+    "в целом",
+
+    "примерно",
+
+    "приблизительно",
+
+    "не знаю",
+
+    "пока нет",
+
+    "нет информации",
+
+    "не определено",
+
+    "не могу сказать",
+
+]
+
+class Pipe:
+
+    class Valves(BaseModel):
+
+        DEFAULT_PROJECT_ID: str = Field(default="A3-0001")
+
+        METHODOLOGIST_MODEL: str = Field(default="gpt-5.2")
+
+        STATE_FSYNC: str = Field(default="batched")  # always | batched | never
+
+        STATE_FSYNC_INTERVAL_SEC: float = Field(default=5.0)
+
+        PROJECT_LOCK_TIMEOUT_SEC: float = Field(default=300.0)
+
+        PROJECT_FILE_LOCK: bool = Field(default=False)  # for multi-worker uvicorn
+
+        STATE_BACKEND: str = Field(default="json")  # json | sqlite
+
+        STATE_DB_PATH: str = Field(default="")  # sqlite file, default a3_state/projects.sqlite3
+
+        STATE_CACHE_SIZE: int = Field(default=256)  # parsed projects kept in memory, 0 = off
+
+        STATE_JOURNAL_MAX_OPS: int = Field(default=50)  # json backend: journal entries per snapshot, 0 = off
+
+        STATE_JOURNAL_IDLE_SEC: float = Field(default=120.0)  # compact after this long without writes
+
+        ACTIVE_FLUSH_DELAY_SEC: float = Field(default=2.0)  # debounce for global_active.json, 0 = write at once
+
+        LOOP_LAG_SAMPLE_SEC: float = Field(default=0.1)  # event-loop lag probe for /a3stats, 0 = off
+
+        USER_CACHE_TTL_SEC: float = Field(default=60.0)  # Open WebUI user objects reused for LLM calls, 0 = query every time
+
+        LLM_CACHE_TTL_SEC: float = Field(default=604800.0)  # cached JSON answers live 7 days, 0 = off
+
+        LLM_CACHE_MAX_ENTRIES: int = Field(default=2000)  # files kept in a3_state/llm_cache, 0 = off
+
+        STEP6_PREFETCH_CONCURRENCY: int = Field(default=3)  # parallel "why" suggestions at problem selection
+
+        PREFETCH_NEXT_STEP: bool = Field(default=True)  # start step 4 metric proposals before they are asked for
+
+        LLM_TIMEOUT_SEC: float = Field(default=120.0)  # per model attempt, 0 = no deadline
+
+        LLM_MODEL_TIMEOUTS: str = Field(default="")  # per-model overrides: "gpt-5.2=90, gpt-4o=45"
+
+        LLM_ROUTES: str = Field(default="_analyze_project_with_gpt52=gpt-5.2@300")  # "site=model|fallback@sec; _get_step2*=gpt-4o-mini@30"; unrouted sites use METHODOLOGIST_MODEL
+
+        LLM_BREAKER_FAILURES: int = Field(default=3)  # consecutive failures that open a model's breaker, 0 = off
+
+        LLM_BREAKER_COOLDOWN_SEC: float = Field(default=60.0)
+
+        LLM_HEDGE: bool = Field(default=False)  # fire the next model after the p95 delay, first answer wins
+
+        LLM_HEDGE_MIN_DELAY_SEC: float = Field(default=3.0)  # floor for the hedge delay (and its value until p95 is known)
+
+        LOCAL_EXTRACT_MIN_SCORE: float = Field(default=0.8)  # template answers whose local parse scores at least this skip the LLM extraction call, 0 = off
+
+        JOB_RESULT_TTL_SEC: int = Field(default=3600)  # reuse a finished analysis/hypothesis/step 6 job with the same inputs, 0 = always rerun
+
+        PROMPT_TOKEN_BUDGET: int = Field(default=6000)  # estimated tokens of project data in the review prompt, 0 = no limit
+
+        LLM_MAX_CONCURRENCY: int = Field(default=8)  # LLM calls in flight per process; step turns go before reviews and prefetch, 0 = no limit
+
+        LLM_SINGLE_FLIGHT: bool = Field(default=True)  # identical concurrent JSON requests share one completion
+
+        STREAM_ANALYSIS: bool = Field(default=True)  # stream "анализ проекта" into the chat while it is generated
+
+        STREAM_EMIT_INTERVAL_SEC: float = Field(default=0.25)  # min gap between streamed message updates
+
+        STREAM_HYPOTHESIS: bool = Field(default=True)  # render /гипотеза section by section while it is generated
+
+        PROJECTS_PAGE_SIZE: int = Field(default=20)  # rows per /projects page
+
+    _EDIT_FIELDS: dict = {
+        "проблема": ("data", "steps", "raw_problem", "raw_problem_sentence"),
+        "где/когда": ("data", "steps", "problem_spec", "where_when"),
+        "масштаб": ("data", "steps", "problem_spec", "scale"),
+        "последствия": ("data", "steps", "problem_spec", "consequences"),
+        "кто страдает": ("data", "steps", "problem_spec", "who_suffers"),
+        "деньги": ("data", "steps", "problem_spec", "money_impact"),
+        "событие начала": ("data", "steps", "process_context", "start_event"),
+        "событие окончания": ("data", "steps", "process_context", "end_event"),
+        "владелец процесса": ("data", "steps", "process_context", "owner"),
+        "периметр": ("data", "steps", "process_context", "perimeter"),
+        "название процесса": ("data", "steps", "process_definition", "process_name"),
+        "название проекта": ("data", "steps", "process_definition", "project_title"),
+    }
+
+    def __init__(self):
+
+        self.valves = self.Valves()
+
+    def pipes(self):
+        return [{"id": "a3", "name": "A3 Project Controller"}]
+
+    def _get_edit_field(self, state: dict, path: tuple) -> str:
+        obj = state
+        for key in path[:-1]:
+            if not isinstance(obj, dict):
+                return ""
+            obj = obj.get(key) or {}
+        if not isinstance(obj, dict):
+            return ""
+        return str(obj.get(path[-1], "") or "").strip()
+
+    def _set_edit_field(self, state: dict, path: tuple, value: str) -> None:
+        obj = state
+        for key in path[:-1]:
+            if not isinstance(obj.get(key), dict):
+                obj[key] = {}
+            obj = obj[key]
+        obj[path[-1]] = value
+
+    def _build_edit_view(self, state: dict, project_id: str) -> str:
+        lines = [
+            f"✏️ Режим редактирования проекта `{project_id}`\n",
+            "Отредактируй нужные поля в блоке ниже, скопируй и отправь обратно.",
+            "Чтобы выйти без изменений — напиши `готово`.\n",
+            "```",
+        ]
+        for label, path in self._EDIT_FIELDS.items():
+            value = self._get_edit_field(state, path)
+            lines.append(f"{label.capitalize()}: {value}")
+        lines.append("```")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _fmt_hint(h: str) -> str:
+        """Format a hint: bold the label before first colon, add arrow."""
+        h = h.strip().strip('"').strip("'")
+        if ":" in h:
+            label, _, rest = h.partition(":")
+            label = label.strip()
+            rest = rest.strip()
+            if label and len(label) < 60:
+                return f"> **{label}** → {rest}"
+        return f"> {h}"
+
+    async def _generate_hypothesis(
+        self, state: dict, project_id: str, __request__, __user__: dict, __event_emitter__=None
+    ) -> str:
+        steps = state.get("data", {}).get("steps", {})
+
+        raw_problem = steps.get("raw_problem", {}).get("raw_problem_sentence", "")
+        if not raw_problem:
+            return "⚠️ Сначала опиши проблему на шаге 1 — тогда смогу сгенерировать гипотезу."
+
+        spec = steps.get("problem_spec", {})
+        spec_text = (
+            f"Где/когда: {spec.get('where_when','—')}, "
+            f"Масштаб: {spec.get('scale','—')}, "
+            f"Последствия: {spec.get('consequences','—')}, "
+            f"Кто страдает: {spec.get('who_suffers','—')}, "
+            f"Деньги: {spec.get('money_impact','—')}"
+        ) if spec else "нет данных"
+
+        ctx = steps.get("process_context", {})
+        process_text = (
+            f"Начало: {ctx.get('start_event','—')}, "
+            f"Окончание: {ctx.get('end_event','—')}, "
+            f"Владелец: {ctx.get('owner','—')}, "
+            f"Периметр: {ctx.get('perimeter','—')}, "
+            f"Метрики: {', '.join(ctx.get('result_metrics') or ['—'])}"
+        ) if ctx else "нет данных"
+
+        system = (
+            "Ты методолог A3/Lean. Генерируй полный черновик A3 по предоставленным данным. "
+            "Верни СТРОГО JSON без пояснений."
+        )
+        user_prompt = (
+            "Сгенерируй полный черновик A3 по данным ниже.\n\n"
+            f"Проблема (шаг 1): {raw_problem}\n"
+            f"Уточнение (шаг 2): {spec_text}\n"
+            f"Процесс (шаг 3): {process_text}\n\n"
+            "Верни строго JSON:\n"
+            '{\n'
+            '  "problem": "...",\n'
+            '  "spec": {"where_when":"...","scale":"...","consequences":"...","who_suffers":"...","money_impact":"..."},\n'
+            '  "baseline": [{"metric":"...","current_value":"..."}],\n'
+            '  "target": [{"metric":"...","target_value":"..."}],\n'
+            '  "root_causes": ["...","...","..."],\n'
+            '  "actions": [{"action":"...","owner":"...","due":"..."}],\n'
+            '  "monitoring": "..."\n'
+            '}'
+        )
+
+        messages = [{"role": "system", "content": system}, {"role": "user", "content": user_prompt}]
+
+        async def draft() -> dict:
+            data = None
+            if __event_emitter__ and self.valves.STREAM_HYPOTHESIS:
+                data = await self._stream_hypothesis(__request__, __user__, messages, __event_emitter__)
+            if data is None:
+                data = await self._call_llm_json(__request__, __user__, messages, site="_generate_hypothesis")
+            return data
+
+        try:
+            data = await self._run_job(
+                project_id, "hypothesis", _fingerprint(messages), draft, __event_emitter__, "Гипотеза"
+            )
+        except Exception as e:
+            return f"⚠️ Не удалось сгенерировать гипотезу: {e}"
+
+        return self._format_hypothesis(data)
+
+    _HYPOTHESIS_SECTIONS = ("problem", "spec", "baseline", "target", "root_causes", "actions", "monitoring")
+
+    def _hypothesis_section_lines(self, key: str, data: dict) -> List[str]:
+        if key == "problem":
+            return ["", f"**1. Проблема**", data.get("problem", "—")]
+        if key == "spec":
+            lines = ["", "**2. Уточнение проблемы**"]
+            s = data.get("spec") or {}
+            for label, k in [("Где/когда", "where_when"), ("Масштаб", "scale"),
+                             ("Последствия", "consequences"), ("Кто страдает", "who_suffers"),
+                             ("Деньги", "money_impact")]:
+                lines.append(f"- {label}: {s.get(k, '—')}")
+            return lines
+        if key == "baseline":
+            lines = ["", "**3. Текущее состояние**"]
+            for item in (data.get("baseline") or []):
+                lines.append(f"- {item.get('metric','—')}: {item.get('current_value','—')}")
+            return lines
+        if key == "target":
+            lines = ["", "**4. Целевое состояние**"]
+            for item in (data.get("target") or []):
+                lines.append(f"- {item.get('metric','—')}: {item.get('target_value','—')}")
+            return lines
+        if key == "root_causes":
+            return ["", "**5. Коренные причины**"] + [f"- {rc}" for rc in (data.get("root_causes") or [])]
+        if key == "actions":
+            lines = ["", "**6. Мероприятия**"]
+            for act in (data.get("actions") or []):
+                lines.append(f"- {act.get('action','—')} ({act.get('owner','—')}, {act.get('due','—')})")
+            return lines
+        return ["", "**7. Мониторинг**", data.get("monitoring", "—")]
+
+    def _format_hypothesis(self, data: dict, sections: Optional[List[str]] = None) -> str:
+        lines = [f"💡 **Авто-гипотеза A3** *(черновик — данные не сохранены)*\n", "---"]
+        for key in self._HYPOTHESIS_SECTIONS:
+            if sections is None or key in sections:
+                lines += self._hypothesis_section_lines(key, data)
+        if sections is None:
+            lines += ["", "---", "Для сохранения данных продолжи работу по шагам или используй `/edit`."]
+        else:
+            lines += ["", "⏳ _генерирую остальные разделы…_"]
+        return "\n".join(lines)
+
+    async def _stream_hypothesis(
+        self, __request__, __user__: dict, messages: List[Dict[str, Any]], __event_emitter__
+    ) -> Optional[dict]:
+        """Stream the draft, showing each section as soon as its JSON member closes.
+
+        Returns the parsed draft, or None to let the caller fall back to the
+        blocking ``_call_llm_json`` (which also handles re-asks and fallbacks).
+        """
+        site = "_generate_hypothesis"
+        models = self._model_candidates(site)
+        key = self._llm_json_key(models, messages)
+        cached = await self._cached_llm_json(key)
+        if cached is not None:
+            return cached
+
+        uid = (__user__ or {}).get("id") if isinstance(__user__, dict) else None
+        user = await self._get_user_async(uid)
+        call_user = user or (__user__ if isinstance(__user__, dict) else {"id": "system"})
+        model_name = self._model_health().order(models)[0]
+        parser = IncrementalJsonObject()
+
+        async def consume(stream) -> Optional[dict]:
+            async for piece in stream:
+                if not [k for k in parser.feed(piece) if k in self._HYPOTHESIS_SECTIONS]:
+                    continue
+                shown = [k for k in self._HYPOTHESIS_SECTIONS if k in parser.values]
+                with contextlib.suppress(Exception):
+                    await __event_emitter__(
+                        {"type": "replace", "data": {"content": self._format_hypothesis(parser.values, shown)}}
+                    )
+            try:
+                data = self._safe_json_loads(parser.text.strip().lstrip("\ufeff"))
+                outcome = "parsed"
+            except Exception:
+                data, outcome = (parser.values, "repaired") if parser.closed else (None, "failed")
+            _LLM_TELEMETRY.record_parse(site, outcome)
+            return data if isinstance(data, dict) and data else None
+
+        try:
+            data = await self._stream_attempt(__request__, call_user, model_name, messages, site, consume)
+        except Exception:
+            return None
+        if data is None:
+            return None
+        await self._store_llm_json(key, model_name, data)
+        return data
+
+    def _parse_edit_message(self, text: str) -> dict:
+        result = {}
+        for line in (text or "").splitlines():
+            if ":" not in line:
+                continue
+            key, _, value = line.partition(":")
+            key_norm = key.strip().lower()
+            value = value.strip()
+            if key_norm in self._EDIT_FIELDS and value:
+                result[key_norm] = value
+        return result
+
+    def _validate_edit_fields(self, fields: dict) -> list:
+        """Returns list of validation error strings. Empty = OK."""
+        errors = []
+        str_fields = set(self._EDIT_FIELDS.keys())
+        min_len = 3
+        for key, value in fields.items():
+            if key not in str_fields:
+                continue
+            if not isinstance(value, str) or len(value.strip()) < min_len:
+                errors.append(f"Поле «{key.capitalize()}» слишком короткое (мин. {min_len} символа).")
+        return errors
+
+    # ---------- paths ----------
+
+    def _state_path(self, project_id: str) -> Path:
+
+        return STATE_DIR / f"{project_id}.json"
+
+    def _active_path(self, user_id: str) -> Path:
+
+        return ACTIVE_DIR / f"{user_id}.json"
+
+    # ---------- state ----------
+
+    def _store(self):
+
+        return _open_store(
+
+            (self.valves.STATE_BACKEND or "json").strip().lower(),
+
+            (self.valves.STATE_DB_PATH or "").strip(),
+
+            fsync=self.valves.STATE_FSYNC,
+
+            fsync_interval=self.valves.STATE_FSYNC_INTERVAL_SEC,
+
+            cache_size=self.valves.STATE_CACHE_SIZE,
+
+            journal_max_ops=self.valves.STATE_JOURNAL_MAX_OPS,
+
+            journal_idle_sec=self.valves.STATE_JOURNAL_IDLE_SEC,
+
+        )
+
+    def _project_exists(self, project_id: str) -> bool:
+
+        return self._store().exists(project_id)
+
+    def _load_state(self, project_id: str) -> Dict[str, Any]:
+
+        state = self._store().load(project_id)
+
+        if state is None:
+
+            return {"project_id": project_id, "current_step": 1, "meta": {}, "data": {}}
+
+        return state
+
+    def _save_state(self, project_id: str, state: Dict[str, Any]) -> None:
+
+        uow = _TURN_UOW.get()
+
+        if uow is not None and not uow.closed:
+
+            uow.dirty[project_id] = state
+
+            uow.active_project = project_id
+
+            return
+
+        self._write_state(project_id, state)
+
+        self._write_global_active(project_id)
+
+    def _write_state(self, project_id: str, state: Dict[str, Any]) -> None:
+
+        self._store().save(project_id, state)
+
+    def _write_file(self, path: Path, text: str) -> None:
+
+        _atomic_write_text(
+
+            path,
+
+            text,
+
+            fsync=self.valves.STATE_FSYNC,
+
+            fsync_interval=self.valves.STATE_FSYNC_INTERVAL_SEC,
+
+        )
+
+    def _active_registry(self) -> ActiveProjectRegistry:
+
+        reg = get_active_registry()
+
+        reg.flush_delay = float(self.valves.ACTIVE_FLUSH_DELAY_SEC or 0)
+
+        reg.fsync = self.valves.STATE_FSYNC
+
+        reg.fsync_interval = self.valves.STATE_FSYNC_INTERVAL_SEC
+
+        return reg
+
+    def _write_global_active(self, project_id: str) -> None:
+
+        # Keep a global active-project marker so the status action can find
+        # the current project without depending on user_id format matching.
+        # Held in memory; the file is rewritten only when the project changes.
+        try:
+            self._active_registry().touch(project_id)
+        except Exception:
+            pass
+
+    def _mark_global_active(self, project_id: str) -> None:
+
+        uow = _TURN_UOW.get()
+
+        if uow is not None and not uow.closed:
+
+            uow.active_project = project_id
+
+            return
+
+        self._write_global_active(project_id)
+
+    def _flush_unit_of_work(self, uow: _StateUnitOfWork) -> None:
+
+        dirty, uow.dirty = uow.dirty, {}
+
+        for pid, st in dirty.items():
+
+            self._write_state(pid, st)
+
+        if uow.active_project:
+
+            self._write_global_active(uow.active_project)
+
+            uow.active_project = None
+
+    def _checkpoint_state(self) -> None:
+        """Flush pending writes of the current turn before a long LLM await.
+
+        Used right after a step transition, so a worker killed mid-call does
+        not lose the step progress already shown to the user.
+        """
+        uow = _TURN_UOW.get()
+        if uow is not None and not uow.closed and uow.dirty:
+            self._flush_unit_of_work(uow)
+
+    @contextlib.asynccontextmanager
+    async def _project_turn_lock(self, project_id: str):
+        timeout = max(0.0, float(self.valves.PROJECT_LOCK_TIMEOUT_SEC or 0))
+        deadline = time.monotonic() + timeout
+        lock = _project_lock(project_id)
+        try:
+            await asyncio.wait_for(lock.acquire(), timeout=timeout or None)
+        except asyncio.TimeoutError:
+            raise ProjectBusyError(project_id)
+        try:
+            if self.valves.PROJECT_FILE_LOCK:
+                async with _project_file_lock(project_id, deadline):
+                    yield
+            else:
+                yield
+        finally:
+            lock.release()
+
+    async def _create_project(self, project_id: str, state: Dict[str, Any], held_id: str) -> None:
+        """Write the initial state of a project unless it already exists.
+
+        A switch command runs under the lock of the project its turn started
+        on (``held_id``); any other target is checked and written under its
+        own lock, so a concurrent turn of that project never loses an update.
+        """
+        if project_id == held_id:
+
+            if not await _run_io(self._project_exists, project_id):
+
+                self._save_state(project_id, state)
+
+            return
+
+        async with self._project_turn_lock(project_id):
+
+            if not await _run_io(self._project_exists, project_id):
+
+                await _run_io(self._write_state, project_id, state)
+
+    @contextlib.contextmanager
+    def _state_unit_of_work(self):
+        uow = _StateUnitOfWork()
+        token = _TURN_UOW.set(uow)
+        try:
+            yield uow
+        finally:
+            uow.closed = True
+            _TURN_UOW.reset(token)
+            self._flush_unit_of_work(uow)
+
+    @contextlib.asynccontextmanager
+    async def _turn_unit_of_work(self):
+        # Same as _state_unit_of_work, but the final flush runs off the loop.
+        uow = _StateUnitOfWork()
+        token = _TURN_UOW.set(uow)
+        try:
+            yield uow
+        finally:
+            uow.closed = True
+            _TURN_UOW.reset(token)
+            await _run_io(self._flush_unit_of_work, uow)
+
+    # ---------- async storage facade ----------
+
+    async def _load_state_async(self, project_id: str) -> Dict[str, Any]:
+
+        return await _run_io(self._load_state, project_id)
+
+    async def _get_active_project_async(self, user_id: str) -> str:
+
+        return await _run_io(self._get_active_project, user_id)
+
+    async def _checkpoint_state_async(self) -> None:
+
+        await _run_io(self._checkpoint_state)
+
+    async def _get_user_async(self, uid: Optional[str]):
+
+        if not uid:
+
+            return None
+
+        _USER_CACHE.ttl_sec = float(self.valves.USER_CACHE_TTL_SEC or 0)
+
+        return await _USER_CACHE.lookup(uid, Users.get_user_by_id)
+
+    # ---------- steps ----------
+
+    def _load_step(self, step_id: int) -> Dict[str, Any]:
+
+        p = STEPS_DIR / f"step_{step_id}.json"
+
+        cached = _STEP_CACHE.get(p)
+
+        if cached is not None:
+
+            return cached[1]
+
+        return self._read_step(p)
+
+    def _read_step(self, p: Path) -> Dict[str, Any]:
+
+        mtime = p.stat().st_mtime_ns
+
+        step = json.loads(p.read_text(encoding="utf-8-sig"))
+
+        _STEP_CACHE[p] = (mtime, step)
+
+        return step
+
+    def _refresh_steps(self) -> None:
+
+        for p in STEPS_DIR.glob("step_*.json"):
+
+            cached = _STEP_CACHE.get(p)
+
+            try:
+
+                if cached is None or cached[0] != p.stat().st_mtime_ns:
+
+                    self._read_step(p)
+
+            except (OSError, ValueError):
+
+                _STEP_CACHE.pop(p, None)
+
+    def _step_exists(self, step_id: int) -> bool:
+
+        p = STEPS_DIR / f"step_{step_id}.json"
+
+        return p in _STEP_CACHE or p.exists()
+
+    # ---------- active project per user ----------
+
+    def _get_active_project(self, user_id: str) -> str:
+
+        return self._active_registry().get(user_id) or self.valves.DEFAULT_PROJECT_ID
+
+    def _set_active_project(self, user_id: str, project_id: str) -> None:
+
+        self._write_file(
+
+            self._active_path(user_id),
+
+            json.dumps({"project_id": project_id}, ensure_ascii=False, indent=2),
+
+        )
+
+        self._active_registry().remember(user_id, project_id)
+
+        # Also update global marker so the status action always sees the switch.
+        self._mark_global_active(project_id)
+
+    # ---------- commands ----------
+
+    def _list_projects(self) -> List[str]:
+
+        return self._store().list_ids()
+
+    def _parse_projects_args(self, args: str) -> Dict[str, Any]:
+
+        opts: Dict[str, Any] = {"mine": False, "step": None, "page": 1}
+
+        for tok in args.lower().split():
+
+            key, _, val = tok.partition("=")
+
+            if tok in ("mine", "мои"):
+
+                opts["mine"] = True
+
+            elif key in ("step", "шаг") and val.isdigit():
+
+                opts["step"] = int(val)
+
+            elif key in ("page", "стр") and val.isdigit():
+
+                opts["page"] = max(1, int(val))
+
+        return opts
+
+    def _render_projects(self, args: str, user_id: str, active_project: str) -> str:
+
+        opts = self._parse_projects_args(args)
+
+        size = max(1, int(self.valves.PROJECTS_PAGE_SIZE or 20))
+
+        def query():
+
+            return self._store().query_index(
+
+                owner=user_id if opts["mine"] else None,
+
+                step=opts["step"],
+
+                offset=(opts["page"] - 1) * size,
+
+                limit=size,
+
+            )
+
+        total, rows = query()
+
+        if not total:
+
+            return "📂 Пока нет проектов." if args.strip() == "" else "📂 Проектов по этому фильтру нет."
+
+        pages = (total + size - 1) // size
+
+        # A page past the end (stale link, typo) shows the last one instead.
+        if opts["page"] > pages:
+
+            opts["page"] = pages
+
+            total, rows = query()
+
+            pages = max(1, (total + size - 1) // size)
+
+        lines = [f"📂 Проекты (стр. {opts['page']}/{pages}, всего {total}):"]
+
+        for r in rows:
+
+            when = time.strftime("%d.%m.%Y %H:%M", time.localtime(r.get("updated_at") or 0))
+
+            mark = " 👈 активный" if r["id"] == active_project else ""
+
+            lines.append(
+
+                f"- `{r['id']}` — {r.get('title') or 'без названия'} · шаг {r.get('current_step')} · {when}{mark}"
+
+            )
+
+        if opts["page"] < pages:
+
+            filt = (" mine" if opts["mine"] else "") + (f" step={opts['step']}" if opts["step"] else "")
+
+            lines.append(f"\nДальше: `/projects{filt} page={opts['page'] + 1}`")
+
+        return "\n".join(lines)
+
+    def _next_project_id(self) -> str:
+
+        # Each call hands out a new number, so concurrent /startnew never collide.
+        return f"{self._store().allocate_number():05d}"
+
+    # ---------- admin stats ----------
+
+    def _llm_telemetry_lines(self, snap: Dict[str, Any]) -> List[str]:
+
+        def sec(v: Optional[float]) -> str:
+
+            return f"{v:.1f}" if v is not None else "—"
+
+        lines = [f"📡 Вызовы LLM (процесс {os.getpid()}, снимок в `{LLM_METRICS_PATH.name}`)", ""]
+
+        if not snap["calls"]:
+
+            return lines + ["Пока не было ни одного вызова."]
+
+        lines += [
+
+            "| Точка вызова | Модель | Попыток | Запасных | Ошибок | p50, с | p95, с | p99, с | Токены (вход/выход) |",
+
+            "|---|---|---|---|---|---|---|---|---|",
+
+        ]
+
+        for r in snap["calls"]:
+
+            failed = r["calls"] - r["outcomes"].get("ok", 0) - r["outcomes"].get("cancelled", 0)
+
+            lines.append(
+
+                f"| {r['site']} | {r['model']} | {r['calls']} | {r['fallback']} | {failed} | "
+
+                f"{sec(r['p50'])} | {sec(r['p95'])} | {sec(r['p99'])} | "
+
+                f"{r['prompt_tokens']}/{r['completion_tokens']} |"
+
+            )
+
+        if snap["json"]:
 
-        lines = [
-            f"💡 **Авто-гипотеза A3** *(черновик — данные не сохранены)*\n",
-            "---",
-            "",
-            f"**1. Проблема**",
-            data.get("problem", "—"),
-            "",
-            "**2. Уточнение проблемы**",
-        ]
-        s = data.get("spec") or {}
-        for label, key in [("Где/когда", "where_when"), ("Масштаб", "scale"),
-                           ("Последствия", "consequences"), ("Кто страдает", "who_suffers"),
-                           ("Деньги", "money_impact")]:
-            lines.append(f"- {label}: {s.get(key, '—')}")
+            lines += ["", "Разбор JSON по точкам вызова:"]
 
-        lines += ["", "**3. Текущее состояние**"]
-        for item in (data.get("baseline") or []):
-            lines.append(f"- {item.get('metric','—')}: {item.get('current_value','—')}")
+            for site, c in sorted(snap["json"].items()):
 
-        lines += ["", "**4. Целевое состояние**"]
-        for item in (data.get("target") or []):
-            lines.append(f"- {item.get('metric','—')}: {item.get('target_value','—')}")
+                lines.append(f"- {site}: сразу {c['parsed']}, починено {c['repaired']}, не разобрано {c['failed']}")
 
-        lines += ["", "**5. Коренные причины**"]
-        for rc in (data.get("root_causes") or []):
-            lines.append(f"- {rc}")
+        return lines
 
-        lines += ["", "**6. Мероприятия**"]
-        for act in (data.get("actions") or []):
-            lines.append(f"- {act.get('action','—')} ({act.get('owner','—')}, {act.get('due','—')})")
+    def _build_stats_lines(self) -> List[str]:
 
-        lines += ["", "**7. Мониторинг**", data.get("monitoring", "—")]
-        lines += ["", "---", "Для сохранения данных продолжи работу по шагам или используй `/edit`."]
+        store = self._store()
 
-        return "\n".join(lines)
+        lines = [f"📈 Статистика A3 (процесс {os.getpid()})", ""]
 
-    def _parse_edit_message(self, text: str) -> dict:
-        result = {}
-        for line in (text or "").splitlines():
-            if ":" not in line:
-                continue
-            key, _, value = line.partition(":")
-            key_norm = key.strip().lower()
-            value = value.strip()
-            if key_norm in self._EDIT_FIELDS and value:
-                result[key_norm] = value
-        return result
+        cache = getattr(store, "cache", None)
 
-    def _validate_edit_fields(self, fields: dict) -> list:
-        """Returns list of validation error strings. Empty = OK."""
-        errors = []
-        str_fields = set(self._EDIT_FIELDS.keys())
-        min_len = 3
-        for key, value in fields.items():
-            if key not in str_fields:
-                continue
-            if not isinstance(value, str) or len(value.strip()) < min_len:
-                errors.append(f"Поле «{key.capitalize()}» слишком короткое (мин. {min_len} символа).")
-        return errors
+        if cache is not None:
 
-    # ---------- paths ----------
+            st = cache.stats()
 
-    def _state_path(self, project_id: str) -> Path:
+            lines += [
 
-        return STATE_DIR / f"{project_id}.json"
+                f"Кэш состояний ({store.backend}): {st['size']}/{st['capacity']}",
 
-    def _active_path(self, user_id: str) -> Path:
+                f"- попадания: {st['hits']}, промахи: {st['misses']}, устаревшие: {st['stale']}",
 
-        return ACTIVE_DIR / f"{user_id}.json"
+                f"- вытеснения: {st['evictions']}, доля попаданий: {st['hit_rate']:.1%}",
 
-    # ---------- state ----------
+            ]
 
-    def _load_state(self, project_id: str) -> Dict[str, Any]:
+        lag = _LOOP_LAG.stats()
 
-        p = self._state_path(project_id)
+        lines += [
 
-        if not p.exists():
+            f"Event loop (проба каждые {_LOOP_LAG.interval:g} с): задержка p95 {lag['p95_ms']} мс, макс {lag['max_ms']} мс",
 
-            return {"project_id": project_id, "current_step": 1, "meta": {}, "data": {}}
+            f"- блокировок ≥ {_LOOP_LAG.stall_ms:g} мс: {lag['stalls']} из {lag['samples']}, суммарно {lag['total_ms']} мс",
 
-        return json.loads(p.read_text(encoding="utf-8-sig"))
+            f"- I/O вынесено в пул: {int(_IO_STATS['calls'])} вызовов, {_IO_STATS['seconds']:.2f} с",
 
-    def _save_state(self, project_id: str, state: Dict[str, Any]) -> None:
+            f"- пользователи из кэша: {_USER_CACHE.hits}, запросов к БД: {_USER_CACHE.misses}",
 
-        p = self._state_path(project_id)
+        ]
 
-        p.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+        for model_name, st in self._model_health().stats().items():
+
+            p95 = f"{st['p95']:.1f} с" if st["p95"] is not None else "—"
+
+            lines.append(
+
+                f"Модель {model_name}: успешно {st['ok']}, ошибок {st['errors']}, пропущено {st['skipped']}, "
+
+                f"p95 {p95}{' · ⛔ отключена' if st['open'] else ''}"
 
-        # Keep a global active-project marker so the status action can find
-        # the current project without depending on user_id format matching.
-        try:
-            (STATE_DIR.parent / "global_active.json").write_text(
-                json.dumps({"project_id": project_id}, ensure_ascii=False),
-                encoding="utf-8",
             )
-        except Exception:
-            pass
 
-    # ---------- steps ----------
+        pf = _PREFETCH.stats()
 
-    def _load_step(self, step_id: int) -> Dict[str, Any]:
+        lines += [
 
-        p = STEPS_DIR / f"step_{step_id}.json"
+            f"Предзагрузка следующего шага: запущено {pf['started']}, использовано {pf['used']}, "
 
-        return json.loads(p.read_text(encoding="utf-8-sig"))
+            f"промахов {pf['missed']}, ошибок {pf['failed']}, в работе {pf['running']}",
 
-    def _step_exists(self, step_id: int) -> bool:
+        ]
 
-        return (STEPS_DIR / f"step_{step_id}.json").exists()
+        llm = self._llm_cache().stats()
 
-    # ---------- active project per user ----------
+        lines += [
 
-    def _get_active_project(self, user_id: str) -> str:
+            f"Кэш ответов LLM: попадания {llm['hits']}, промахи {llm['misses']}, истёкшие {llm['expired']}",
 
-        p = self._active_path(user_id)
+            f"- записано: {llm['writes']}, вытеснено: {llm['evictions']}, доля попаданий: {llm['hit_rate']:.1%}",
 
-        if p.exists():
+        ]
 
-            try:
+        gate = self._llm_gate().stats()
 
-                data = json.loads(p.read_text(encoding="utf-8-sig"))
+        lines += [
 
-                pid = (data.get("project_id") or "").strip()
+            f"Очередь к LLM (лимит {gate['limit'] or '∞'}): выполняется {gate['active']}, ждут {gate['waiting']}",
 
-                if pid:
+            f"- пропущено вызовов: {gate['admitted']}, из них ждали {gate['queued']}, макс. ожидание {gate['max_wait']:g} с",
 
-                    return pid
+        ]
 
-            except Exception:
+        jobs = _JOBS.stats()
 
-                pass
+        lines += [
 
-        return self.valves.DEFAULT_PROJECT_ID
+            f"Фоновые задачи: запущено {jobs['started']}, выполняется {jobs['running']}, "
 
-    def _set_active_project(self, user_id: str, project_id: str) -> None:
+            f"выдано готовых {jobs['reused']}, ошибок {jobs['failed']}",
+
+        ]
 
-        p = self._active_path(user_id)
+        sf = _LLM_FLIGHTS.stats()
 
-        p.write_text(
+        lines += [
 
-            json.dumps({"project_id": project_id}, ensure_ascii=False, indent=2),
+            f"Одинаковые запросы к LLM: выполнено {sf['leaders']}, присоединено к уже идущим {sf['coalesced']}, "
 
-            encoding="utf-8",
+            f"в работе {sf['inflight']}",
+
+        ]
+
+        calls = _LLM_TELEMETRY.snapshot()["calls"]
+
+        lines.append(
+
+            f"Вызовы LLM: {sum(r['calls'] for r in calls)} попыток в {len(calls)} точках "
+
+            f"(подробно: `/a3stats llm`)"
 
         )
 
-        # Also update global marker so the status action always sees the switch.
-        try:
-            (STATE_DIR.parent / "global_active.json").write_text(
-                json.dumps({"project_id": project_id}, ensure_ascii=False),
-                encoding="utf-8",
+        parts = []
+
+        for step, c in _LOCAL_EXTRACT_STATS.items():
+
+            total = c["local"] + c["llm"]
+
+            share = c["local"] / total if total else 0.0
+
+            parts.append(f"шаг {step[-1]} — {c['local']} из {total} ({share:.0%})")
+
+        lines.append("Поля шаблонов извлечены без LLM: " + ", ".join(parts))
+
+        last = _PROMPT_STATS["last"]
+
+        if last:
+
+            before = sum(r["before"] for r in last.values())
+
+            after = sum(r["after"] for r in last.values())
+
+            lines.append(
+
+                f"Данные проекта в промпте анализа: последний ≈{after} ток. (было ≈{before}), "
+
+                f"сокращались {_PROMPT_STATS['truncated']} раз из {_PROMPT_STATS['builds']}"
+
             )
-        except Exception:
-            pass
 
-    # ---------- commands ----------
+        js = _JSON_STATS
 
-    def _list_projects(self) -> List[str]:
+        lines += [
 
-        return [p.stem for p in STATE_DIR.glob("*.json") if p.is_file()]
+            f"JSON от LLM: сразу {js['parsed']}, починено локально {js['repaired']}, "
 
-    def _next_project_id(self) -> str:
+            f"повторных запросов {js['reasked']}, не разобрано {js['failed']}",
 
-        max_num = 0
-        for pid in self._list_projects():
-            m = _re_search(r"(\d+)$", pid or "")
-            if not m:
-                continue
-            try:
-                max_num = max(max_num, int(m.group(1)))
-            except Exception:
-                continue
-        return f"{max_num + 1:05d}"
+        ]
+
+        reg = get_active_registry()
+
+        lines += [
+
+            f"Активный проект: {reg.current() or '—'}",
+
+            f"- записей global_active.json: {reg.flushes}, пропущено без изменений: {reg.skipped}",
+
+        ]
+
+        return lines
 
     # ---------- extraction ----------
 
@@ -619,6 +3572,46 @@ class Pipe:
 
         return filled_count, strong_count, strong_fields, weak_fields
 
+    def _local_score_step2(self, extracted: Dict[str, str]) -> float:
+
+        filled_count, strong_count, _, _ = self._count_filled_and_strong_fields_step2(extracted)
+
+        return (filled_count + strong_count) / 10
+
+    def _local_score_step3(self, ctx: Dict[str, Any]) -> float:
+
+        points = 0
+
+        for k in ("start_event", "end_event", "owner", "perimeter"):
+
+            if not self._is_weak(ctx.get(k) or ""):
+
+                points += 1
+
+        metrics = [str(m) for m in (ctx.get("result_metrics") or []) if not self._is_weak(str(m))]
+
+        if len(metrics) >= 2:
+
+            points += 1
+
+        return points / 5
+
+    def _local_extract_passes(self, step: str, score: float) -> bool:
+
+        """Counts the answer as extracted locally or by the LLM extraction call.
+
+        Only that call is skipped: the same turn still asks the LLM for the
+        next phase (step 3 hints after step 2, name variants within step 3).
+        """
+
+        threshold = float(self.valves.LOCAL_EXTRACT_MIN_SCORE or 0)
+
+        local = threshold > 0 and score >= threshold
+
+        _LOCAL_EXTRACT_STATS[step]["local" if local else "llm"] += 1
+
+        return local
+
     def _step3_context_ready(self, ctx: Dict[str, Any]) -> Tuple[bool, List[str]]:
 
         missing = []
@@ -1513,8 +4506,42 @@ class Pipe:
 
 # ---------- LLM ----------
 
-    def _model_candidates(self) -> List[str]:
-        candidates = [
+    def _llm_route(self, site: str) -> Tuple[List[str], Optional[float]]:
+        """Models and attempt timeout routed to a call site by LLM_ROUTES.
+
+        Routes are "site=model|model@timeout" separated by ";"; a site
+        ending in "*" is a prefix ("*" alone matches everything). An exact
+        name wins over prefixes, then the first matching prefix applies.
+        """
+        exact = None
+        prefixed = None
+        for item in (self.valves.LLM_ROUTES or "").split(";"):
+            pattern, _, target = item.partition("=")
+            pattern = pattern.strip()
+            if not pattern or not target.strip():
+                continue
+            if pattern == site:
+                exact = target
+                break
+            if prefixed is None and pattern.endswith("*") and site.startswith(pattern[:-1]):
+                prefixed = target
+        target = exact if exact is not None else prefixed
+        if target is None:
+            return [], None
+        models, _, timeout = target.partition("@")
+        try:
+            seconds = float(timeout) if timeout.strip() else None
+        except ValueError:
+            seconds = None
+        return [m.strip() for m in models.split("|") if m.strip()], seconds
+
+    def _attempt_timeout(self, site: str, model_name: str) -> Optional[float]:
+        routed = self._llm_route(site)[1] if site else None
+        return routed if routed else self._model_timeout(model_name)
+
+    def _model_candidates(self, site: str = "") -> List[str]:
+        routed = self._llm_route(site)[0] if site else []
+        candidates = routed or [
             (self.valves.METHODOLOGIST_MODEL or "").strip(),
             "gpt-5.2",
         ]
@@ -1622,45 +4649,278 @@ class Pipe:
             )
         return self._normalize_list(out, limit=5)
 
+    def _model_health(self) -> ModelHealth:
+        _MODEL_HEALTH.failures = int(self.valves.LLM_BREAKER_FAILURES or 0)
+        _MODEL_HEALTH.cooldown_sec = float(self.valves.LLM_BREAKER_COOLDOWN_SEC or 0)
+        return _MODEL_HEALTH
+
+    def _model_timeout(self, model_name: str) -> Optional[float]:
+        for item in (self.valves.LLM_MODEL_TIMEOUTS or "").split(","):
+            name, _, value = item.partition("=")
+            if name.strip() == model_name:
+                try:
+                    return float(value) or None
+                except ValueError:
+                    break
+        return float(self.valves.LLM_TIMEOUT_SEC or 0) or None
+
+    def _hedge_delay(self, model_name: str) -> Optional[float]:
+        if not self.valves.LLM_HEDGE:
+            return None
+        floor = float(self.valves.LLM_HEDGE_MIN_DELAY_SEC or 0)
+        p95 = self._model_health().p95(model_name)
+        return max(floor, p95 or 0.0)
+
+    async def _chat_single(
+        self, __request__, call_user, messages: List[Dict[str, Any]], model_name: str,
+        site: str = "", attempt: int = 1, admitted: Optional[asyncio.Event] = None,
+    ) -> str:
+        health = self._model_health()
+        timeout = self._attempt_timeout(site, model_name)
+        started = time.monotonic()
+        usage = None
+
+        def trace(outcome: str) -> None:
+            _LLM_TELEMETRY.record(site or "?", model_name, attempt, outcome, time.monotonic() - started, usage)
+
+        try:
+            async with self._llm_slot(call_user, site):
+                started = time.monotonic()  # queueing is not the model's latency
+                if admitted is not None:
+                    admitted.set()
+                result = await asyncio.wait_for(
+                    generate_chat_completions(
+                        request=__request__,
+                        form_data={
+                            "model": model_name,
+                            "messages": messages,
+                            "stream": False,
+                        },
+                        user=call_user,
+                    ),
+                    timeout=timeout,
+                )
+            if not isinstance(result, dict):
+                raise ValueError(f"bad_llm_result_type={type(result).__name__}")
+            usage = result.get("usage")
+            choices = result.get("choices")
+            if not isinstance(choices, list) or not choices:
+                raise ValueError("bad_llm_result_choices")
+            first = choices[0] if isinstance(choices[0], dict) else {}
+            message = first.get("message") if isinstance(first, dict) else {}
+            if not isinstance(message, dict):
+                raise ValueError("bad_llm_result_message")
+            content = message.get("content")
+            if content is None:
+                raise ValueError("empty_llm_content")
+        except asyncio.TimeoutError:
+            health.record_failure(model_name)
+            trace("timeout")
+            # Without a limit the TimeoutError came from inside the client.
+            raise ValueError(f"timeout after {timeout:g}s" if timeout else "upstream timeout")
+        except asyncio.CancelledError:
+            trace("cancelled")
+            raise  # lost a hedge race: not the model's fault
+        except Exception:
+            health.record_failure(model_name)
+            trace("error")
+            raise
+        health.record_success(model_name, time.monotonic() - started)
+        trace("ok")
+        return content or ""
+
     async def _chat_once_with_fallback(
-        self, __request__, __user__: dict, messages: List[Dict[str, Any]]
+        self, __request__, __user__: dict, messages: List[Dict[str, Any]], site: str = ""
     ) -> Tuple[str, str]:
+        """First valid answer from the site's models; ``site`` keys routing and telemetry."""
         uid = (__user__ or {}).get("id") if isinstance(__user__, dict) else None
-        user = Users.get_user_by_id(uid) if uid else None
+        user = await self._get_user_async(uid)
         call_user = user or (__user__ if isinstance(__user__, dict) else {"id": "system"})
+        site = site or _LLM_CALL_SITE.get()
+        queue = self._model_health().order(self._model_candidates(site))
         errs: List[str] = []
-        for model_name in self._model_candidates():
-            try:
-                result = await generate_chat_completions(
-                    request=__request__,
-                    form_data={
-                        "model": model_name,
-                        "messages": messages,
-                        "stream": False,
-                    },
-                    user=call_user,
-                )
-                if not isinstance(result, dict):
-                    raise ValueError(f"bad_llm_result_type={type(result).__name__}")
-                choices = result.get("choices")
-                if not isinstance(choices, list) or not choices:
-                    raise ValueError("bad_llm_result_choices")
-                first = choices[0] if isinstance(choices[0], dict) else {}
-                message = first.get("message") if isinstance(first, dict) else {}
-                if not isinstance(message, dict):
-                    raise ValueError("bad_llm_result_message")
-                content = message.get("content")
-                if content is None:
-                    raise ValueError("empty_llm_content")
-                return (content or ""), model_name
-            except Exception as e:
-                errs.append(f"{model_name}: {e}")
-                continue
+        running: Dict[asyncio.Task, str] = {}
+        admitted: Dict[asyncio.Task, asyncio.Event] = {}
+        attempts = 0
+
+        def launch() -> None:
+            nonlocal attempts
+            attempts += 1
+            model_name = queue.pop(0)
+            event = asyncio.Event()
+            task = asyncio.ensure_future(
+                self._chat_single(__request__, call_user, messages, model_name, site, attempts, event)
+            )
+            running[task] = model_name
+            admitted[task] = event
+
+        # Models are tried in order; with LLM_HEDGE the next one also starts
+        # when the current one is slower than its p95 (counted from getting
+        # an LLM slot, not from joining the queue), and the first valid
+        # answer wins.
+        if queue:
+            launch()
+        try:
+            while running:
+                newest = list(running)[-1]
+                delay = self._hedge_delay(running[newest]) if queue else None
+                admission = None
+                if delay is not None and not admitted[newest].is_set():
+                    admission = asyncio.ensure_future(admitted[newest].wait())
+                    delay = None
+                waits = list(running) + ([admission] if admission is not None else [])
+                try:
+                    done, _ = await asyncio.wait(waits, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    if admission is not None:
+                        admission.cancel()
+                done = {task for task in done if task in running}
+                if not done:
+                    if admission is None:
+                        launch()
+                    continue  # just admitted: the hedge clock starts now
+                for task in done:
+                    model_name = running.pop(task)
+                    try:
+                        return task.result(), model_name
+                    except Exception as e:
+                        errs.append(f"{model_name}: {e}")
+                if not running and queue:
+                    launch()
+        finally:
+            for task in running:
+                task.cancel()
         raise ValueError("; ".join(errs) if errs else "No available model")
 
+    def _llm_gate(self) -> LlmAdmission:
+
+        _LLM_GATE.limit = int(self.valves.LLM_MAX_CONCURRENCY or 0)
+
+        return _LLM_GATE
+
+    def _llm_slot(self, call_user, site: str):
+
+        """Admission for one LLM call, reporting the queue place to the chat."""
+
+        if isinstance(call_user, dict):
+
+            uid = str(call_user.get("id") or "")
+
+        else:
+
+            uid = str(getattr(call_user, "id", "") or "")
+
+        priority = max(
+
+            _LLM_PRIORITY.get(), LLM_PRIORITY_REVIEW if site in _REVIEW_SITES else LLM_PRIORITY_INTERACTIVE
+
+        )
+
+        emitter = _LLM_EMITTER.get()
+
+        shown = {"position": None}
+
+        async def on_wait(position: int) -> None:
+
+            if emitter is None or position == shown["position"]:
+
+                return
+
+            shown["position"] = position
+
+            if position:
+
+                status = {"description": f"⏳ Модель занята, ты в очереди: {position}-й", "done": False}
+
+            else:
+
+                status = {"description": "Очередь пройдена, готовлю ответ…", "done": True}
+
+            with contextlib.suppress(Exception):
+
+                await emitter({"type": "status", "data": status})
+
+        return self._llm_gate().slot(uid, priority, on_wait)
+
+    def _llm_cache(self) -> LlmResponseCache:
+
+        _LLM_CACHE.ttl_sec = float(self.valves.LLM_CACHE_TTL_SEC or 0)
+
+        _LLM_CACHE.max_entries = int(self.valves.LLM_CACHE_MAX_ENTRIES or 0)
+
+        return _LLM_CACHE
+
+    def _llm_json_key(self, models: List[str], messages: List[Dict[str, Any]], use_cache: bool = True) -> Optional[str]:
+
+        return _llm_cache_key(models, messages) if use_cache and self._llm_cache().enabled else None
+
+    async def _cached_llm_json(self, key: Optional[str]) -> Optional[Dict[str, Any]]:
+
+        """Stored answer for ``key``, unless this turn asked for a fresh one."""
+
+        if key is None or _LLM_CACHE_BYPASS.get():
+
+            return None
+
+        entry = await _run_io(self._llm_cache().get, key)
+
+        if entry is not None and isinstance(entry.get("data"), dict):
+
+            return entry["data"]
+
+        return None
+
+    async def _store_llm_json(self, key: Optional[str], model_name: str, data: Dict[str, Any]) -> None:
+
+        if key is None:
+
+            return
+
+        with contextlib.suppress(Exception):
+
+            await _run_io(self._llm_cache().put, key, model_name, data)
+
     async def _call_llm_json(
 
-        self, __request__, __user__: dict, messages: List[Dict[str, Any]]
+        self, __request__, __user__: dict, messages: List[Dict[str, Any]], use_cache: bool = True, site: str = ""
+
+    ) -> Dict[str, Any]:
+
+        site = site or _LLM_CALL_SITE.get()
+
+        models = self._model_candidates(site)
+
+        key = self._llm_json_key(models, messages, use_cache)
+
+        cached = await self._cached_llm_json(key)
+
+        if cached is not None:
+
+            return cached
+
+        token = _LLM_CALL_SITE.set(site)
+
+        try:
+
+            if not self.valves.LLM_SINGLE_FLIGHT:
+
+                return await self._request_llm_json(__request__, __user__, messages, key)
+
+            flight = _llm_cache_key(models, messages)
+
+            return await _LLM_FLIGHTS.run(
+
+                flight, lambda: self._request_llm_json(__request__, __user__, messages, key)
+
+            )
+
+        finally:
+
+            _LLM_CALL_SITE.reset(token)
+
+    async def _request_llm_json(
+
+        self, __request__, __user__: dict, messages: List[Dict[str, Any]], key: Optional[str]
 
     ) -> Dict[str, Any]:
 
@@ -1668,19 +4928,55 @@ class Pipe:
 
         last_content = ""
 
-        for _ in range(2):
+        for attempt in range(2):
 
-            content, _ = await self._chat_once_with_fallback(__request__, __user__, messages)
+            content, model_name = await self._chat_once_with_fallback(__request__, __user__, messages)
 
             last_content = (content or "").strip().lstrip("\ufeff")
 
+            repaired = False
+
             try:
 
-                return self._safe_json_loads(last_content)
+                data = self._safe_json_loads(last_content)
+
+                _JSON_STATS["parsed"] += 1
+
+                _LLM_TELEMETRY.record_parse(_LLM_CALL_SITE.get(), "parsed")
 
             except Exception as e:
 
-                last_err = e
+                data = _repair_json(last_content)
+
+                if not isinstance(data, dict):
+
+                    last_err = e
+
+                    data = None
+
+                    _LLM_TELEMETRY.record_parse(_LLM_CALL_SITE.get(), "failed")
+
+                else:
+
+                    repaired = True
+
+                    _JSON_STATS["repaired"] += 1
+
+                    _LLM_TELEMETRY.record_parse(_LLM_CALL_SITE.get(), "repaired")
+
+            if data is not None:
+
+                # A locally repaired answer may be a truncated one closed by
+                # _repair_json: use it for this turn, but never cache it.
+                if not repaired:
+
+                    await self._store_llm_json(key, model_name, data)
+
+                return data
+
+            if attempt == 0:
+
+                _JSON_STATS["reasked"] += 1
 
                 messages = messages + [
 
@@ -1694,6 +4990,8 @@ class Pipe:
 
                 ]
 
+        _JSON_STATS["failed"] += 1
+
         snippet = (
 
             (last_content[:200] + "...") if len(last_content) > 200 else last_content
@@ -1776,6 +5074,8 @@ class Pipe:
 
             ],
 
+            site="_get_step2_hints_and_extract",
+
         )
 
         extracted = data.get("extracted") or {}
@@ -1891,6 +5191,7 @@ class Pipe:
                     {"role": "system", "content": system},
                     {"role": "user", "content": user_prompt},
                 ],
+                site="_get_step3_context_hints_examples_and_extract",
             )
         except Exception:
             data = {
@@ -2142,6 +5443,7 @@ class Pipe:
                     {"role": "system", "content": system},
                     {"role": "user", "content": user_prompt},
                 ],
+                site="_get_step3_proposals",
             )
         except Exception:
             return self._fallback_step3_proposals(raw_problem, process_context)
@@ -2234,6 +5536,8 @@ class Pipe:
 
             ],
 
+            site="_get_step4_metric_proposals",
+
         )
 
         metrics = data.get("metric_suggestions") or []
@@ -2318,6 +5622,8 @@ class Pipe:
 
             ],
 
+            site="_get_step6_problem_proposals",
+
         )
 
         problems = data.get("problems") or []
@@ -2361,6 +5667,7 @@ class Pipe:
                     {"role": "system", "content": system},
                     {"role": "user", "content": user_prompt},
                 ],
+                site="_get_step6_why_suggestions",
             )
             llm_raw = (content or "").strip().lstrip("\ufeff")
             if not llm_raw:
@@ -2397,6 +5704,28 @@ class Pipe:
             "llm_error": llm_err,
         }
 
+    async def _get_step6_why_suggestions_for(
+        self,
+        __request__,
+        __user__: dict,
+        problems: List[str],
+    ) -> Dict[str, List[str]]:
+        """First-level "why" suggestions for every selected problem, fetched concurrently."""
+
+        async def fetch(problem: str) -> List[str]:
+            try:
+                s_data = await self._get_step6_why_suggestions(__request__, __user__, problem)
+            except Exception:
+                s_data = {"why_suggestions": []}
+            return self._normalize_list(s_data.get("why_suggestions") or [], limit=5)
+
+        problems = [p for p in dict.fromkeys(problems) if p]
+        results = await _gather_bounded(
+            [functools.partial(fetch, p) for p in problems],
+            self.valves.STEP6_PREFETCH_CONCURRENCY,
+        )
+        return dict(zip(problems, results))
+
     async def _get_step6_root_hint(
         self,
         __request__,
@@ -2433,13 +5762,13 @@ class Pipe:
             "\u041a\u043e\u0440\u043d\u0435\u0432\u0430\u044f \u043f\u0440\u0438\u0447\u0438\u043d\u0430:\n"
             f"{root_cause}\n\n"
             "\u041a\u043e\u043d\u0442\u0435\u043a\u0441\u0442 \u043f\u0440\u043e\u0446\u0435\u0441\u0441\u0430:\n"
-            f"{json.dumps(process_ctx, ensure_ascii=False, indent=2)}\n\n"
+            f"{_compact_json(process_ctx)}\n\n"
             "\u041a\u043e\u043d\u043a\u0440\u0435\u0442\u0438\u0437\u0430\u0446\u0438\u044f \u043f\u0440\u043e\u0431\u043b\u0435\u043c\u044b:\n"
-            f"{json.dumps(problem_spec, ensure_ascii=False, indent=2)}\n\n"
+            f"{_compact_json(problem_spec)}\n\n"
             "\u0422\u0435\u043a\u0443\u0449\u0438\u0435 \u043c\u0435\u0442\u0440\u0438\u043a\u0438:\n"
-            f"{json.dumps(current_metrics, ensure_ascii=False, indent=2)}\n\n"
+            f"{_compact_json(current_metrics)}\n\n"
             "\u0426\u0435\u043b\u0435\u0432\u044b\u0435 \u043c\u0435\u0442\u0440\u0438\u043a\u0438:\n"
-            f"{json.dumps(target_metrics, ensure_ascii=False, indent=2)}\n\n"
+            f"{_compact_json(target_metrics)}\n\n"
             "\u0412\u0435\u0440\u043d\u0438 3-5 \u043f\u0443\u043d\u043a\u0442\u043e\u0432, \u043a\u0430\u0436\u0434\u044b\u0439 \u0441 \u043d\u043e\u0432\u043e\u0439 \u0441\u0442\u0440\u043e\u043a\u0438. \u0411\u0435\u0437 JSON."
         )
 
@@ -2453,6 +5782,7 @@ class Pipe:
                     {"role": "system", "content": system},
                     {"role": "user", "content": user_prompt},
                 ],
+                site="_get_step7_countermeasures",
             )
             llm_raw = (content or "").strip().lstrip("\ufeff")
             if not llm_raw:
@@ -2503,7 +5833,7 @@ class Pipe:
             "\u0414\u0435\u0439\u0441\u0442\u0432\u0438\u044f:\n"
             + "\n".join([f"- {a}" for a in actions])
             + "\n\n\u041a\u043e\u043d\u0442\u0435\u043a\u0441\u0442 \u043f\u0440\u043e\u0446\u0435\u0441\u0441\u0430:\n"
-            + f"{json.dumps(process_ctx, ensure_ascii=False, indent=2)}\n\n"
+            + f"{_compact_json(process_ctx)}\n\n"
             + "\u0412\u0435\u0440\u043d\u0438 \u0421\u0422\u0420\u041e\u0413\u041e JSON \u0444\u043e\u0440\u043c\u0430\u0442\u0430:\n"
             + '{"plan":[{"action":"...","expected_result":"...","owner":"...","due":"..."}]}'
         )
@@ -2511,11 +5841,17 @@ class Pipe:
             {"role": "system", "content": system},
             {"role": "user", "content": user_prompt},
         ]
-        return await self._call_llm_json(__request__, __user__, messages)
+        return await self._call_llm_json(__request__, __user__, messages, site="_get_step7_plan_from_actions")
 
     def _build_project_summary_lines(
-        self, state: Dict[str, Any], project_id: str, current_step: int
+        self, state: Dict[str, Any], project_id: str, current_step: int, budget: int = 0
     ) -> List[str]:
+        """Project overview for /summary and the review prompt.
+
+        With a ``budget`` (estimated tokens) the why-chains are cut first:
+        chains of other problems oldest-first, then the active chain. Within
+        the budget the output is the same as without one.
+        """
         raw_problem = state.get("data", {}).get("steps", {}).get("raw_problem", {})
         spec = state.get("data", {}).get("steps", {}).get("problem_spec", {})
         process_ctx = state.get("data", {}).get("steps", {}).get("process_context", {})
@@ -2605,25 +5941,36 @@ class Pipe:
         lines += ["", "Шаг 6 — Анализ причин:"]
         if step6_active:
             lines.append(f"- Активная проблема: {step6_active}")
-        if step6_chain:
-            lines.append("- Цепочка почему (последние 3):")
-            for w in step6_chain[-3:]:
-                level = w.get("level")
-                answer = w.get("answer")
-                lines.append(f"- Почему {level}: {answer}")
-
+        prompt = PromptBuilder(budget)
+        prompt.add("steps_1_5", lines)
+        lines = []
         chains_by_problem = state.get("data", {}).get("steps", {}).get("step6_chains_by_problem", {})
         if not isinstance(chains_by_problem, dict):
             chains_by_problem = {}
+        # The whole active chain is its own section, cut only after the
+        # chains of the other problems; it is not repeated among them.
+        active_chain = step6_chain or (chains_by_problem.get(step6_active) if step6_active else None)
+        if not isinstance(active_chain, list):
+            active_chain = []
+        if active_chain:
+            prompt.add(
+                "step6_chain",
+                ["- Цепочка почему:"],
+                [f"- Почему {w.get('level')}: {w.get('answer')}" for w in active_chain],
+                priority=2,
+            )
+
         if chains_by_problem:
-            lines.append("- Цепочки почему:")
+            blocks = []
             for problem, chain in chains_by_problem.items():
-                lines.append(f"- Проблема: {problem}")
+                if active_chain and problem == step6_active:
+                    continue
+                block = [f"- Проблема: {problem}"]
                 if isinstance(chain, list):
                     for w in chain:
-                        level = w.get("level")
-                        answer = w.get("answer")
-                        lines.append(f"- Почему {level}: {answer}")
+                        block.append(f"- Почему {w.get('level')}: {w.get('answer')}")
+                blocks.append(block)
+            prompt.add("step6_chains_by_problem", ["- Цепочки почему:"], blocks, priority=3)
 
         if step6_roots:
             lines.append("- Корневые причины:")
@@ -2659,13 +6006,91 @@ class Pipe:
         else:
             lines.append("- ещё не задан")
 
-        return lines
+        prompt.add("step6_roots_step7", lines)
+        lines = prompt.lines()
+        if budget:
+            _PROMPT_STATS["builds"] += 1
+            _PROMPT_STATS["truncated"] += int(any(r["after"] < r["before"] for r in prompt.report.values()))
+            _PROMPT_STATS["last"] = prompt.report
+        return lines
+
+    async def _open_stream(
+        self, __request__, call_user, model_name: str, messages: List[Dict[str, Any]], site: str = ""
+    ):
+        """Start a ``stream: True`` completion; returns an async iterator of text pieces."""
+        timeout = self._attempt_timeout(site, model_name)
+        result = await asyncio.wait_for(
+            generate_chat_completions(
+                request=__request__,
+                form_data={"model": model_name, "messages": messages, "stream": True},
+                user=call_user,
+            ),
+            timeout=timeout,
+        )
+        return _iter_completion_text(result, idle_timeout=timeout)
+
+    async def _stream_attempt(
+        self, __request__, call_user, model_name: str, messages: List[Dict[str, Any]], site: str, consume
+    ) -> Any:
+        """One streamed completion, gated and accounted like a ``_chat_single`` attempt.
+
+        ``consume`` receives the piece iterator and returns the result; an
+        exception from it counts as a failed attempt for the model's breaker.
+        """
+        health = self._model_health()
+        started = time.monotonic()
+
+        def trace(outcome: str) -> None:
+            _LLM_TELEMETRY.record(site or "?", model_name, 1, outcome, time.monotonic() - started)
+
+        try:
+            async with self._llm_slot(call_user, site):
+                started = time.monotonic()
+                result = await consume(await self._open_stream(__request__, call_user, model_name, messages, site))
+        except asyncio.TimeoutError:
+            health.record_failure(model_name)
+            trace("timeout")
+            raise
+        except asyncio.CancelledError:
+            trace("cancelled")
+            raise
+        except Exception:
+            health.record_failure(model_name)
+            trace("error")
+            raise
+        health.record_success(model_name, time.monotonic() - started)
+        trace("ok")
+        return result
+
+    async def _stream_to_chat(
+        self,
+        __event_emitter__,
+        pieces,
+        prefix: str = "",
+    ) -> str:
+        """Collect streamed text while mirroring it into the chat message.
+
+        Each update replaces the whole message (prefix + text so far), at most
+        every STREAM_EMIT_INTERVAL_SEC, so the final return value of the pipe
+        simply overwrites the last partial state.
+        """
+        text = ""
+        last_emit = 0.0
+        interval = float(self.valves.STREAM_EMIT_INTERVAL_SEC or 0)
+        async for piece in pieces:
+            text += piece
+            now = time.monotonic()
+            if __event_emitter__ and (not last_emit or now - last_emit >= interval):
+                last_emit = now
+                with contextlib.suppress(Exception):
+                    await __event_emitter__({"type": "replace", "data": {"content": prefix + text}})
+        return text
 
     async def _analyze_project_with_gpt52(
-        self, __request__, __user__: dict, summary_text: str
+        self, __request__, __user__: dict, summary_text: str, __event_emitter__=None, prefix: str = ""
     ) -> str:
         uid = (__user__ or {}).get("id") if isinstance(__user__, dict) else None
-        user = Users.get_user_by_id(uid) if uid else None
+        user = await self._get_user_async(uid)
         call_user = user or (__user__ if isinstance(__user__, dict) else {"id": "system"})
 
         system_prompt = (
@@ -2716,31 +6141,28 @@ class Pipe:
             "После инструкции ниже будет предоставлено описание проекта A3 для анализа."
         )
         user_prompt = "Описание проекта A3 для анализа:\n\n" + (summary_text or "")
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ]
 
-        result = await generate_chat_completions(
-            request=__request__,
-            form_data={
-                "model": "gpt-5.2",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt},
-                ],
-                "stream": False,
-            },
-            user=call_user,
-        )
-        if not isinstance(result, dict):
-            raise ValueError(f"bad_llm_result_type={type(result).__name__}")
-        choices = result.get("choices")
-        if not isinstance(choices, list) or not choices:
-            raise ValueError("bad_llm_result_choices")
-        first = choices[0] if isinstance(choices[0], dict) else {}
-        message = first.get("message") if isinstance(first, dict) else {}
-        if not isinstance(message, dict):
-            raise ValueError("bad_llm_result_message")
-        content = message.get("content")
-        if content is None:
-            raise ValueError("empty_llm_content")
+        site = "_analyze_project_with_gpt52"
+        if __event_emitter__ and self.valves.STREAM_ANALYSIS:
+            # First tokens show up in the chat right away. If streaming fails,
+            # the blocking call below runs and its answer replaces the partial one.
+            model_name = self._model_health().order(self._model_candidates(site))[0]
+
+            async def consume(stream) -> str:
+                return await self._stream_to_chat(__event_emitter__, stream, prefix)
+
+            try:
+                streamed = await self._stream_attempt(__request__, call_user, model_name, messages, site, consume)
+            except Exception:
+                streamed = ""
+            if streamed.strip():
+                return streamed.strip()
+
+        content, _ = await self._chat_once_with_fallback(__request__, __user__, messages, site=site)
         return (content or "").strip()
 
     async def _emit_follow_ups(self, __event_emitter__, follow_ups: list) -> None:
@@ -2756,6 +6178,119 @@ class Pipe:
         except Exception:
             return
 
+    # ---------- next-step prefetch ----------
+
+    def _schedule_prefetch(self, project_id: str, kind: str, fingerprint: str, factory) -> None:
+
+        if not self.valves.PREFETCH_NEXT_STEP:
+
+            return
+
+        async def persist(result, consumed) -> None:
+
+            # Waits for the running turn of this project, then records the
+            # result unless that turn already took it from memory.
+            async with self._project_turn_lock(project_id):
+
+                if consumed():
+
+                    return
+
+                st = await self._load_state_async(project_id)
+
+                st.setdefault("meta", {}).setdefault("prefetch", {})[kind] = {
+
+                    "fingerprint": fingerprint,
+
+                    "result": result,
+
+                    "at": time.time(),
+
+                }
+
+                await _run_io(self._write_state, project_id, st)
+
+        _PREFETCH.schedule(project_id, kind, fingerprint, factory, persist)
+
+    async def _take_prefetch(
+
+        self, project_id: str, state: Dict[str, Any], kind: str, fingerprint: str
+
+    ) -> Optional[Any]:
+
+        stored = ((state.get("meta") or {}).get("prefetch") or {}).pop(kind, None)
+
+        if isinstance(stored, dict) and stored.get("fingerprint") == fingerprint:
+
+            _PREFETCH.used += 1
+
+            return stored.get("result")
+
+        result = await _PREFETCH.take(project_id, kind, fingerprint)
+
+        if result is None:
+
+            _PREFETCH.missed += 1
+
+        return result
+
+    # ---------- background jobs ----------
+
+    async def _run_job(
+
+        self, project_id: str, kind: str, fingerprint: str, factory, __event_emitter__=None, label: str = ""
+
+    ) -> Any:
+
+        """Run a long LLM operation as a background job and wait for its result.
+
+        The job keeps running if this request is cut off; asking again with
+        the same inputs joins it or returns its stored result at once
+        ("обнови варианты" always starts a new one).
+        """
+
+        _JOBS.ttl_sec = float(self.valves.JOB_RESULT_TTL_SEC or 0)
+
+        job = await _JOBS.lookup(project_id, kind, fingerprint, fresh=_LLM_CACHE_BYPASS.get())
+
+        if job is None:
+
+            job = _JOBS.start(project_id, kind, fingerprint, factory)
+
+        async def status(description: str, done: bool) -> None:
+
+            if __event_emitter__ is None:
+
+                return
+
+            with contextlib.suppress(Exception):
+
+                await __event_emitter__({"type": "status", "data": {"description": description, "done": done}})
+
+        async def progress(job, elapsed: float) -> None:
+
+            await status(f"⏳ {label}: выполняется {int(elapsed)} с (задача {job['id']})", False)
+
+        try:
+
+            result = await _JOBS.wait(job, progress)
+
+        except Exception:
+
+            await status(f"{label}: ошибка (задача {job['id']})", True)
+
+            raise
+
+        if "task" in job:
+
+            await status(f"{label}: готово", True)
+
+        else:
+
+            await status(f"{label}: готово, результат задачи {job['id']}", True)
+
+        return result
+
     async def _emit_step3_follow_ups(self, __event_emitter__) -> None:
         return
 
@@ -2783,6 +6318,93 @@ class Pipe:
 
             return
 
+        # Turns of one project run strictly one after another (no lost
+        # updates on double-send/regenerate); other projects stay parallel.
+        _LOOP_LAG.interval = float(self.valves.LOOP_LAG_SAMPLE_SEC or 0)
+
+        _LOOP_LAG.ensure_started()
+
+        user_id = str(__user__["id"])
+
+        project_id = await self._get_active_project_async(user_id)
+
+        # "обнови варианты" must reach the LLM instead of the response cache.
+        bypass = _LLM_CACHE_BYPASS.set(self._is_update_variants_cmd(self._extract_user_text(body)))
+
+        emitter = _LLM_EMITTER.set(__event_emitter__)
+
+        try:
+
+            while True:
+
+                async with self._project_turn_lock(project_id):
+
+                    # Another tab may have switched the project while this
+                    # turn waited for the lock: follow it to the new one.
+                    active = await self._get_active_project_async(user_id)
+
+                    if active != project_id:
+
+                        project_id = active
+
+                        continue
+
+                    # One unit of work per turn: every _save_state below only marks
+                    # the project dirty, the write happens once when the turn ends.
+                    async with self._turn_unit_of_work():
+
+                        # Warm the state cache and step definitions off the loop;
+                        # the synchronous reads inside the turn then hit memory.
+                        await _run_io(self._refresh_steps)
+
+                        await self._load_state_async(project_id)
+
+                        return await self._pipe_turn(
+
+                            body, __user__, __request__, __event_emitter__, __metadata__,
+
+                            project_id=project_id,
+
+                        )
+
+        except ProjectBusyError as exc:
+
+            busy_id = exc.args[0] if exc.args else project_id
+
+            return (
+
+                f"⏳ Предыдущее сообщение по проекту `{busy_id}` ещё обрабатывается.\n\n"
+
+                "Подожди немного и отправь сообщение ещё раз."
+
+            )
+
+        finally:
+
+            _LLM_CACHE_BYPASS.reset(bypass)
+
+            _LLM_EMITTER.reset(emitter)
+
+    async def _pipe_turn(
+
+        self,
+
+        body: dict,
+
+        __user__: dict,
+
+        __request__,
+
+        __event_emitter__=None,
+
+        __metadata__=None,
+
+        *,
+
+        project_id: str,
+
+    ):
+
         user_id = str(__user__["id"])
 
         user_text = self._extract_user_text(body).strip()
@@ -2799,46 +6421,51 @@ class Pipe:
         cmd = cmd_line.lower().strip()
         cmd = cmd.strip("`")
 
-        project_id = self._get_active_project(user_id)
-
-        # Always keep global_active.json current so the status action
-        # can find the right project without user_id lookup.
-        try:
-            (STATE_DIR.parent / "global_active.json").write_text(
-                json.dumps({"project_id": project_id}, ensure_ascii=False),
-                encoding="utf-8",
-            )
-        except Exception:
-            pass
+        # Always keep the global active marker current so the status action
+        # can find the right project without user_id lookup (in memory; the
+        # file only changes when the project does).
+        self._mark_global_active(project_id)
 
         # -------- commands --------
 
-        if cmd == "/projects":
+        if cmd == "/projects" or cmd.startswith("/projects "):
+
+            return await _run_io(self._render_projects, cmd[len("/projects"):], user_id, project_id)
 
-            projects = self._list_projects()
+        if cmd == "/a3stats" or cmd.startswith("/a3stats "):
 
-            if not projects:
+            cmd_rest = cmd[len("/a3stats"):].strip()
 
-                return "📂 Пока нет проектов."
+            if (__user__ or {}).get("role") != "admin":
 
-            return "📂 Проекты:\n" + "\n".join([f"- {p}" for p in projects])
+                return "⛔ Команда доступна только администратору."
+
+            if cmd_rest == "llm":
+
+                snap = await _run_io(_LLM_TELEMETRY.dump, LLM_METRICS_PATH)
+
+                return "\n".join(self._llm_telemetry_lines(snap))
+
+            return "\n".join(self._build_stats_lines())
 
         # ✅ /startnew or /создать проект: always create a fresh project with auto ID
         if cmd.startswith("/startnew") or cmd.startswith("/создать проект") or cmd.startswith("/создать_проект"):
-            new_id = self._next_project_id()
+            new_id = await _run_io(self._next_project_id)
 
-            self._set_active_project(user_id, new_id)
+            await self._create_project(
 
-            project_id = new_id
-
-            self._save_state(
+                new_id,
 
-                project_id,
+                {"project_id": new_id, "current_step": 1, "meta": {"owner": user_id}, "data": {}},
 
-                {"project_id": project_id, "current_step": 1, "meta": {}, "data": {}},
+                held_id=project_id,
 
             )
 
+            await _run_io(self._set_active_project, user_id, new_id)
+
+            project_id = new_id
+
             step1 = self._load_step(1)
 
             return (
@@ -2867,22 +6494,21 @@ class Pipe:
 
                 return "❗Укажи ID проекта: `/continue X-001`"
 
-            self._set_active_project(user_id, new_id)
+            # Only a missing project is written; an existing one is left to
+            # its own turns (the switch itself lives in the registry).
+            await self._create_project(
 
-            project_id = new_id
+                new_id,
 
-            if not self._state_path(project_id).exists():
-                state_to_save = {
-                    "project_id": project_id,
-                    "current_step": 1,
-                    "meta": {},
-                    "data": {},
-                }
-            else:
-                state_to_save = self._load_state(project_id)
+                {"project_id": new_id, "current_step": 1, "meta": {}, "data": {}},
+
+                held_id=project_id,
+
+            )
+
+            await _run_io(self._set_active_project, user_id, new_id)
 
-            # Always save to update mtime so the status action sees this as the active project.
-            self._save_state(project_id, state_to_save)
+            project_id = new_id
 
             step1 = self._load_step(1)
 
@@ -2900,7 +6526,7 @@ class Pipe:
 
         # load state
 
-        state = self._load_state(project_id)
+        state = await self._load_state_async(project_id)
 
         current_step = int(state.get("current_step", 1))
 
@@ -2908,6 +6534,9 @@ class Pipe:
 
         state.setdefault("meta", {})
 
+        # Projects created before owners were recorded belong to whoever works on them first.
+        state["meta"].setdefault("owner", user_id)
+
         if "step3_phase" not in state["meta"]:
 
             state["meta"]["step3_phase"] = "context"
@@ -2928,10 +6557,21 @@ class Pipe:
             return "\n".join(lines)
 
         if cmd in {"анализ проекта", "/анализ проекта"}:
-            lines = self._build_project_summary_lines(state, project_id, current_step)
+            lines = self._build_project_summary_lines(
+                state, project_id, current_step, budget=int(self.valves.PROMPT_TOKEN_BUDGET or 0)
+            )
             summary_text = "\n".join(lines)
             try:
-                review = await self._analyze_project_with_gpt52(__request__, __user__, summary_text)
+                review = await self._run_job(
+                    project_id,
+                    "analysis",
+                    _fingerprint(summary_text),
+                    lambda: self._analyze_project_with_gpt52(
+                        __request__, __user__, summary_text, __event_emitter__, prefix="🧠 Анализ проекта :\n\n"
+                    ),
+                    __event_emitter__,
+                    "Анализ проекта",
+                )
             except Exception as e:
                 return (
                     "⚠️ Не удалось выполнить анализ проекта через `gpt-5.2`.\n"
@@ -2945,7 +6585,7 @@ class Pipe:
 
         # /гипотеза command
         if cmd in {"/гипотеза", "/hypothesis", "гипотеза"}:
-            return await self._generate_hypothesis(state, project_id, __request__, __user__)
+            return await self._generate_hypothesis(state, project_id, __request__, __user__, __event_emitter__)
 
         # /edit command
         if cmd in {"/edit", "/редактировать", "редактировать", "/редакт"}:
@@ -3058,6 +6698,8 @@ class Pipe:
 
             self._save_state(project_id, state)
 
+            await self._checkpoint_state_async()
+
             raw_problem = user_text.strip()
 
             try:
@@ -3161,20 +6803,30 @@ class Pipe:
 
                 return msg
 
-            try:
+            local = self._extract_step2_fields_local(user_text)
 
-                data = await self._get_step2_hints_and_extract(
+            if self._local_extract_passes("step2", self._local_score_step2(local)):
 
-                    __request__, __user__, raw_problem, user_text
+                # The template answer is complete on its own: the turn moves
+                # on to step 3, where step 2 hints are not shown anyway.
+                data = {"extracted": local, "hints": []}
 
-                )
+            else:
 
-            except Exception as e:
-                data = {
-                    "extracted": self._extract_step2_fields_local(user_text),
-                    "hints": self._default_step2_hints(raw_problem),
-                    "llm_error": str(e),
-                }
+                try:
+
+                    data = await self._get_step2_hints_and_extract(
+
+                        __request__, __user__, raw_problem, user_text
+
+                    )
+
+                except Exception as e:
+                    data = {
+                        "extracted": local,
+                        "hints": self._default_step2_hints(raw_problem),
+                        "llm_error": str(e),
+                    }
 
             extracted = data.get("extracted") or {}
 
@@ -3228,6 +6880,8 @@ class Pipe:
 
             self._save_state(project_id, state)
 
+            await self._checkpoint_state_async()
+
             # ✅ Mini-fix #1: show rich Step 3 immediately (no extra user "ok")
 
             if self._step_exists(3):
@@ -3559,27 +7213,37 @@ class Pipe:
 
                         self._save_state(project_id, state)
 
+                        await self._checkpoint_state_async()
+
                         if self._step_exists(4):
 
-                            try:
+                            step4_data = await self._take_prefetch(
 
-                                step4_data = await self._get_step4_metric_proposals(
+                                project_id, state, "step4_metrics", _fingerprint(raw_problem, problem_spec, ctx)
 
-                                    __request__,
+                            )
 
-                                    __user__,
+                            if step4_data is None:
 
-                                    raw_problem,
+                                try:
 
-                                    problem_spec,
+                                    step4_data = await self._get_step4_metric_proposals(
 
-                                    ctx,
+                                        __request__,
 
-                                )
+                                        __user__,
 
-                            except Exception:
+                                        raw_problem,
+
+                                        problem_spec,
+
+                                        ctx,
+
+                                    )
 
-                                step4_data = {"metric_suggestions": []}
+                                except Exception:
+
+                                    step4_data = {"metric_suggestions": []}
 
                             step4 = self._load_step(4)
 
@@ -3681,12 +7345,26 @@ class Pipe:
 
             # ---------- PHASE: context ----------
             regen = self._is_update_variants_cmd(user_text)
-            try:
-                ctx_data = await self._get_step3_context_hints_examples_and_extract(
-                    __request__, __user__, raw_problem, problem_spec, "" if regen else user_text
-                )
-            except Exception:
-                ctx_data = {"hints": [], "examples": {}, "metric_suggestions": [], "extracted": {}}
+            local_ctx = None
+            if user_text and not regen:
+                score = 0.0
+                if self._looks_like_step3_template(user_text):
+                    local_ctx = self._extract_step3_context_fallback(user_text)
+                    if self._step3_context_ready(local_ctx)[0]:
+                        score = self._local_score_step3(local_ctx)
+                if not self._local_extract_passes("step3", score):
+                    local_ctx = None
+            if local_ctx is not None:
+                # Complete template: the turn goes straight to proposals,
+                # the context hints are not needed.
+                ctx_data = {"hints": [], "examples": {}, "metric_suggestions": [], "extracted": local_ctx}
+            else:
+                try:
+                    ctx_data = await self._get_step3_context_hints_examples_and_extract(
+                        __request__, __user__, raw_problem, problem_spec, "" if regen else user_text
+                    )
+                except Exception:
+                    ctx_data = {"hints": [], "examples": {}, "metric_suggestions": [], "extracted": {}}
 
             extracted = ctx_data.get("extracted") or {}
 
@@ -3798,6 +7476,24 @@ class Pipe:
 
                 self._save_state(project_id, state)
 
+                # Step 4 metric proposals depend only on steps 1-3, which are
+                # fixed now: compute them while the user picks the names.
+                self._schedule_prefetch(
+
+                    project_id,
+
+                    "step4_metrics",
+
+                    _fingerprint(raw_problem, problem_spec, extracted),
+
+                    functools.partial(
+
+                        self._get_step4_metric_proposals, __request__, __user__, raw_problem, problem_spec, extracted
+
+                    ),
+
+                )
+
                 pv = proposals.get("process_variants", [])
 
                 prj = proposals.get("project_variants", [])
@@ -4492,14 +8188,14 @@ class Pipe:
 
             state["current_step"] = 6
 
-            self._save_state(project_id, state)
-
             # transition to step 6
 
             state["meta"]["step6_phase"] = "select_problem"
 
             self._save_state(project_id, state)
 
+            await self._checkpoint_state_async()
+
             raw_problem = (
 
                 state.get("data", {})
@@ -4536,23 +8232,40 @@ class Pipe:
 
             )
 
+            # Keyed on the target values too: edited targets need new proposals.
+            step6_fp = _fingerprint(raw_problem, problem_spec, process_ctx, current_metrics, target_metrics)
+
             try:
 
-                p_data = await self._get_step6_problem_proposals(
+                p_data = await self._run_job(
+
+                    project_id,
+
+                    "step6_problems",
+
+                    step6_fp,
+
+                    lambda: self._get_step6_problem_proposals(
+
+                        __request__,
+
+                        __user__,
+
+                        raw_problem,
 
-                    __request__,
+                        problem_spec,
 
-                    __user__,
+                        process_ctx,
 
-                    raw_problem,
+                        current_metrics,
 
-                    problem_spec,
+                        target_metrics,
 
-                    process_ctx,
+                    ),
 
-                    current_metrics,
+                    __event_emitter__,
 
-                    target_metrics,
+                    "Проблемы шага 6",
 
                 )
 
@@ -4818,21 +8531,35 @@ class Pipe:
 
                     try:
 
-                        p_data = await self._get_step6_problem_proposals(
+                        p_data = await self._run_job(
 
-                            __request__,
+                            project_id,
 
-                            __user__,
+                            "step6_problems",
 
-                            raw_problem,
+                            _fingerprint(raw_problem, problem_spec, process_ctx, current_metrics, target_metrics),
 
-                            problem_spec,
+                            lambda: self._get_step6_problem_proposals(
 
-                            process_ctx,
+                                __request__,
 
-                            current_metrics,
+                                __user__,
 
-                            target_metrics,
+                                raw_problem,
+
+                                problem_spec,
+
+                                process_ctx,
+
+                                current_metrics,
+
+                                target_metrics,
+
+                            ),
+
+                            __event_emitter__,
+
+                            "Проблемы шага 6",
 
                         )
 
@@ -4905,13 +8632,11 @@ class Pipe:
                 self._save_state(project_id, state)
 
                 prefix = "\u2705 \u041f\u0440\u043e\u0431\u043b\u0435\u043c\u044b \u0437\u0430\u0444\u0438\u043a\u0441\u0438\u0440\u043e\u0432\u0430\u043d\u044b. \u041d\u0430\u0447\u043d\u0435\u043c \u0441 \u043f\u0435\u0440\u0432\u043e\u0439.\n\n"
-                try:
-                    s_data = await self._get_step6_why_suggestions(
-                        __request__, __user__, selected[0]
-                    )
-                except Exception:
-                    s_data = {"why_suggestions": []}
-                suggestions = _normalize_list(s_data.get("why_suggestions") or [], limit=5)
+                # Suggestions for the pending problems are fetched together with
+                # the first one, so switching problems later needs no LLM call.
+                by_problem = await self._get_step6_why_suggestions_for(__request__, __user__, selected)
+                state["data"]["steps"]["step6_why_suggestions_by_problem"] = by_problem
+                suggestions = _normalize_list(by_problem.get(selected[0]) or [], limit=5)
                 state["data"]["steps"]["step6_why_suggestions"] = suggestions
                 self._save_state(project_id, state)
                 return _step6_why_prompt(
@@ -5031,17 +8756,25 @@ class Pipe:
 
                         state["data"]["steps"]["step6_why_chain"] = []
 
-                        try:
+                        ready = (state["data"]["steps"].get("step6_why_suggestions_by_problem") or {}).get(next_problem)
 
-                            s_data = await self._get_step6_why_suggestions(
+                        if ready:
 
-                                __request__, __user__, next_problem
+                            s_data = {"why_suggestions": ready}
 
-                            )
+                        else:
+
+                            try:
+
+                                s_data = await self._get_step6_why_suggestions(
+
+                                    __request__, __user__, next_problem
 
-                        except Exception:
+                                )
+
+                            except Exception:
 
-                            s_data = {"why_suggestions": []}
+                                s_data = {"why_suggestions": []}
 
                         state["data"]["steps"]["step6_why_suggestions"] = _normalize_list(
 
@@ -5066,6 +8799,7 @@ class Pipe:
                     state["meta"]["step6_phase"] = "done"
                     state["current_step"] = 7
                     self._save_state(project_id, state)
+                    await self._checkpoint_state_async()
                     if self._step_exists(7):
                         process_ctx = (
                             state.get("data", {}).get("steps", {}).get("process_context", {})
@@ -5176,6 +8910,14 @@ class Pipe:
 
                     )
 
+                    if regen and not chain and active_problem:
+
+                        state["data"]["steps"].setdefault("step6_why_suggestions_by_problem", {})[active_problem] = (
+
+                            state["data"]["steps"]["step6_why_suggestions"]
+
+                        )
+
                     self._save_state(project_id, state)
 
                 suggestions = _normalize_list(
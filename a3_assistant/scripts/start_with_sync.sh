@@ -36,14 +36,16 @@ if ACTIVE.exists():
         except Exception:
             pass
 
-# 2. Most recently modified project file (prefer non-default)
+# 2. Most recently modified project (prefer non-default); journaled saves
+#    touch <id>.journal, not the <id>.json snapshot.
 if not pid and PROJECTS.exists():
-    files = list(PROJECTS.glob('*.json'))
-    real = sorted([f for f in files if f.stem != 'A3-0001'],
-                  key=lambda f: f.stat().st_mtime, reverse=True)
-    pick = real or sorted(files, key=lambda f: f.stat().st_mtime, reverse=True)
-    if pick:
-        pid = pick[0].stem
+    mtimes = {f.stem: f.stat().st_mtime for f in PROJECTS.glob('*.json')}
+    for f in PROJECTS.glob('*.journal'):
+        if f.stem in mtimes:
+            mtimes[f.stem] = max(mtimes[f.stem], f.stat().st_mtime)
+    pool = [p for p in mtimes if p != 'A3-0001'] or list(mtimes)
+    if pool:
+        pid = max(pool, key=lambda p: mtimes[p])
         print(f'[boot-active] mtime fallback: {pid}')
 
 if pid:
@@ -5,6 +5,8 @@ Unit-тесты для a3_controller.py
 
 import pytest
 import json
+import os
+import time
 from pathlib import Path
 import tempfile
 import shutil
@@ -39,6 +41,7 @@ sys.modules["open_webui.models.users"] = open_webui.models.users
 # Note: нужно адаптировать импорт под вашу структуру
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
+from a3_assistant.pipe import a3_controller
 from a3_assistant.pipe.a3_controller import Pipe
 
 
@@ -552,6 +555,41 @@ class TestStep6EdgeCases:
         assert st["data"]["steps"]["step6_active_problem"]
         assert st["data"]["steps"]["step6_pending_problems"]
 
+    def test_step6_select_prefetches_all_problems(self, monkeypatch):
+        pipe = Pipe()
+        state = {
+            "project_id": "T-1",
+            "current_step": 6,
+            "meta": {"step6_phase": "select_problem"},
+            "data": {"steps": {"raw_problem": {"raw_problem_sentence": "Raw"}}},
+        }
+        msg, st = self._run_pipe(pipe, "Проблемы:\n- P1\n- P2\n- P3", state, monkeypatch)
+        by_problem = st["data"]["steps"]["step6_why_suggestions_by_problem"]
+        assert set(by_problem) == {"P1", "P2", "P3"}
+        assert by_problem["P2"] == ["W1", "W2", "W3"]
+
+    def test_step6_next_problem_uses_prefetched(self, monkeypatch):
+        pipe = Pipe()
+        state = {
+            "project_id": "T-1",
+            "current_step": 6,
+            "meta": {"step6_phase": "why_loop"},
+            "data": {
+                "steps": {
+                    "raw_problem": {"raw_problem_sentence": "Raw"},
+                    "step6_active_problem": "P1",
+                    "step6_pending_problems": ["P2"],
+                    "step6_why_chain": [{"level": 1, "question": "Почему?", "answer": "Причина A"}],
+                    "step6_why_suggestions_by_problem": {"P2": ["Готовая причина"]},
+                    "root_causes": [],
+                }
+            },
+        }
+        msg, st = self._run_pipe(pipe, "зафиксировать", state, monkeypatch)
+        assert st["data"]["steps"]["step6_active_problem"] == "P2"
+        assert st["data"]["steps"]["step6_why_suggestions"] == ["Готовая причина"]
+        assert "Готовая причина" in msg
+
     def test_step6_select_custom_multiline(self, monkeypatch):
         pipe = Pipe()
         state = {
@@ -683,6 +721,1713 @@ class TestStep6EdgeCases:
         msg, st = self._run_pipe(pipe, "   \n  ", state, monkeypatch)
         assert "Почему?" in msg
         assert st["data"]["steps"]["step6_why_chain"] == []
+
+
+class TestStateUnitOfWork:
+    """Запись состояния один раз за ход pipe()"""
+
+    def _counting_pipe(self, monkeypatch):
+        pipe = Pipe()
+        writes = []
+        monkeypatch.setattr(pipe, "_write_state", lambda pid, st: writes.append((pid, dict(st))))
+        monkeypatch.setattr(pipe, "_write_global_active", lambda pid: writes.append(("global", pid)))
+        return pipe, writes
+
+    def test_saves_are_coalesced_until_turn_end(self, monkeypatch):
+        pipe, writes = self._counting_pipe(monkeypatch)
+        state = {"project_id": "T-1", "current_step": 1, "meta": {}, "data": {}}
+        with pipe._state_unit_of_work():
+            pipe._save_state("T-1", state)
+            state["current_step"] = 2
+            pipe._save_state("T-1", state)
+            pipe._save_state("T-1", state)
+            assert writes == []
+        assert writes == [("T-1", state), ("global", "T-1")]
+        assert writes[0][1]["current_step"] == 2
+
+    def test_checkpoint_flushes_only_dirty_state(self, monkeypatch):
+        pipe, writes = self._counting_pipe(monkeypatch)
+        state = {"project_id": "T-1", "current_step": 5, "meta": {}, "data": {}}
+        with pipe._state_unit_of_work():
+            pipe._save_state("T-1", state)
+            pipe._checkpoint_state()
+            assert [w[0] for w in writes] == ["T-1", "global"]
+            pipe._checkpoint_state()
+            assert len(writes) == 2
+        assert len(writes) == 2
+
+    def test_save_outside_turn_writes_immediately(self, monkeypatch):
+        pipe, writes = self._counting_pipe(monkeypatch)
+        pipe._save_state("T-1", {"project_id": "T-1"})
+        assert [w[0] for w in writes] == ["T-1", "global"]
+
+
+@pytest.fixture(autouse=True)
+def isolated_jobs(tmp_path, monkeypatch):
+    """Фоновые задачи пишут результаты во временную директорию"""
+    monkeypatch.setattr(a3_controller, "JOBS_DIR", tmp_path / "jobs")
+    monkeypatch.setattr(a3_controller, "_JOBS", a3_controller.JobRunner())
+
+
+@pytest.fixture
+def state_dirs(tmp_path, monkeypatch):
+    """Перенаправляет a3_state во временную директорию"""
+    projects = tmp_path / "projects"
+    active = tmp_path / "active_users"
+    projects.mkdir()
+    active.mkdir()
+    monkeypatch.setattr(a3_controller, "STATE_DIR", projects)
+    monkeypatch.setattr(a3_controller, "ACTIVE_DIR", active)
+    monkeypatch.setattr(a3_controller, "GLOBAL_ACTIVE_PATH", tmp_path / "global_active.json")
+    monkeypatch.setattr(a3_controller, "PROJECT_SEQ_PATH", tmp_path / "project_seq.json")
+    monkeypatch.setattr(a3_controller, "PROJECTS_INDEX_PATH", tmp_path / "projects_index.jsonl")
+    monkeypatch.setattr(a3_controller, "_ACTIVE_REGISTRY", a3_controller.ActiveProjectRegistry())
+    monkeypatch.setattr(a3_controller, "LLM_CACHE_DIR", tmp_path / "llm_cache")
+    monkeypatch.setattr(a3_controller, "_LLM_CACHE", a3_controller.LlmResponseCache())
+    monkeypatch.setattr(a3_controller, "_PREFETCH", a3_controller.PrefetchScheduler())
+    monkeypatch.setattr(a3_controller, "_LLM_FLIGHTS", a3_controller.SingleFlight())
+    monkeypatch.setattr(a3_controller, "_LLM_GATE", a3_controller.LlmAdmission())
+    monkeypatch.setattr(a3_controller, "_LLM_TELEMETRY", a3_controller.LlmTelemetry())
+    monkeypatch.setattr(a3_controller, "LLM_METRICS_PATH", tmp_path / "llm_metrics.json")
+    monkeypatch.setattr(a3_controller, "LOCK_DIR", tmp_path / "locks")
+    return projects
+
+
+class TestAtomicStateWrites:
+    """Атомарная запись проекта и откат к предыдущему поколению"""
+
+    @pytest.fixture
+    def pipe(self, state_dirs):
+        pipe = Pipe()
+        pipe.valves.STATE_FSYNC = "never"
+        pipe.valves.STATE_JOURNAL_MAX_OPS = 0
+        return pipe
+
+    def test_write_keeps_previous_generation(self, pipe, state_dirs):
+        pipe._save_state("T-1", {"project_id": "T-1", "current_step": 1})
+        pipe._save_state("T-1", {"project_id": "T-1", "current_step": 2})
+        assert json.loads((state_dirs / "T-1.json").read_text(encoding="utf-8"))["current_step"] == 2
+        assert json.loads((state_dirs / "T-1.json.bak").read_text(encoding="utf-8"))["current_step"] == 1
+        assert not list(state_dirs.glob("*.tmp"))
+        assert pipe._list_projects() == ["T-1"]
+
+    def test_load_falls_back_to_previous_generation(self, pipe, state_dirs):
+        pipe._save_state("T-1", {"project_id": "T-1", "current_step": 3})
+        pipe._save_state("T-1", {"project_id": "T-1", "current_step": 4})
+        (state_dirs / "T-1.json").write_text('{"project_id": "T-1", "curr', encoding="utf-8")
+        assert pipe._load_state("T-1")["current_step"] == 3
+
+    def test_load_without_backup_still_raises(self, pipe, state_dirs):
+        (state_dirs / "T-2.json").write_text("{broken", encoding="utf-8")
+        with pytest.raises(ValueError):
+            pipe._load_state("T-2")
+
+
+class TestProjectTurnLock:
+    """Сериализация ходов одного проекта"""
+
+    def _run_turns(self, pipe, monkeypatch, user_projects):
+        import asyncio
+
+        events = []
+
+        async def _turn(body, __user__, *args, **kwargs):
+            pid = user_projects[__user__["id"]]
+            events.append(("start", pid))
+            await asyncio.sleep(0.02)
+            events.append(("end", pid))
+            return pid
+
+        monkeypatch.setattr(pipe, "_pipe_turn", _turn)
+        monkeypatch.setattr(pipe, "_get_active_project", lambda uid: user_projects[uid])
+
+        async def _main():
+            return await asyncio.gather(
+                *[pipe.pipe({"messages": []}, {"id": uid}, None) for uid in user_projects]
+            )
+
+        return asyncio.run(_main()), events
+
+    def test_same_project_turns_are_serialized(self, monkeypatch, state_dirs):
+        pipe = Pipe()
+        _, events = self._run_turns(pipe, monkeypatch, {"u1": "T-1", "u2": "T-1"})
+        assert [e[0] for e in events] == ["start", "end", "start", "end"]
+
+    def test_different_projects_run_in_parallel(self, monkeypatch, state_dirs):
+        pipe = Pipe()
+        _, events = self._run_turns(pipe, monkeypatch, {"u1": "T-1", "u2": "T-2"})
+        assert [e[0] for e in events] == ["start", "start", "end", "end"]
+
+    def test_file_lock_serializes_too(self, monkeypatch, state_dirs, tmp_path):
+        monkeypatch.setattr(a3_controller, "LOCK_DIR", tmp_path / "locks")
+        pipe = Pipe()
+        pipe.valves.PROJECT_FILE_LOCK = True
+        results, events = self._run_turns(pipe, monkeypatch, {"u1": "T-1", "u2": "T-1"})
+        assert results == ["T-1", "T-1"]
+        assert [e[0] for e in events] == ["start", "end", "start", "end"]
+
+    def test_busy_project_returns_message(self, monkeypatch, state_dirs):
+        import asyncio
+
+        pipe = Pipe()
+        pipe.valves.PROJECT_LOCK_TIMEOUT_SEC = 0.01
+
+        async def _slow(*args, **kwargs):
+            await asyncio.sleep(0.1)
+            return "done"
+
+        monkeypatch.setattr(pipe, "_pipe_turn", _slow)
+        monkeypatch.setattr(pipe, "_get_active_project", lambda uid: "T-1")
+
+        async def _main():
+            return await asyncio.gather(
+                pipe.pipe({"messages": []}, {"id": "u1"}, None),
+                pipe.pipe({"messages": []}, {"id": "u1"}, None),
+            )
+
+        first, second = asyncio.run(_main())
+        assert first == "done"
+        assert "ещё обрабатывается" in second
+
+    def test_continue_does_not_overwrite_concurrent_step_turn(self, monkeypatch, state_dirs):
+        import asyncio
+        import contextvars
+        import threading
+
+        steps_dir = Path(a3_controller.__file__).resolve().parents[1] / "steps"
+        monkeypatch.setattr(a3_controller, "STEPS_DIR", steps_dir)
+        pipe = Pipe()
+        pipe.valves.STATE_FSYNC = "never"
+        pipe._write_state("00007", {"project_id": "00007", "current_step": 1, "meta": {}, "data": {}})
+        pipe._set_active_project("u2", "00007")
+        who = contextvars.ContextVar("who", default="")
+        u1_loaded, u2_written = threading.Event(), threading.Event()
+        written = []
+        real_load, real_write = pipe._load_state, pipe._write_state
+
+        def load(pid):
+            st = real_load(pid)
+            if pid == "00007" and who.get() == "u1":
+                u1_loaded.set()
+            return st
+
+        def write(pid, st):
+            # Forces the lost-update order: the /continue turn loads before
+            # the step turn writes and saves after it.
+            if pid == "00007" and who.get() == "u2":
+                u1_loaded.wait(0.5)
+                real_write(pid, st)
+                written.append(json.loads(json.dumps(st)))
+                u2_written.set()
+                return
+            if pid == "00007":
+                u2_written.wait(0.5)
+            real_write(pid, st)
+
+        monkeypatch.setattr(pipe, "_load_state", load)
+        monkeypatch.setattr(pipe, "_write_state", write)
+        answer = "Срок поставки деталей вырос с 5 до 9 дней, что срывает план сборки."
+
+        async def send(uid, text):
+            who.set(uid)
+            return await pipe.pipe({"messages": [{"role": "user", "content": text}]}, {"id": uid}, None)
+
+        async def _main():
+            return await asyncio.gather(send("u2", answer), send("u1", "/continue 00007"))
+
+        asyncio.run(_main())
+        assert written and written[-1]["current_step"] == 2
+        assert pipe._get_active_project("u1") == "00007"
+        assert real_load("00007") == written[-1]
+
+
+class TestSqliteProjectStore:
+    """SQLite-хранилище проектов и миграция из JSON"""
+
+    @pytest.fixture
+    def pipe(self, state_dirs, tmp_path):
+        pipe = Pipe()
+        pipe.valves.STATE_FSYNC = "never"
+        pipe.valves.STATE_BACKEND = "sqlite"
+        pipe.valves.STATE_DB_PATH = str(tmp_path / "projects.sqlite3")
+        yield pipe
+        pipe._store().close()
+        a3_controller._CURRENT_STORE.update(key=None, store=None)
+
+    def test_migrates_json_directory_once(self, state_dirs, pipe):
+        (state_dirs / "00007.json").write_text(
+            json.dumps({"project_id": "00007", "current_step": 4, "meta": {"owner": "u1"}}),
+            encoding="utf-8",
+        )
+        (state_dirs / "A3-0001.json").write_text(json.dumps({"current_step": 1}), encoding="utf-8")
+        assert sorted(pipe._list_projects()) == ["00007", "A3-0001"]
+        assert pipe._load_state("00007")["current_step"] == 4
+        assert pipe._next_project_id() == "00008"
+        store = pipe._store()
+        assert store.migrate_from_json() == 0
+
+    def test_save_load_and_latest(self, pipe):
+        pipe._save_state("00001", {"project_id": "00001", "current_step": 2, "meta": {"owner": "u1"}})
+        pipe._save_state("00002", {"project_id": "00002", "current_step": 3, "meta": {}})
+        assert pipe._project_exists("00002")
+        assert not pipe._project_exists("00003")
+        assert pipe._load_state("00001")["current_step"] == 2
+        assert pipe._store().latest_project_id() == "00002"
+        assert pipe._store().latest_project_id(skip=("00002",)) == "00001"
+        assert a3_controller.get_project_store() is pipe._store()
+        row = pipe._store()._con.execute(
+            "SELECT owner, current_step FROM projects WHERE project_id='00001'"
+        ).fetchone()
+        assert row == ("u1", 2)
+
+    def test_allocate_number_uses_sequence(self, pipe):
+        pipe._save_state("00004", {"project_id": "00004", "current_step": 1, "meta": {}})
+        assert pipe._next_project_id() == "00005"
+        assert pipe._next_project_id() == "00006"
+        pipe._save_state("00007", {"project_id": "00007", "current_step": 1, "meta": {}})
+        assert pipe._next_project_id() == "00008"
+
+
+class TestProjectIdAllocation:
+    """Выдача номеров проектов через персистентный счётчик"""
+
+    @pytest.fixture
+    def pipe(self, state_dirs):
+        pipe = Pipe()
+        pipe.valves.STATE_FSYNC = "never"
+        return pipe
+
+    def test_seeds_from_existing_projects_once(self, pipe, state_dirs, monkeypatch):
+        (state_dirs / "00003.json").write_text("{}", encoding="utf-8")
+        assert pipe._next_project_id() == "00004"
+        assert json.loads(a3_controller.PROJECT_SEQ_PATH.read_text(encoding="utf-8")) == {"next": 5}
+        monkeypatch.setattr(
+            a3_controller.JsonProjectStore, "max_number", Mock(side_effect=AssertionError("scan"))
+        )
+        assert pipe._next_project_id() == "00005"
+
+    def test_ids_are_unique_without_saving(self, pipe):
+        ids = [pipe._next_project_id() for _ in range(3)]
+        assert ids == ["00001", "00002", "00003"]
+
+    def test_skips_ids_created_by_hand(self, pipe, state_dirs):
+        assert pipe._next_project_id() == "00001"
+        (state_dirs / "00002.json").write_text("{}", encoding="utf-8")
+        assert pipe._next_project_id() == "00003"
+
+    def test_concurrent_allocation_from_threads(self, pipe):
+        import concurrent.futures
+
+        store = pipe._store()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            numbers = list(pool.map(lambda _: store.allocate_number(), range(40)))
+        assert sorted(numbers) == list(range(1, 41))
+
+
+class TestProjectsIndex:
+    """Индекс проектов для /projects"""
+
+    @pytest.fixture(params=["json", "sqlite"])
+    def pipe(self, request, state_dirs, tmp_path):
+        pipe = Pipe()
+        pipe.valves.STATE_FSYNC = "never"
+        pipe.valves.STATE_BACKEND = request.param
+        pipe.valves.STATE_DB_PATH = str(tmp_path / "projects.sqlite3")
+        pipe.valves.PROJECTS_PAGE_SIZE = 2
+        yield pipe
+        pipe._store().close()
+        a3_controller._CURRENT_STORE.update(key=None, store=None)
+
+    def _save(self, pipe, pid, owner, step, title=""):
+        steps = {"process_definition": {"project_title": title}} if title else {}
+        pipe._save_state(
+            pid,
+            {"project_id": pid, "current_step": step, "meta": {"owner": owner}, "data": {"steps": steps}},
+        )
+
+    def _fill(self, pipe, monkeypatch):
+        clock = iter(range(1000, 2000))
+        monkeypatch.setattr(a3_controller.time, "time", lambda: float(next(clock)))
+        self._save(pipe, "00001", "u1", 2, "Склад")
+        self._save(pipe, "00002", "u2", 4)
+        self._save(pipe, "00003", "u1", 4, "Закупки")
+        self._save(pipe, "00001", "u1", 3, "Склад")
+
+    def test_query_filters_and_sorts_by_recency(self, pipe, monkeypatch):
+        self._fill(pipe, monkeypatch)
+        store = pipe._store()
+        total, rows = store.query_index(limit=10)
+        assert total == 3
+        assert [r["id"] for r in rows] == ["00001", "00003", "00002"]
+        assert rows[0]["title"] == "Склад" and rows[0]["current_step"] == 3
+        assert [r["id"] for r in store.query_index(owner="u1")[1]] == ["00001", "00003"]
+        assert [r["id"] for r in store.query_index(step=4)[1]] == ["00003", "00002"]
+        assert store.query_index(offset=2, limit=2) == (3, [rows[2]])
+
+    def test_render_pages_and_filters(self, pipe, monkeypatch):
+        self._fill(pipe, monkeypatch)
+        text = pipe._render_projects("", "u1", "00003")
+        assert "стр. 1/2, всего 3" in text
+        assert "`00003` — Закупки · шаг 4" in text and "👈" in text
+        assert "/projects page=2" in text
+        text = pipe._render_projects(" page=5", "u1", "00003")
+        assert "стр. 2/2, всего 3" in text and "`00002`" in text
+        assert "Дальше" not in text
+        text = pipe._render_projects(" mine step=4", "u1", "00001")
+        assert "всего 1" in text and "00003" in text and "00002" not in text
+        assert "Проектов по этому фильтру нет" in pipe._render_projects(" step=7", "u1", "x")
+
+    def test_json_index_rebuilt_when_missing(self, pipe, monkeypatch):
+        if pipe.valves.STATE_BACKEND != "json":
+            pytest.skip("json only")
+        self._fill(pipe, monkeypatch)
+        a3_controller.PROJECTS_INDEX_PATH.unlink()
+        total, rows = a3_controller.JsonProjectStore().query_index()
+        assert total == 3
+        assert {r["id"]: r["owner"] for r in rows} == {"00001": "u1", "00002": "u2", "00003": "u1"}
+
+
+class TestActiveProjectRegistry:
+    """Реестр активных проектов в памяти"""
+
+    @pytest.fixture
+    def pipe(self, state_dirs):
+        pipe = Pipe()
+        pipe.valves.STATE_FSYNC = "never"
+        return pipe
+
+    def test_global_marker_written_only_on_change(self, pipe):
+        reg = a3_controller.get_active_registry()
+        pipe._mark_global_active("00001")
+        pipe._mark_global_active("00001")
+        pipe._mark_global_active("00001")
+        assert json.loads(a3_controller.GLOBAL_ACTIVE_PATH.read_text(encoding="utf-8")) == {"project_id": "00001"}
+        assert (reg.flushes, reg.skipped) == (1, 2)
+
+    def test_flush_is_debounced_inside_event_loop(self, pipe):
+        import asyncio
+        import threading
+
+        pipe.valves.ACTIVE_FLUSH_DELAY_SEC = 0.05
+        reg = a3_controller.get_active_registry()
+        threads = []
+        real_flush = reg.flush
+        reg.flush = lambda: threads.append(threading.current_thread().name) or real_flush()
+
+        async def run():
+            pipe._mark_global_active("00001")
+            pipe._mark_global_active("00002")
+            assert not a3_controller.GLOBAL_ACTIVE_PATH.exists()
+            await asyncio.sleep(0.1)
+
+        asyncio.run(run())
+        assert json.loads(a3_controller.GLOBAL_ACTIVE_PATH.read_text(encoding="utf-8")) == {"project_id": "00002"}
+        assert reg.flushes == 1
+        assert threads and all(name.startswith("a3-io") for name in threads)
+
+    def test_user_lookup_sees_switch_by_another_worker(self, pipe):
+        pipe._set_active_project("u1", "00003")
+        assert pipe._get_active_project("u1") == "00003"
+        path = a3_controller.ACTIVE_DIR / "u1.json"
+        path.write_text(json.dumps({"project_id": "00009"}), encoding="utf-8")
+        st = path.stat()
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+        assert pipe._get_active_project("u1") == "00009"
+        assert pipe._get_active_project("nobody") == "A3-0001"
+
+
+class TestOffLoopStorage:
+    """Дисковые операции пайпа вне event loop"""
+
+    def test_run_io_uses_pool_and_keeps_context(self):
+        import asyncio
+        import threading
+
+        async def run():
+            with Pipe()._state_unit_of_work() as uow:
+                seen = await a3_controller._run_io(
+                    lambda: (threading.current_thread().name, a3_controller._TURN_UOW.get())
+                )
+            return seen, uow
+
+        (thread_name, seen_uow), uow = asyncio.run(run())
+        assert thread_name.startswith("a3-io")
+        assert seen_uow is uow
+
+    def test_pipe_reads_and_writes_state_off_loop(self, state_dirs, monkeypatch):
+        import asyncio
+        import threading
+
+        steps_dir = Path(a3_controller.__file__).resolve().parents[1] / "steps"
+        monkeypatch.setattr(a3_controller, "STEPS_DIR", steps_dir)
+        pipe = Pipe()
+        pipe.valves.STATE_FSYNC = "never"
+        threads = []
+        real_load, real_write = pipe._load_state, pipe._write_state
+        monkeypatch.setattr(
+            pipe, "_load_state", lambda pid: threads.append(threading.current_thread().name) or real_load(pid)
+        )
+        monkeypatch.setattr(
+            pipe,
+            "_write_state",
+            lambda pid, st: threads.append(threading.current_thread().name) or real_write(pid, st),
+        )
+        asyncio.run(pipe.pipe({"messages": [{"role": "user", "content": "/startnew"}]}, {"id": "u1"}, None))
+        assert threads and all(name.startswith("a3-io") for name in threads)
+
+    def test_turn_arms_debounce_timers_from_io_pool(self, state_dirs, monkeypatch):
+        import asyncio
+
+        steps_dir = Path(a3_controller.__file__).resolve().parents[1] / "steps"
+        monkeypatch.setattr(a3_controller, "STEPS_DIR", steps_dir)
+        pipe = Pipe()
+        pipe.valves.STATE_FSYNC = "never"
+        reg = a3_controller.get_active_registry()
+        answer = "Срок поставки деталей вырос с 5 до 9 дней, что срывает план сборки."
+
+        async def run():
+            for text in ("/startnew", answer):
+                await pipe.pipe({"messages": [{"role": "user", "content": text}]}, {"id": "u1"}, None)
+            store = pipe._store()
+            assert (state_dirs / "00001.journal").exists()
+            assert "00001" in store._idle_handles
+            assert reg._handle is not None
+            assert reg.flushes == 0
+            store.close()
+
+        asyncio.run(run())
+
+    def test_idle_compaction_runs_on_io_pool(self, state_dirs, monkeypatch):
+        import asyncio
+        import threading
+
+        steps_dir = Path(a3_controller.__file__).resolve().parents[1] / "steps"
+        monkeypatch.setattr(a3_controller, "STEPS_DIR", steps_dir)
+        pipe = Pipe()
+        pipe.valves.STATE_FSYNC = "never"
+        pipe.valves.STATE_JOURNAL_IDLE_SEC = 0.01
+        answer = "Срок поставки деталей вырос с 5 до 9 дней, что срывает план сборки."
+        threads = []
+
+        async def run():
+            for text in ("/startnew", answer):
+                await pipe.pipe({"messages": [{"role": "user", "content": text}]}, {"id": "u1"}, None)
+            store = pipe._store().inner
+            real_compact = store.compact
+            store.compact = lambda pid: threads.append(threading.current_thread().name) or real_compact(pid)
+            await asyncio.sleep(0.1)
+            store.close()
+
+        asyncio.run(run())
+        assert threads and all(name.startswith("a3-io") for name in threads)
+        assert not (state_dirs / "00001.journal").exists()
+
+    def test_loop_lag_monitor_counts_stalls(self):
+        import asyncio
+
+        monitor = a3_controller.LoopLagMonitor(interval=0.01, stall_ms=20)
+
+        async def run():
+            monitor.ensure_started()
+            await asyncio.sleep(0.02)
+            time.sleep(0.05)  # blocks the loop
+            await asyncio.sleep(0.03)
+            monitor.interval = 0
+
+        asyncio.run(run())
+        stats = monitor.stats()
+        assert stats["stalls"] >= 1
+        assert stats["max_ms"] >= 20
+
+    def test_step_definitions_cached_until_changed(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(a3_controller, "STEPS_DIR", tmp_path)
+        monkeypatch.setattr(a3_controller, "_STEP_CACHE", {})
+        path = tmp_path / "step_1.json"
+        path.write_text(json.dumps({"title": "A"}), encoding="utf-8")
+        pipe = Pipe()
+        assert pipe._load_step(1)["title"] == "A"
+        path.write_text(json.dumps({"title": "B"}), encoding="utf-8")
+        st = path.stat()
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+        assert pipe._load_step(1)["title"] == "A"
+        pipe._refresh_steps()
+        assert pipe._load_step(1)["title"] == "B"
+
+
+class TestLlmResponseCache:
+    """Дисковый кэш JSON-ответов LLM"""
+
+    @pytest.fixture
+    def pipe(self, state_dirs):
+        pipe = Pipe()
+        pipe.calls = []
+
+        async def fake_chat(req, user, messages):
+            pipe.calls.append(messages)
+            return json.dumps({"n": len(pipe.calls)}), "m1"
+
+        pipe._chat_once_with_fallback = fake_chat
+        return pipe
+
+    def _msgs(self, text="Контекст процесса"):
+        return [{"role": "system", "content": "S"}, {"role": "user", "content": text}]
+
+    def _call(self, pipe, messages, **kw):
+        import asyncio
+
+        return asyncio.run(pipe._call_llm_json(None, {"id": "u1"}, messages, **kw))
+
+    def test_repeat_call_served_from_disk(self, pipe):
+        assert self._call(pipe, self._msgs()) == {"n": 1}
+        assert self._call(pipe, self._msgs("  Контекст\n процесса ")) == {"n": 1}
+        assert len(pipe.calls) == 1
+        assert len(list(a3_controller.LLM_CACHE_DIR.glob("*/*.json"))) == 1
+        assert a3_controller._LLM_CACHE.stats()["hits"] == 1
+
+    def test_opt_out_and_regenerate(self, pipe):
+        self._call(pipe, self._msgs())
+        assert self._call(pipe, self._msgs(), use_cache=False) == {"n": 2}
+        token = a3_controller._LLM_CACHE_BYPASS.set(True)
+        try:
+            assert self._call(pipe, self._msgs()) == {"n": 3}
+        finally:
+            a3_controller._LLM_CACHE_BYPASS.reset(token)
+        # the regenerated answer replaces the cached one
+        assert self._call(pipe, self._msgs()) == {"n": 3}
+
+    def test_repaired_truncated_answer_is_not_cached(self, pipe):
+        answers = iter(['{"items": ["a", "b"], "cut": "незаконч', '{"items": ["a", "b", "c"]}'])
+
+        async def fake_chat(req, user, messages):
+            pipe.calls.append(messages)
+            return next(answers), "m1"
+
+        pipe._chat_once_with_fallback = fake_chat
+        assert self._call(pipe, self._msgs()) == {"items": ["a", "b"], "cut": "незаконч"}
+        assert self._call(pipe, self._msgs()) == {"items": ["a", "b", "c"]}
+        assert len(pipe.calls) == 2
+        assert self._call(pipe, self._msgs()) == {"items": ["a", "b", "c"]}
+        assert len(pipe.calls) == 2
+
+    def test_key_depends_on_models_and_prompt_version(self, monkeypatch):
+        msgs = self._msgs()
+        key = a3_controller._llm_cache_key(["m1"], msgs)
+        assert key != a3_controller._llm_cache_key(["m2"], msgs)
+        monkeypatch.setattr(a3_controller, "LLM_PROMPT_VERSION", 99)
+        assert key != a3_controller._llm_cache_key(["m1"], msgs)
+
+    def test_ttl_and_lru_sweep(self, state_dirs, monkeypatch):
+        cache = a3_controller.LlmResponseCache(ttl_sec=100, max_entries=2, sweep_every=1000)
+        monkeypatch.setattr(a3_controller.time, "time", lambda: 1000.0)
+        for i, key in enumerate(["aa1", "bb2", "cc3"]):
+            cache.put(key, "m1", {"i": i})
+            os.utime(cache.path(key), (1000 + i, 1000 + i))
+        monkeypatch.setattr(a3_controller.time, "time", lambda: 1050.0)
+        assert cache.get("aa1")["data"] == {"i": 0}  # hit refreshes its LRU position
+        os.utime(cache.path("aa1"), (1050, 1050))
+        assert cache.sweep() == 1
+        assert not cache.path("bb2").exists()
+        monkeypatch.setattr(a3_controller.time, "time", lambda: 1200.0)
+        assert cache.get("cc3") is None
+        assert cache.stats()["expired"] == 1
+
+
+class TestNextStepPrefetch:
+    """Фоновая предзагрузка предложений следующего шага"""
+
+    @pytest.fixture
+    def pipe(self, state_dirs):
+        pipe = Pipe()
+        pipe.valves.STATE_FSYNC = "never"
+        return pipe
+
+    def test_take_waits_for_job_in_flight(self, state_dirs):
+        import asyncio
+
+        sched = a3_controller._PREFETCH
+        calls = []
+
+        async def factory():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"metric_suggestions": ["M1"]}
+
+        async def run():
+            sched.schedule("T-1", "step4_metrics", "fp", factory)
+            sched.schedule("T-1", "step4_metrics", "fp", factory)  # same inputs: no second call
+            assert await sched.take("T-1", "step4_metrics", "other") is None
+            return await sched.take("T-1", "step4_metrics", "fp")
+
+        assert asyncio.run(run()) == {"metric_suggestions": ["M1"]}
+        assert len(calls) == 1
+        assert sched.stats()["used"] == 1
+
+    def test_unclaimed_result_persisted_and_consumed_later(self, pipe):
+        import asyncio
+
+        pipe._save_state("T-1", {"project_id": "T-1", "current_step": 3, "meta": {}, "data": {}})
+
+        async def factory():
+            return {"metric_suggestions": ["M1"]}
+
+        async def schedule_and_finish():
+            pipe._schedule_prefetch("T-1", "step4_metrics", "fp", factory)
+            await asyncio.sleep(0.05)
+
+        asyncio.run(schedule_and_finish())
+        state = pipe._load_state("T-1")
+        assert state["meta"]["prefetch"]["step4_metrics"]["result"] == {"metric_suggestions": ["M1"]}
+
+        taken = asyncio.run(pipe._take_prefetch("T-1", state, "step4_metrics", "fp"))
+        assert taken == {"metric_suggestions": ["M1"]}
+        assert "step4_metrics" not in state["meta"]["prefetch"]
+        assert asyncio.run(pipe._take_prefetch("T-1", state, "step4_metrics", "fp")) is None
+
+    def test_disabled_by_valve(self, pipe):
+        import asyncio
+
+        pipe.valves.PREFETCH_NEXT_STEP = False
+
+        async def factory():
+            raise AssertionError("must not run")
+
+        async def run():
+            pipe._schedule_prefetch("T-1", "step4_metrics", "fp", factory)
+            await asyncio.sleep(0)
+
+        asyncio.run(run())
+        assert a3_controller._PREFETCH.stats()["started"] == 0
+
+
+class TestChatFallbackResilience:
+    """Таймауты, предохранитель и хеджирование вызовов LLM"""
+
+    @pytest.fixture
+    def pipe(self, monkeypatch):
+        monkeypatch.setattr(a3_controller, "_MODEL_HEALTH", a3_controller.ModelHealth())
+        pipe = Pipe()
+        pipe.valves.METHODOLOGIST_MODEL = "fast-model"
+        pipe.calls = []
+        return pipe
+
+    def _fake_llm(self, pipe, monkeypatch, delays):
+        import asyncio
+
+        async def fake(request=None, form_data=None, user=None):
+            model = form_data["model"]
+            pipe.calls.append(model)
+            delay = delays[model]
+            if delay is None:
+                raise RuntimeError("upstream 500")
+            await asyncio.sleep(delay)
+            return {"choices": [{"message": {"content": f"ok from {model}"}}]}
+
+        monkeypatch.setattr(a3_controller, "generate_chat_completions", fake)
+
+    def _chat(self, pipe):
+        import asyncio
+
+        return asyncio.run(pipe._chat_once_with_fallback(None, {"id": "u1"}, [{"role": "user", "content": "x"}]))
+
+    def test_timeout_falls_back_to_next_model(self, pipe, monkeypatch):
+        pipe.valves.LLM_MODEL_TIMEOUTS = "fast-model=0.02"
+        self._fake_llm(pipe, monkeypatch, {"fast-model": 1.0, "gpt-5.2": 0})
+        assert self._chat(pipe) == ("ok from gpt-5.2", "gpt-5.2")
+        assert a3_controller._MODEL_HEALTH.stats()["fast-model"]["errors"] == 1
+
+    def test_client_timeout_without_limit_is_reported(self, pipe, monkeypatch):
+        import asyncio
+
+        pipe.valves.LLM_TIMEOUT_SEC = 0
+
+        async def fake(request=None, form_data=None, user=None):
+            raise asyncio.TimeoutError()
+
+        monkeypatch.setattr(a3_controller, "generate_chat_completions", fake)
+        with pytest.raises(ValueError, match="upstream timeout"):
+            asyncio.run(pipe._chat_single(None, {"id": "u1"}, [], "fast-model"))
+
+    def test_breaker_skips_failing_model_during_cooldown(self, pipe, monkeypatch):
+        pipe.valves.LLM_BREAKER_FAILURES = 2
+        self._fake_llm(pipe, monkeypatch, {"fast-model": None, "gpt-5.2": 0})
+        self._chat(pipe)
+        self._chat(pipe)
+        pipe.calls.clear()
+        assert self._chat(pipe)[1] == "gpt-5.2"
+        assert pipe.calls == ["gpt-5.2"]
+        assert a3_controller._MODEL_HEALTH.stats()["fast-model"]["open"]
+
+    def test_all_breakers_open_still_tries(self, pipe, monkeypatch):
+        pipe.valves.LLM_BREAKER_FAILURES = 1
+        self._fake_llm(pipe, monkeypatch, {"fast-model": None, "gpt-5.2": None})
+        with pytest.raises(ValueError):
+            self._chat(pipe)
+        with pytest.raises(ValueError, match="upstream 500"):
+            self._chat(pipe)
+
+    def test_hedge_takes_first_valid_answer(self, pipe, monkeypatch):
+        pipe.valves.LLM_HEDGE = True
+        pipe.valves.LLM_HEDGE_MIN_DELAY_SEC = 0.02
+        self._fake_llm(pipe, monkeypatch, {"fast-model": 0.5, "gpt-5.2": 0})
+        assert self._chat(pipe) == ("ok from gpt-5.2", "gpt-5.2")
+        assert pipe.calls == ["fast-model", "gpt-5.2"]
+        # the cancelled loser is not counted as a failure
+        assert a3_controller._MODEL_HEALTH.stats()["fast-model"]["errors"] == 0
+
+    def test_hedge_clock_starts_on_admission(self, pipe, monkeypatch):
+        import asyncio
+
+        monkeypatch.setattr(a3_controller, "_LLM_GATE", a3_controller.LlmAdmission())
+        pipe.valves.LLM_MAX_CONCURRENCY = 1
+        pipe.valves.LLM_HEDGE = True
+        pipe.valves.LLM_HEDGE_MIN_DELAY_SEC = 0.05
+        self._fake_llm(pipe, monkeypatch, {"fast-model": 0.01, "gpt-5.2": 0})
+        gate = pipe._llm_gate()
+
+        async def other():
+            async with gate.slot("u2"):
+                await asyncio.sleep(0.2)
+
+        async def run():
+            holder = asyncio.ensure_future(other())
+            await asyncio.sleep(0)
+            result = await pipe._chat_once_with_fallback(None, {"id": "u1"}, [{"role": "user", "content": "?"}])
+            await holder
+            return result
+
+        assert asyncio.run(run()) == ("ok from fast-model", "fast-model")
+        # a hedge launched while still queued would have queued as well
+        assert pipe.calls == ["fast-model"]
+        assert gate.stats()["queued"] == 1
+
+
+class TestStreamedAnalysis:
+    """Потоковый вывод «анализ проекта»"""
+
+    class _Streaming:
+        def __init__(self, chunks):
+            async def gen():
+                for c in chunks:
+                    yield c
+
+            self.body_iterator = gen()
+
+    def _sse(self, *pieces):
+        out = b""
+        for p in pieces:
+            out += b"data: " + json.dumps({"choices": [{"delta": {"content": p}}]}).encode() + b"\n\n"
+        return out + b"data: [DONE]\n\n"
+
+    def test_iter_completion_text_handles_split_chunks(self):
+        import asyncio
+
+        raw = self._sse("Сильные ", "стороны")
+        resp = self._Streaming([raw[:17], raw[17:40], raw[40:]])
+
+        async def run():
+            return [p async for p in a3_controller._iter_completion_text(resp)]
+
+        assert "".join(asyncio.run(run())) == "Сильные стороны"
+
+    def test_analysis_streams_into_chat(self, monkeypatch):
+        import asyncio
+
+        events = []
+
+        async def emitter(event):
+            events.append(event)
+
+        async def fake(request=None, form_data=None, user=None):
+            assert form_data["stream"] is True
+            return self._Streaming([self._sse("Оценка ", "7/10")])
+
+        monkeypatch.setattr(a3_controller, "generate_chat_completions", fake)
+        pipe = Pipe()
+        pipe.valves.STREAM_EMIT_INTERVAL_SEC = 0
+        review = asyncio.run(pipe._analyze_project_with_gpt52(None, {"id": "u1"}, "A3", emitter, prefix="🧠 "))
+        assert review == "Оценка 7/10"
+        assert events[0] == {"type": "replace", "data": {"content": "🧠 Оценка "}}
+        assert events[-1]["data"]["content"] == "🧠 Оценка 7/10"
+
+    def test_analysis_falls_back_to_blocking_call(self, monkeypatch):
+        import asyncio
+
+        async def fake(request=None, form_data=None, user=None):
+            if form_data["stream"]:
+                raise RuntimeError("stream unsupported")
+            return {"choices": [{"message": {"content": "Полный ответ"}}]}
+
+        async def emitter(event):
+            pass
+
+        monkeypatch.setattr(a3_controller, "generate_chat_completions", fake)
+        monkeypatch.setattr(a3_controller, "_MODEL_HEALTH", a3_controller.ModelHealth())
+        review = asyncio.run(Pipe()._analyze_project_with_gpt52(None, {"id": "u1"}, "A3", emitter))
+        assert review == "Полный ответ"
+
+
+class TestStreamedHypothesis:
+    """Потоковая /гипотеза: разделы появляются по мере закрытия JSON"""
+
+    DRAFT = {
+        "problem": "Долгая приёмка",
+        "spec": {"where_when": "склад", "scale": "все заказы", "consequences": "штрафы",
+                 "who_suffers": "клиенты", "money_impact": "1 млн"},
+        "baseline": [{"metric": "Время", "current_value": "5 дней"}],
+        "target": [{"metric": "Время", "target_value": "2 дня"}],
+        "root_causes": ["Нет графика, \"ручной\" учёт {}"],
+        "actions": [{"action": "Ввести график", "owner": "ОТК", "due": "май"}],
+        "monitoring": "Еженедельно",
+    }
+
+    def test_parser_reports_members_across_split_chunks(self):
+        raw = "```json\n" + json.dumps(self.DRAFT, ensure_ascii=False) + "\n```"
+        parser = a3_controller.IncrementalJsonObject()
+        seen = []
+        for i in range(0, len(raw), 7):
+            seen += parser.feed(raw[i:i + 7])
+        assert seen == list(self.DRAFT)
+        assert parser.values == self.DRAFT
+        assert parser.closed
+
+    def test_streamed_draft_matches_blocking_draft(self, state_dirs, monkeypatch):
+        import asyncio
+
+        raw = json.dumps(self.DRAFT, ensure_ascii=False)
+        sse = TestStreamedAnalysis()._sse(*[raw[i:i + 11] for i in range(0, len(raw), 11)])
+        events = []
+
+        async def emitter(event):
+            events.append(event)
+
+        async def fake(request=None, form_data=None, user=None):
+            if form_data.get("stream"):
+                return TestStreamedAnalysis._Streaming([sse])
+            return {"choices": [{"message": {"content": raw}}]}
+
+        monkeypatch.setattr(a3_controller, "generate_chat_completions", fake)
+        state = {"data": {"steps": {"raw_problem": {"raw_problem_sentence": "Долгая приёмка"}}}}
+        pipe = Pipe()
+        streamed = asyncio.run(pipe._generate_hypothesis(state, "00001", None, {"id": "u1"}, emitter))
+        pipe.valves.LLM_CACHE_TTL_SEC = 0
+        pipe.valves.JOB_RESULT_TTL_SEC = 0
+        blocking = asyncio.run(pipe._generate_hypothesis(state, "00001", None, {"id": "u1"}))
+        assert streamed == blocking
+        events = [e for e in events if e["type"] == "replace"]
+        assert "**1. Проблема**" in events[0]["data"]["content"]
+        assert "**7. Мониторинг**" not in events[0]["data"]["content"]
+        assert len(events) == 7
+
+    def test_stream_failure_feeds_breaker_telemetry_and_fallback(self, state_dirs, monkeypatch):
+        import asyncio
+
+        raw = json.dumps(self.DRAFT, ensure_ascii=False)
+        used = []
+
+        async def fake(request=None, form_data=None, user=None):
+            used.append((form_data["model"], bool(form_data.get("stream"))))
+            if form_data["model"] == "broken":
+                raise RuntimeError("down")
+            return {"choices": [{"message": {"content": raw}}]}
+
+        async def emitter(event):
+            pass
+
+        monkeypatch.setattr(a3_controller, "generate_chat_completions", fake)
+        monkeypatch.setattr(a3_controller, "_MODEL_HEALTH", a3_controller.ModelHealth())
+        pipe = Pipe()
+        pipe.valves.LLM_ROUTES = "_generate_hypothesis=broken|gpt-5.2"
+        pipe.valves.LLM_BREAKER_FAILURES = 1
+        state = {"data": {"steps": {"raw_problem": {"raw_problem_sentence": "Долгая приёмка"}}}}
+        out = asyncio.run(pipe._generate_hypothesis(state, "00001", None, {"id": "u1"}, emitter))
+        assert "Ввести график" in out
+        assert used == [("broken", True), ("gpt-5.2", False)]
+        rows = {(r["site"], r["model"]): r for r in a3_controller._LLM_TELEMETRY.snapshot()["calls"]}
+        assert rows[("_generate_hypothesis", "broken")]["outcomes"] == {"error": 1}
+        assert rows[("_generate_hypothesis", "gpt-5.2")]["outcomes"] == {"ok": 1}
+        assert a3_controller._MODEL_HEALTH.stats()["broken"]["open"]
+
+
+class TestJsonRepair:
+    """Локальная починка JSON до повторного запроса к LLM"""
+
+    @pytest.mark.parametrize(
+        "raw, expected",
+        [
+            ('Вот ответ: {"a": [1, 2,], "b": "x",} Надеюсь, помог.', {"a": [1, 2], "b": "x"}),
+            ("{'a': 'it's', 'ok': True, 'n': None}", {"a": "it's", "ok": True, "n": None}),
+            ('{\u201ca\u201d: \u201cb\u201d}', {"a": "b"}),
+            ('{"text": "строка 1\nстрока 2"}', {"text": "строка 1\nстрока 2"}),
+            ('{"text": "нет "ручного" учёта"}', {"text": 'нет "ручного" учёта'}),
+            ('{"items": [{"x": 1}, {"x": 2', {"items": [{"x": 1}, {"x": 2}]}),
+            ('{"items": ["a", "b"], "cut": "незаконч', {"items": ["a", "b"], "cut": "незаконч"}),
+            ('{"items": ["a"], "next_key', {"items": ["a"]}),
+            ("просто текст", None),
+        ],
+    )
+    def test_repairs_common_breakage(self, raw, expected):
+        assert a3_controller._repair_json(raw) == expected
+
+    def test_repair_avoids_second_llm_call(self, monkeypatch):
+        import asyncio
+
+        calls = []
+
+        async def fake(request=None, form_data=None, user=None):
+            calls.append(form_data["messages"])
+            return {"choices": [{"message": {"content": '```json\n{"answer": "да",}\n```'}}]}
+
+        monkeypatch.setattr(a3_controller, "generate_chat_completions", fake)
+        monkeypatch.setattr(a3_controller, "_JSON_STATS", dict.fromkeys(a3_controller._JSON_STATS, 0))
+        pipe = Pipe()
+        pipe.valves.LLM_CACHE_TTL_SEC = 0
+        data = asyncio.run(pipe._call_llm_json(None, {"id": "u1"}, [{"role": "user", "content": "?"}]))
+        assert data == {"answer": "да"}
+        assert len(calls) == 1
+        assert a3_controller._JSON_STATS["repaired"] == 1
+        assert a3_controller._JSON_STATS["reasked"] == 0
+
+    def test_reasks_when_repair_fails(self, monkeypatch):
+        import asyncio
+
+        answers = iter(["не могу", '{"answer": "да"}'])
+
+        async def fake(request=None, form_data=None, user=None):
+            return {"choices": [{"message": {"content": next(answers)}}]}
+
+        monkeypatch.setattr(a3_controller, "generate_chat_completions", fake)
+        monkeypatch.setattr(a3_controller, "_JSON_STATS", dict.fromkeys(a3_controller._JSON_STATS, 0))
+        pipe = Pipe()
+        pipe.valves.LLM_CACHE_TTL_SEC = 0
+        data = asyncio.run(pipe._call_llm_json(None, {"id": "u1"}, [{"role": "user", "content": "?"}]))
+        assert data == {"answer": "да"}
+        assert a3_controller._JSON_STATS == {"parsed": 1, "repaired": 0, "reasked": 1, "failed": 0}
+
+
+class TestLlmSingleFlight:
+    """Совмещение одинаковых одновременных запросов к LLM"""
+
+    def _fake(self, calls, content='{"answer": "да"}'):
+        import asyncio
+
+        async def fake(request=None, form_data=None, user=None):
+            calls.append(form_data["messages"])
+            await asyncio.sleep(0.02)
+            return {"choices": [{"message": {"content": content}}]}
+
+        return fake
+
+    def test_identical_concurrent_calls_share_one_completion(self, state_dirs, monkeypatch):
+        import asyncio
+
+        calls = []
+        monkeypatch.setattr(a3_controller, "generate_chat_completions", self._fake(calls))
+        pipe = Pipe()
+        same = [{"role": "user", "content": "?"}]
+        other = [{"role": "user", "content": "!"}]
+
+        async def run():
+            return await asyncio.gather(
+                pipe._call_llm_json(None, {"id": "u1"}, same),
+                pipe._call_llm_json(None, {"id": "u2"}, list(same)),
+                pipe._call_llm_json(None, {"id": "u1"}, other),
+            )
+
+        results = asyncio.run(run())
+        assert results == [{"answer": "да"}] * 3
+        results[0]["answer"] = "изменено"  # one turn normalising its answer in place
+        assert results[1] == {"answer": "да"}
+        assert len(calls) == 2
+        assert a3_controller._LLM_FLIGHTS.stats() == {"leaders": 2, "coalesced": 1, "inflight": 0}
+
+    def test_cancelled_caller_does_not_cancel_shared_call(self, state_dirs, monkeypatch):
+        import asyncio
+
+        calls = []
+        monkeypatch.setattr(a3_controller, "generate_chat_completions", self._fake(calls))
+        pipe = Pipe()
+        messages = [{"role": "user", "content": "?"}]
+
+        async def run():
+            first = asyncio.ensure_future(pipe._call_llm_json(None, {"id": "u1"}, messages))
+            second = asyncio.ensure_future(pipe._call_llm_json(None, {"id": "u1"}, messages))
+            await asyncio.sleep(0.005)
+            first.cancel()
+            return await second
+
+        assert asyncio.run(run()) == {"answer": "да"}
+        assert len(calls) == 1
+
+
+class TestLlmTelemetry:
+    """Телеметрия вызовов LLM по точкам вызова и моделям"""
+
+    def test_records_site_model_tokens_and_parse(self, state_dirs, monkeypatch):
+        import asyncio
+
+        async def fake(request=None, form_data=None, user=None):
+            if form_data["model"] == "broken":
+                raise RuntimeError("down")
+            return {
+                "choices": [{"message": {"content": '{"why_suggestions": ["W1"]}'}}],
+                "usage": {"prompt_tokens": 120, "completion_tokens": 30},
+            }
+
+        monkeypatch.setattr(a3_controller, "generate_chat_completions", fake)
+        monkeypatch.setattr(a3_controller, "_MODEL_HEALTH", a3_controller.ModelHealth())
+        pipe = Pipe()
+        pipe.valves.METHODOLOGIST_MODEL = "broken"
+        asyncio.run(pipe._get_step6_why_suggestions(None, {"id": "u1"}, "P1"))
+        state = {"data": {"steps": {"raw_problem": {"raw_problem_sentence": "Долгая приёмка"}}}}
+        asyncio.run(pipe._generate_hypothesis(state, "00001", None, {"id": "u1"}))
+
+        snap = a3_controller._LLM_TELEMETRY.snapshot()
+        rows = {(r["site"], r["model"]): r for r in snap["calls"]}
+        failed = rows[("_get_step6_why_suggestions", "broken")]
+        ok = rows[("_get_step6_why_suggestions", "gpt-5.2")]
+        assert failed["outcomes"] == {"error": 1}
+        assert ok["fallback"] == 1
+        assert (ok["prompt_tokens"], ok["completion_tokens"]) == (120, 30)
+        assert ok["p50"] is not None
+        assert snap["json"] == {"_generate_hypothesis": {"parsed": 1, "repaired": 0, "failed": 0}}
+
+    def test_streamed_analysis_and_wrapped_calls_keep_their_site(self, state_dirs, monkeypatch):
+        import asyncio
+
+        async def fake(request=None, form_data=None, user=None):
+            if form_data.get("stream"):
+                return TestStreamedAnalysis._Streaming([TestStreamedAnalysis()._sse("Оценка ", "7/10")])
+            return {"choices": [{"message": {"content": '{"plan": []}'}}]}
+
+        async def emitter(event):
+            pass
+
+        monkeypatch.setattr(a3_controller, "generate_chat_completions", fake)
+        monkeypatch.setattr(a3_controller, "_MODEL_HEALTH", a3_controller.ModelHealth())
+        pipe = Pipe()
+        asyncio.run(pipe._analyze_project_with_gpt52(None, {"id": "u1"}, "A3", emitter))
+        ctx = {"raw_problem": "P", "root_causes": ["R"]}
+        wrapped = lambda: pipe._get_step7_plan_from_actions(None, {"id": "u1"}, ["Ввести график"], ctx)
+        asyncio.run(pipe._run_job("T-1", "plan", "fp", wrapped))
+
+        sites = {(r["site"], r["model"]): r["outcomes"] for r in a3_controller._LLM_TELEMETRY.snapshot()["calls"]}
+        assert sites[("_analyze_project_with_gpt52", "gpt-5.2")] == {"ok": 1}
+        assert sites[("_get_step7_plan_from_actions", "gpt-5.2")] == {"ok": 1}
+
+    def test_admin_command_dumps_metrics_file(self, state_dirs, monkeypatch):
+        import asyncio
+
+        a3_controller._LLM_TELEMETRY.record("_get_step2_hints_and_extract", "gpt-5.2", 1, "ok", 1.5)
+        body = {"messages": [{"role": "user", "content": "/a3stats llm"}]}
+        out = asyncio.run(Pipe().pipe(body, {"id": "admin", "role": "admin"}, None))
+        assert "| _get_step2_hints_and_extract | gpt-5.2 | 1 | 0 | 0 | 1.5 |" in out
+        dumped = json.loads(a3_controller.LLM_METRICS_PATH.read_text(encoding="utf-8"))
+        assert dumped["calls"][0]["site"] == "_get_step2_hints_and_extract"
+
+
+class TestLlmRouting:
+    """Маршрутизация вызовов LLM по точкам вызова"""
+
+    def test_route_parsing(self):
+        pipe = Pipe()
+        pipe.valves.LLM_ROUTES = "_get_step*=mini|gpt-5.2@20; _get_step6_root_hint=nano; bad; *=big"
+        assert pipe._llm_route("_get_step6_root_hint") == (["nano"], None)
+        assert pipe._llm_route("_get_step2_hints_and_extract") == (["mini", "gpt-5.2"], 20.0)
+        assert pipe._llm_route("_generate_hypothesis") == (["big"], None)
+        assert pipe._model_candidates("_get_step2_hints_and_extract") == ["mini", "gpt-5.2"]
+        assert pipe._attempt_timeout("_get_step2_hints_and_extract", "mini") == 20.0
+        pipe.valves.LLM_ROUTES = ""
+        assert pipe._model_candidates("_generate_hypothesis") == ["gpt-5.2"]
+        assert pipe._attempt_timeout("_generate_hypothesis", "gpt-5.2") == 120.0
+
+    def test_call_sites_use_their_routes(self, state_dirs, monkeypatch):
+        import asyncio
+
+        used = []
+
+        async def fake(request=None, form_data=None, user=None):
+            used.append(form_data["model"])
+            return {"choices": [{"message": {"content": "Причина"}}]}
+
+        monkeypatch.setattr(a3_controller, "generate_chat_completions", fake)
+        monkeypatch.setattr(a3_controller, "_MODEL_HEALTH", a3_controller.ModelHealth())
+        pipe = Pipe()
+        pipe.valves.LLM_ROUTES = "_get_step6_why_suggestions=mini; _analyze_project_with_gpt52=big"
+        asyncio.run(pipe._get_step6_why_suggestions(None, {"id": "u1"}, "P1"))
+        asyncio.run(pipe._analyze_project_with_gpt52(None, {"id": "u1"}, "A3"))
+        assert used == ["mini", "big"]
+
+
+class TestLocalExtraction:
+    """Разбор заполненных шаблонов без обращения к LLM"""
+
+    STEP2 = (
+        "Где/когда: на складе при приёмке, ежедневно\n"
+        "Масштаб: 30% поставок\n"
+        "Последствия: простои бригад до 2 дней\n"
+        "Кто страдает: прорабы и снабжение\n"
+        "Деньги: около 1,5 млн руб. в месяц"
+    )
+
+    def _run(self, pipe, text, state, monkeypatch):
+        import asyncio
+
+        holder = {"state": state}
+        llm_calls = []
+
+        async def step2_llm(*args, **kwargs):
+            llm_calls.append("step2")
+            return {"extracted": {}, "hints": ["H"]}
+
+        async def step3_llm(*args, **kwargs):
+            llm_calls.append("step3")
+            return {"hints": [], "examples": {}, "metric_suggestions": [], "extracted": {}}
+
+        async def proposals(*args, **kwargs):
+            llm_calls.append("step3_proposals")
+            return {"process_variants": ["П1"], "project_variants": ["Пр1"]}
+
+        steps_dir = Path(a3_controller.__file__).resolve().parents[1] / "steps"
+        monkeypatch.setattr(a3_controller, "STEPS_DIR", steps_dir)
+        monkeypatch.setattr(a3_controller, "_LOCAL_EXTRACT_STATS", {
+            "step2": {"local": 0, "llm": 0}, "step3": {"local": 0, "llm": 0},
+        })
+        monkeypatch.setattr(pipe, "_load_state", lambda _pid: holder["state"])
+        monkeypatch.setattr(pipe, "_save_state", lambda _pid, st: holder.update(state=st))
+        monkeypatch.setattr(pipe, "_get_active_project", lambda _uid: "T-1")
+        monkeypatch.setattr(pipe, "_get_step2_hints_and_extract", step2_llm)
+        monkeypatch.setattr(pipe, "_get_step3_context_hints_examples_and_extract", step3_llm)
+        monkeypatch.setattr(pipe, "_get_step3_proposals", proposals)
+        body = {"messages": [{"role": "user", "content": text}]}
+        asyncio.run(pipe.pipe(body, {"id": "u1"}, None))
+        return holder["state"], llm_calls
+
+    def _state(self, step):
+        return {
+            "project_id": "T-1",
+            "current_step": step,
+            "meta": {"step3_phase": "context"},
+            "data": {"steps": {"raw_problem": {"raw_problem_sentence": "Долгая приёмка"}}},
+        }
+
+    def test_scores(self):
+        pipe = Pipe()
+        assert pipe._local_score_step2(pipe._extract_step2_fields_local(self.STEP2)) == 1.0
+        weak = pipe._extract_step2_fields_local("Где/когда: склад\nМасштаб: неизвестно\nДеньги: нет данных")
+        assert pipe._local_score_step2(weak) == 0.4
+
+    def test_complete_step2_template_skips_llm_extraction(self, state_dirs, monkeypatch):
+        pipe = Pipe()
+        st, llm_calls = self._run(pipe, self.STEP2, self._state(2), monkeypatch)
+        assert st["current_step"] == 3
+        assert st["data"]["steps"]["problem_spec"]["scale"] == "30% поставок"
+        assert llm_calls == ["step3"]  # only the step 3 hints shown in the same turn
+        assert a3_controller._LOCAL_EXTRACT_STATS["step2"] == {"local": 1, "llm": 0}
+
+    def test_weak_step2_answer_goes_to_llm(self, state_dirs, monkeypatch):
+        pipe = Pipe()
+        st, llm_calls = self._run(pipe, "Где/когда: склад\nМасштаб: неизвестно", self._state(2), monkeypatch)
+        assert llm_calls == ["step2"]
+        assert a3_controller._LOCAL_EXTRACT_STATS["step2"] == {"local": 0, "llm": 1}
+
+    def test_threshold_zero_disables_gate(self, state_dirs, monkeypatch):
+        pipe = Pipe()
+        pipe.valves.LOCAL_EXTRACT_MIN_SCORE = 0
+        _, llm_calls = self._run(pipe, self.STEP2, self._state(2), monkeypatch)
+        assert llm_calls[0] == "step2"
+
+    def test_complete_step3_template_skips_llm_extraction(self, state_dirs, monkeypatch):
+        pipe = Pipe()
+        text = (
+            "Событие начала: поступление заявки\n"
+            "Событие окончания: материал на объекте\n"
+            "Владелец процесса: начальник снабжения\n"
+            "Периметр: снабжение и склад\n"
+            "Метрики результата (2–4, без чисел): время цикла; доля срывов"
+        )
+        st, llm_calls = self._run(pipe, text, self._state(3), monkeypatch)
+        ctx = st["data"]["steps"]["process_context"]
+        assert ctx["owner"] == "начальник снабжения"
+        assert ctx["result_metrics"] == ["время цикла", "доля срывов"]
+        assert llm_calls == ["step3_proposals"]  # name variants still come from the LLM
+        assert a3_controller._LOCAL_EXTRACT_STATS["step3"] == {"local": 1, "llm": 0}
+
+
+class TestLlmAdmission:
+    """Общий лимит одновременных вызовов LLM и честная очередь"""
+
+    def test_round_robin_per_user_and_priority(self):
+        import asyncio
+
+        gate = a3_controller.LlmAdmission(limit=1)
+        order = []
+
+        async def call(user, priority, tag):
+            async with gate.slot(user, priority):
+                order.append(tag)
+                await asyncio.sleep(0.01)
+
+        async def run():
+            holder = asyncio.ensure_future(call("x", 0, "first"))
+            await asyncio.sleep(0)
+            jobs = [
+                call("review", a3_controller.LLM_PRIORITY_REVIEW, "review"),
+                call("a", 0, "a1"),
+                call("a", 0, "a2"),
+                call("a", 0, "a3"),
+                call("b", 0, "b1"),
+            ]
+            await asyncio.gather(holder, *jobs)
+
+        asyncio.run(run())
+        assert order == ["first", "a1", "b1", "a2", "a3", "review"]
+        assert gate.stats()["active"] == 0
+        assert gate.stats()["queued"] == 5
+
+    def test_cancelled_waiter_leaves_queue(self):
+        import asyncio
+
+        gate = a3_controller.LlmAdmission(limit=1)
+
+        async def run():
+            async with gate.slot("a"):
+                waiter = asyncio.ensure_future(gate.slot("b").__aenter__())
+                await asyncio.sleep(0)
+                assert gate.waiting() == 1
+                waiter.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await waiter
+                assert gate.waiting() == 0
+            assert gate.active == 0
+
+        asyncio.run(run())
+
+    def test_queue_position_reported_to_chat(self, state_dirs, monkeypatch):
+        import asyncio
+
+        release = None
+
+        async def fake(request=None, form_data=None, user=None):
+            await release.wait()
+            return {"choices": [{"message": {"content": "ok"}}]}
+
+        monkeypatch.setattr(a3_controller, "generate_chat_completions", fake)
+        monkeypatch.setattr(a3_controller, "_MODEL_HEALTH", a3_controller.ModelHealth())
+        pipe = Pipe()
+        pipe.valves.LLM_MAX_CONCURRENCY = 1
+        events = []
+
+        async def emitter(event):
+            events.append(event)
+
+        async def run():
+            nonlocal release
+            release = asyncio.Event()
+            messages = [{"role": "user", "content": "?"}]
+            first = asyncio.ensure_future(pipe._chat_once_with_fallback(None, {"id": "u1"}, messages))
+            await asyncio.sleep(0)
+            token = a3_controller._LLM_EMITTER.set(emitter)
+            second = asyncio.ensure_future(pipe._chat_once_with_fallback(None, {"id": "u2"}, messages))
+            a3_controller._LLM_EMITTER.reset(token)
+            await asyncio.sleep(0.01)
+            release.set()
+            return await asyncio.gather(first, second)
+
+        assert asyncio.run(run()) == [("ok", "gpt-5.2"), ("ok", "gpt-5.2")]
+        statuses = [e["data"] for e in events if e["type"] == "status"]
+        assert statuses[0]["done"] is False and "1-й" in statuses[0]["description"]
+        assert statuses[-1]["done"] is True
+
+
+class TestBackgroundJobs:
+    """Долгие операции как фоновые задачи с сохранённым результатом"""
+
+    def test_job_survives_cut_off_request_and_result_is_reused(self):
+        import asyncio
+
+        pipe = Pipe()
+        calls = []
+        events = []
+
+        async def emitter(event):
+            events.append(event)
+
+        async def analysis():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "Оценка 7/10"
+
+        async def run():
+            request = asyncio.ensure_future(pipe._run_job("T-1", "analysis", "fp1", analysis, emitter, "Анализ"))
+            await asyncio.sleep(0.01)
+            request.cancel()  # the proxy gave up on the request
+            with pytest.raises(asyncio.CancelledError):
+                await request
+            await asyncio.sleep(0.08)
+            return await pipe._run_job("T-1", "analysis", "fp1", analysis, emitter, "Анализ")
+
+        assert asyncio.run(run()) == "Оценка 7/10"
+        assert calls == [1]
+        record = json.loads((a3_controller.JOBS_DIR / "T-1" / "analysis.json").read_text(encoding="utf-8"))
+        assert record["status"] == "done" and record["result"] == "Оценка 7/10"
+        assert record["id"].startswith("analysis-")
+        assert events[0]["data"]["done"] is False and record["id"] in events[0]["data"]["description"]
+        assert events[-1]["data"] == {"description": f"Анализ: готово, результат задачи {record['id']}", "done": True}
+        assert a3_controller._JOBS.stats()["reused"] == 1
+
+    def test_concurrent_request_joins_running_job(self):
+        import asyncio
+
+        pipe = Pipe()
+        calls = []
+
+        async def proposals():
+            calls.append(1)
+            await asyncio.sleep(0.02)
+            return {"problems": ["P1"]}
+
+        async def run():
+            return await asyncio.gather(
+                pipe._run_job("T-1", "step6_problems", "fp", proposals),
+                pipe._run_job("T-1", "step6_problems", "fp", proposals),
+            )
+
+        assert asyncio.run(run()) == [{"problems": ["P1"]}] * 2
+        assert calls == [1]
+
+    def test_changed_inputs_stale_records_and_refresh_rerun(self):
+        import asyncio
+
+        pipe = Pipe()
+        results = iter(["A", "B", "C"])
+
+        async def job():
+            return next(results)
+
+        runner = a3_controller._JOBS
+        runner._write("T-1", "analysis", {"id": "x", "fingerprint": "old", "status": "running"})
+
+        async def run():
+            first = await pipe._run_job("T-1", "analysis", "old", job)
+            second = await pipe._run_job("T-1", "analysis", "new", job)
+            token = a3_controller._LLM_CACHE_BYPASS.set(True)
+            try:
+                third = await pipe._run_job("T-1", "analysis", "new", job)
+            finally:
+                a3_controller._LLM_CACHE_BYPASS.reset(token)
+            return first, second, third
+
+        assert asyncio.run(run()) == ("A", "B", "C")
+
+    def test_superseded_job_does_not_overwrite_newer_record(self):
+        import asyncio
+
+        runner = a3_controller._JOBS
+
+        async def slow():
+            await asyncio.sleep(0.05)
+            return "old"
+
+        async def fast():
+            return "new"
+
+        async def run():
+            old = runner.start("T-1", "analysis", "fp-old", slow)
+            await asyncio.sleep(0.01)
+            new = runner.start("T-1", "analysis", "fp-new", fast)
+            return await asyncio.gather(old["task"], new["task"])
+
+        assert asyncio.run(run()) == ["old", "new"]
+        record = runner._read("T-1", "analysis")
+        assert (record["fingerprint"], record["result"]) == ("fp-new", "new")
+        assert not [p for p in (a3_controller.JOBS_DIR / "T-1").iterdir() if p.name.endswith(".tmp")]
+
+    def test_step6_job_keyed_on_target_values(self, monkeypatch):
+        import asyncio
+
+        pipe = Pipe()
+        seen = []
+
+        async def proposals(req, user, raw, spec, ctx, current, targets):
+            seen.append([m["target_value"] for m in targets])
+            return {"problems": [f"P{len(seen)}"]}
+
+        steps_dir = Path(a3_controller.__file__).resolve().parents[1] / "steps"
+        monkeypatch.setattr(a3_controller, "STEPS_DIR", steps_dir)
+        monkeypatch.setattr(pipe, "_save_state", lambda _pid, st: None)
+        monkeypatch.setattr(pipe, "_get_active_project", lambda _uid: "T-1")
+        monkeypatch.setattr(pipe, "_get_step6_problem_proposals", proposals)
+        metrics = [{"metric": "Срок", "current_value": "9 дней"}]
+        monkeypatch.setattr(pipe, "_load_state", lambda _pid: {
+            "project_id": "T-1",
+            "current_step": 5,
+            "meta": {},
+            "data": {"steps": {"current_state_metrics": metrics, "target_state_metrics": [dict(m) for m in metrics]}},
+        })
+
+        for target in ("5 дней", "5 дней", "3 дня"):
+            body = {"messages": [{"role": "user", "content": f"Метрика: Срок\nЦелевое значение: {target}"}]}
+            asyncio.run(pipe.pipe(body, {"id": "u1"}, None))
+        assert seen == [["5 дней"], ["3 дня"]]
+
+
+class TestUserCache:
+    """Кэш пользователей Open WebUI для вызовов LLM"""
+
+    def test_user_fetched_once_per_ttl_off_loop(self, monkeypatch):
+        import asyncio
+        import threading
+
+        queries = []
+
+        class Users:
+            @staticmethod
+            def get_user_by_id(uid):
+                queries.append((uid, threading.current_thread().name))
+                return {"id": uid} if uid != "ghost" else None
+
+        now = [100.0]
+        monkeypatch.setattr(a3_controller, "Users", Users)
+        monkeypatch.setattr(a3_controller, "_USER_CACHE", a3_controller.UserCache())
+        monkeypatch.setattr(a3_controller.time, "monotonic", lambda: now[0])
+        pipe = Pipe()
+
+        async def lookup(*uids):
+            return [await pipe._get_user_async(u) for u in uids]
+
+        assert asyncio.run(lookup("u1", "u1", "ghost", "ghost")) == [{"id": "u1"}, {"id": "u1"}, None, None]
+        assert [q[0] for q in queries] == ["u1", "ghost", "ghost"]
+        assert all(name.startswith("a3-io") for _, name in queries)
+        now[0] += 61
+        asyncio.run(lookup("u1"))
+        assert [q[0] for q in queries].count("u1") == 2
+        pipe.valves.USER_CACHE_TTL_SEC = 0
+        asyncio.run(lookup("u1", "u1"))
+        assert [q[0] for q in queries].count("u1") == 4
+
+
+class TestPromptBudget:
+    """Сборка промптов с оценкой токенов и сокращением по приоритету"""
+
+    def _state(self):
+        chains = {
+            f"P{p}": [{"level": i, "answer": f"P{p} причина {i} " + "подробности " * 20} for i in range(1, 4)]
+            for p in range(1, 5)
+        }
+        return {"data": {"steps": {
+            "raw_problem": {"raw_problem_sentence": "Долгая приёмка"},
+            "step6_active_problem": "P1",
+            "step6_why_chain": [{"level": i, "answer": f"ответ {i}"} for i in range(1, 6)],
+            "step6_chains_by_problem": chains,
+            "root_causes": [{"problem": "P1", "root_cause": "нет графика"}],
+            "step7_plan": [{"action": "Ввести график", "owner": "ОТК", "due": "май"}],
+        }}}
+
+    def test_builder_cuts_highest_priority_oldest_first(self):
+        builder = a3_controller.PromptBuilder(budget=40)
+        builder.add("core", ["Проблема: долгая приёмка"])
+        builder.add("chain", ["Цепочка:"], ["почему 1 " * 5, "почему 2 " * 5], priority=1)
+        builder.add("history", ["История:"], ["старое " * 10, "новое " * 10], priority=2)
+        lines = builder.lines()
+        assert lines[:2] == ["Проблема: долгая приёмка", "Цепочка:"]
+        assert "- … ещё 2 (сокращено)" in lines
+        assert builder.report["history"]["after"] < builder.report["history"]["before"]
+        assert builder.report["core"]["after"] == builder.report["core"]["before"]
+        assert sum(r["after"] for r in builder.report.values()) <= 40
+
+    def test_summary_full_without_budget_and_trimmed_with_it(self):
+        pipe = Pipe()
+        full = pipe._build_project_summary_lines(self._state(), "00001", 7)
+        assert "- Проблема: P2" in full and "- Проблема: P4" in full
+        assert "- Проблема: P1" not in full  # active: shown in its own section
+        assert "- Почему 1: ответ 1" in full and "- Почему 5: ответ 5" in full
+        assert not any("сокращено" in ln for ln in full)
+
+        budget = 800
+        short = pipe._build_project_summary_lines(self._state(), "00001", 7, budget=budget)
+        assert a3_controller._estimate_tokens("\n".join(short)) <= budget
+        assert "- Проблема: P1" not in short  # active: shown in its own section
+        assert "- Почему 5: ответ 5" in short
+        assert "- Проблема: P2" not in short  # oldest other chain cut first
+        assert "- Проблема: P4" in short  # newest chain kept
+        roomy = pipe._build_project_summary_lines(self._state(), "00001", 7, budget=100000)
+        assert roomy == full
+        assert "- P1 -> нет графика" in short
+        assert "- Ввести график (ответственный: ОТК, срок: май)" in short
+
+    def test_compact_json_for_prompts(self, monkeypatch):
+        import asyncio
+
+        prompts = []
+
+        async def fake_call(__request__, __user__, messages, use_cache=True, site=""):
+            prompts.append(messages[-1]["content"])
+            return {"plan": []}
+
+        pipe = Pipe()
+        monkeypatch.setattr(pipe, "_call_llm_json", fake_call)
+        ctx = {"start_event": "заявка", "owner": "", "result_metrics": ["время", ""]}
+        asyncio.run(pipe._get_step7_plan_from_actions(None, {"id": "u1"}, ["Ввести график"], ctx))
+        assert '{"start_event": "заявка", "result_metrics": ["время"]}' in prompts[0]
+        assert "\\u0" not in prompts[0]
+
+
+class TestGatherBounded:
+    """Параллельный запуск корутин с ограничением"""
+
+    def test_limits_concurrency_and_keeps_order(self):
+        import asyncio
+
+        active = {"now": 0, "max": 0}
+
+        def job(i):
+            async def run():
+                active["now"] += 1
+                active["max"] = max(active["max"], active["now"])
+                await asyncio.sleep(0.01)
+                active["now"] -= 1
+                return i
+
+            return run
+
+        result = asyncio.run(a3_controller._gather_bounded([job(i) for i in range(6)], 2))
+        assert result == list(range(6))
+        assert active["max"] == 2
+
+
+class TestProjectStateCache:
+    """LRU-кэш состояний с проверкой версии файла"""
+
+    @pytest.fixture
+    def pipe(self, state_dirs):
+        pipe = Pipe()
+        pipe.valves.STATE_FSYNC = "never"
+        return pipe
+
+    def test_write_through_then_hit(self, pipe):
+        pipe._save_state("T-1", {"project_id": "T-1", "current_step": 2, "data": {}})
+        cache = pipe._store().cache
+        first = pipe._load_state("T-1")
+        assert first["current_step"] == 2
+        assert cache.hits == 1 and cache.misses == 0
+        first["current_step"] = 99
+        assert pipe._load_state("T-1")["current_step"] == 2
+
+    def test_external_write_is_detected(self, pipe, state_dirs):
+        pipe._save_state("T-1", {"project_id": "T-1", "current_step": 2})
+        (state_dirs / "T-1.json").write_text(
+            json.dumps({"project_id": "T-1", "current_step": 5, "pad": "x" * 10}),
+            encoding="utf-8",
+        )
+        assert pipe._load_state("T-1")["current_step"] == 5
+        assert pipe._store().cache.stale == 1
+
+    def test_lru_eviction_and_disabled_cache(self):
+        cache = a3_controller.ProjectStateCache(capacity=2)
+        for pid in ("A", "B", "C"):
+            cache.put(pid, 1, {"id": pid})
+        assert cache.get("A", 1) is None
+        assert cache.get("C", 1) == {"id": "C"}
+        assert cache.stats()["evictions"] == 1
+        off = a3_controller.ProjectStateCache(capacity=0)
+        off.put("A", 1, {"id": "A"})
+        assert off.get("A", 1) is None
+
+    def test_stats_command_is_admin_only(self, pipe, monkeypatch):
+        import asyncio
+
+        monkeypatch.setattr(pipe, "_get_active_project", lambda _uid: "T-1")
+        body = {"messages": [{"role": "user", "content": "/a3stats"}]}
+        denied = asyncio.run(pipe.pipe(body, {"id": "u1", "role": "user"}, None))
+        assert "администратору" in denied
+        out = asyncio.run(pipe.pipe(body, {"id": "u1", "role": "admin"}, None))
+        assert "Кэш состояний" in out
+
+
+class TestStateJournal:
+    """Журнал изменений проекта и компакция"""
+
+    @pytest.fixture
+    def pipe(self, state_dirs):
+        pipe = Pipe()
+        pipe.valves.STATE_FSYNC = "never"
+        pipe.valves.STATE_JOURNAL_MAX_OPS = 3
+        pipe.valves.STATE_JOURNAL_IDLE_SEC = 0
+        return pipe
+
+    def _state(self, chain):
+        return {
+            "project_id": "T-1",
+            "current_step": 6,
+            "meta": {},
+            "data": {"steps": {"step6_why_chain": chain, "big": "x" * 2000}},
+        }
+
+    def test_diff_and_apply_roundtrip(self):
+        old = {"a": 1, "b": {"c": [1, 2]}, "d": "x"}
+        new = {"a": 2, "b": {"c": [1, 2, 3]}, "e": None}
+        ops = a3_controller._json_diff(old, new)
+        assert {"op": "append", "path": ["b", "c"], "value": 3} in ops
+        assert a3_controller._json_apply(json.loads(json.dumps(old)), ops) == new
+
+    def test_small_edit_appends_to_journal(self, pipe, state_dirs):
+        pipe._save_state("T-1", self._state([]))
+        snapshot = (state_dirs / "T-1.json").read_text(encoding="utf-8")
+        pipe._save_state("T-1", self._state([{"level": 1, "answer": "A"}]))
+        assert (state_dirs / "T-1.json").read_text(encoding="utf-8") == snapshot
+        journal = (state_dirs / "T-1.journal").read_text(encoding="utf-8")
+        assert "x" * 100 not in journal
+        assert json.loads(journal)["ops"][0]["op"] == "append"
+
+    def test_load_replays_journal_in_fresh_store(self, pipe, state_dirs):
+        pipe._save_state("T-1", self._state([]))
+        pipe._save_state("T-1", self._state([{"level": 1, "answer": "A"}]))
+        fresh = a3_controller.JsonProjectStore()
+        state = fresh.load("T-1")
+        assert state["data"]["steps"]["step6_why_chain"] == [{"level": 1, "answer": "A"}]
+        assert "_journal_seq" not in state
+
+    def test_compaction_after_max_ops(self, pipe, state_dirs):
+        chain = []
+        pipe._save_state("T-1", self._state(list(chain)))
+        for i in range(3):
+            chain.append({"level": i + 1, "answer": str(i)})
+            pipe._save_state("T-1", self._state(list(chain)))
+        snap = json.loads((state_dirs / "T-1.json").read_text(encoding="utf-8"))
+        assert snap["_journal_seq"] == 3
+        assert len(snap["data"]["steps"]["step6_why_chain"]) == 3
+        assert not (state_dirs / "T-1.journal").exists()
+        assert a3_controller.JsonProjectStore().load("T-1") == self._state(chain)
+
+    def test_torn_snapshot_recovers_from_backup_and_prev_journal(self, pipe, state_dirs):
+        chain = []
+        pipe._save_state("T-1", self._state(list(chain)))
+        for i in range(4):
+            chain.append({"level": i + 1, "answer": str(i)})
+            pipe._save_state("T-1", self._state(list(chain)))
+        (state_dirs / "T-1.json").write_text("{torn", encoding="utf-8")
+        assert a3_controller.JsonProjectStore().load("T-1") == self._state(chain)
+
+    @pytest.mark.parametrize("module", ["a3_status_iframe", "a3_workflow_buttons"])
+    def test_actions_replay_journal_without_pipe(self, pipe, state_dirs, monkeypatch, module):
+        import importlib.util
+
+        path = Path(__file__).parent.parent / "a3_assistant" / "actions" / f"{module}.py"
+        spec = importlib.util.spec_from_file_location(f"_test_{module}", path)
+        action = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(action)
+        monkeypatch.setattr(action, "STATE_DIR", state_dirs)
+        pipe._save_state("T-1", self._state([]))
+        moved = self._state([{"level": 1, "answer": "A"}])
+        moved["current_step"] = 7
+        pipe._save_state("T-1", moved)
+        assert (state_dirs / "T-1.journal").exists()
+        state = action.Action()._load_state("T-1")
+        assert state["current_step"] == 7
+        assert state["data"]["steps"]["step6_why_chain"] == [{"level": 1, "answer": "A"}]
+        assert "_journal_seq" not in state
+
+
 class TestPipeIntegration:
     """Интеграционные тесты"""
 